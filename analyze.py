@@ -1,33 +1,261 @@
 import argparse
-import ast
-from pattern_converter import convert_pattern, convert_pattern_matrix, get_subjects, get_line_no
-from pattern_matching_checker import *
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from budget import Budget, DEFAULT_Z3_TIMEOUT_MS, DEFAULT_MAX_STEPS, DEFAULT_MATCH_SECONDS
+from stats import Stats, DEFAULT_TOP
+from report import FileError, analyze_file, record_from_dict, record_to_dict, render_text, to_json_line
+from result_cache import ResultCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from symbol_index import SymbolIndex
+from pattern_matching_checker import COLUMN_STRATEGIES, set_column_strategy
+from git_diff import GitError, LineRange, changed_lines, parse_unified_diff, read_revision, read_revisions, repository_root
+
+
+SKIPPED_DIRS = {'__pycache__', '.git', '.hg', '.svn', '.tox', '.nox', '.venv', 'venv', 'node_modules'}
+
+
+def collect_targets(targets: List[str]) -> List[str]:
+    # expand directories and glob patterns into a sorted, duplicate-free list of python files
+    files = []
+
+    for target in targets:
+        if os.path.isdir(target):
+            for dir_path, dir_names, file_names in os.walk(target):
+                dir_names[:] = sorted(name for name in dir_names if name not in SKIPPED_DIRS)
+                files.extend(os.path.join(dir_path, name) for name in sorted(file_names) if name.endswith('.py'))
+        elif glob.has_magic(target):
+            files.extend(path for path in sorted(glob.glob(target, recursive=True)) if os.path.isfile(path))
+        else:
+            files.append(target)
+
+    return list(dict.fromkeys(files))
+
+
+_result_cache: Optional[ResultCache] = None
+_symbol_index: Optional[SymbolIndex] = None
+
+
+def init_worker(cache_dir: Optional[str], max_bytes: int = DEFAULT_MAX_BYTES, enabled: bool = True,
+                symbols: Optional[SymbolIndex] = None, column_strategy: str = 'first'):
+    # called once per process (and as the pool initializer in each worker), so that the symbol
+    # index is handed to each worker once rather than with every file
+    global _result_cache, _symbol_index
+    _result_cache = ResultCache(cache_dir, max_bytes) if enabled else None
+    _symbol_index = symbols
+    set_column_strategy(column_strategy)
+
+
+def build_symbol_index(files: List[str], cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                       use_cache: bool = True) -> SymbolIndex:
+    # the classes of the given files; the index kept in the cache directory is brought up to date,
+    # parsing only the files that changed since the last run
+    index = SymbolIndex.load(cache_dir if use_cache else None)
+    index.update(files)
+    if use_cache:
+        index.save(cache_dir)
+    return index.restrict(files)
+
+
+def build_revision_index(files: List[str], revision: str, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                         use_cache: bool = True) -> SymbolIndex:
+    # the classes of the files as they are at a git revision; the files outside the repository
+    # are indexed as they are on disk, and those of the repository that are not in the revision are left out
+    root = repository_root()
+    paths = list(dict.fromkeys(os.path.abspath(file) for file in files))
+    outside = {path for path in paths if os.path.relpath(path, root).startswith(os.pardir)}
+
+    index = build_symbol_index([path for path in paths if path in outside], cache_dir, use_cache)
+    for path, code in read_revisions([path for path in paths if path not in outside], revision, root).items():
+        index.add_source(code, path)
+    return index
+
+
+def analyze_target(target: str, lines: Optional[List[LineRange]] = None, budget: Optional[Budget] = None,
+                   collect_stats: bool = False, witnesses: bool = True,
+                   revision: Optional[str] = None, missing: int = 1) -> Tuple[List[dict], Optional[dict]]:
+    # runs in a worker process, so every worker builds its own z3 context;
+    # records (and stats, if asked for) are handed back to the parent as plain dicts.
+    # With lines, only the matches spanning those lines are analyzed; with revision, the file
+    # is read at that git revision
+    try:
+        code = read_revision(target, revision) if revision is not None else None
+    except GitError as e:
+        return [record_to_dict(FileError(target, str(e)))], None
+
+    def records():
+        return [record_to_dict(record)
+                for record in analyze_file(target, _result_cache, budget, witnesses, _symbol_index, lines, code,
+                                              missing)]
+
+    if not collect_stats:
+        return records(), None
+
+    with Stats() as collector:
+        result = records()
+
+    return result, collector.to_dict()
+
+
+def analyze_files(files: List[str], jobs: int, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                  cache_bytes: int = DEFAULT_MAX_BYTES, use_cache: bool = True, output_format: str = 'text',
+                  budget: Optional[Budget] = None, stats_top: Optional[int] = None,
+                  witnesses: bool = True, project: Optional[List[str]] = None,
+                  changed: Optional[Dict[str, List[LineRange]]] = None,
+                  revision: Optional[str] = None, missing: int = 1,
+                  column_strategy: str = 'first') -> Optional[Stats]:
+    # with stats_top, engine stats are collected in every worker and merged; the merged stats
+    # are printed to stderr (top stats_top slowest matches) and returned.
+    # Class and Enum patterns are resolved against the classes of the files and of project.
+    # With changed (file -> changed line ranges), only the matches on changed lines are analyzed.
+    # A non-exhaustive match reports examples of up to `missing` distinct uncovered regions.
+    # with a revision, the classes are those of that revision as well
+    if revision is not None:
+        symbols = build_revision_index(files + (project or []), revision, cache_dir, use_cache)
+    else:
+        symbols = build_symbol_index(files + (project or []), cache_dir, use_cache)
+    cache_args = (cache_dir, cache_bytes, use_cache, symbols, column_strategy)
+    analyze = partial(analyze_target, budget=budget, collect_stats=stats_top is not None, witnesses=witnesses,
+                      revision=revision, missing=missing)
+    line_ranges = [changed.get(file) if changed is not None else None for file in files]
+    merged = Stats() if stats_top is not None else None
+
+    if jobs <= 1 or len(files) <= 1:
+        init_worker(*cache_args)
+        reports = map(analyze, files, line_ranges)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=cache_args)
+        # map yields in submission order, so the output is deterministic regardless of scheduling
+        reports = executor.map(analyze, files, line_ranges, chunksize=max(1, len(files) // (jobs * 4)))
+
+    try:
+        for target, (report, worker_stats) in zip(files, reports):
+            records = [record_from_dict(data) for data in report]
+
+            if merged is not None:
+                merged.merge(Stats.from_dict(worker_stats))
+
+            if output_format == 'jsonl':
+                for record in records:
+                    print(to_json_line(record))
+                continue
+
+            if len(files) > 1:
+                print(f"=== {target} ===")
+            for line in render_text(records):
+                print(line)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if merged is not None:
+        print(merged.format(stats_top), file=sys.stderr)
+
+    return merged
+
+
+def changed_targets(targets: List[str], diff: Optional[List[str]], diff_stdin: bool) \
+        -> Tuple[List[str], Optional[Dict[str, List[LineRange]]]]:
+    # the files to analyze and, in diff mode, their changed lines: the python files changed
+    # between two revisions (or a revision and the working tree), or in a diff read from stdin,
+    # restricted to the targets when there are any
+    if diff is None and not diff_stdin:
+        return collect_targets(targets), None
+
+    if diff_stdin:
+        # the paths of a git diff are relative to the repository root, wherever it is run from
+        try:
+            root = repository_root()
+        except GitError:
+            root = os.getcwd()
+        changed = {os.path.join(root, path): ranges for path, ranges in parse_unified_diff(sys.stdin)
+                   .items() if path.endswith('.py')}
+    else:
+        changed = changed_lines(*diff)
+
+    files = sorted(path for path, ranges in changed.items() if ranges)
+    if targets:
+        selected = set(os.path.abspath(path) for path in collect_targets(targets))
+        files = [path for path in files if path in selected]
+
+    return files, changed
+
+
+def add_budget_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--z3-timeout', type=int, default=DEFAULT_Z3_TIMEOUT_MS,
+                        help=f'timeout of each z3 query in milliseconds, 0 for none (default: {DEFAULT_Z3_TIMEOUT_MS})')
+    parser.add_argument('--max-steps', type=int, default=DEFAULT_MAX_STEPS,
+                        help=f'step limit of the usefulness search per match, 0 for none (default: {DEFAULT_MAX_STEPS})')
+    parser.add_argument('--match-timeout', type=float, default=DEFAULT_MATCH_SECONDS,
+                        help=f'wall-clock limit per match in seconds, 0 for none (default: {DEFAULT_MATCH_SECONDS:g})')
+    parser.add_argument('--file-timeout', type=float, default=0,
+                        help='wall-clock limit per file in seconds, 0 for none (default: none)')
+
+
+def budget_from_args(args: argparse.Namespace) -> Budget:
+    # matches and cases that do not fit in the budget are reported as unknown
+    return Budget(z3_timeout_ms=args.z3_timeout or None, max_steps=args.max_steps or None,
+                  match_seconds=args.match_timeout or None, file_seconds=args.file_timeout or None)
 
 
 if __name__ == '__main__':
     # run:
-    # python analyze.py -t <target_file>
+    # python analyze.py -t <target_file> [<target_dir> '<glob>' ...] [-j <jobs>] [--format text|jsonl]
+    # python analyze.py --diff <base> [<head>] [-t <targets> ...]    (or: git diff | python analyze.py --diff-stdin)
     parser = argparse.ArgumentParser()
-    parser.add_argument('-t', '--target', required=True)
+    parser.add_argument('-t', '--target', nargs='+', default=[],
+                        help='python files, directories or glob patterns to analyze')
+    parser.add_argument('--diff', nargs='+', metavar='REV',
+                        help='only analyze the match statements changed between two git revisions, or between '
+                             'one revision and the working tree (restricted to the targets, if any)')
+    parser.add_argument('--diff-stdin', action='store_true',
+                        help='only analyze the match statements changed by a unified diff read from stdin')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'directory of the on-disk result cache (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='size bound of the on-disk result cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write cached results')
+    add_budget_arguments(parser)
+    parser.add_argument('--no-witness', action='store_true',
+                        help='only report useless cases and non-exhaustive matches, without examples (never loads z3)')
+    parser.add_argument('--missing', type=int, default=1, metavar='N',
+                        help='report examples of up to N distinct uncovered cases of a non-exhaustive match '
+                             '(default: 1)')
+    parser.add_argument('--column-strategy', choices=list(COLUMN_STRATEGIES), default='first',
+                        help='the order in which the subjects of a match are tested (default: first, '
+                             'the order of the subjects; see benchmark.py --strategies)')
+    parser.add_argument('--stats', type=int, nargs='?', const=DEFAULT_TOP, metavar='N',
+                        help=f'print engine counters, timers and the N slowest matches to stderr (default N: {DEFAULT_TOP})')
+    parser.add_argument('--format', choices=['text', 'jsonl'], default='text',
+                        help='plain-text report, or one json record per line')
+    parser.add_argument('--project', nargs='+', default=[], metavar='PATH',
+                        help='more files, directories or glob patterns whose classes and Enums are indexed '
+                             'for resolving class patterns (the targets always are)')
     args = parser.parse_args()
 
-    target = args.target
-
-    code = "".join(line for line in open(target, 'r').readlines())
+    if not args.target and args.diff is None and not args.diff_stdin:
+        parser.error('a target, --diff or --diff-stdin is required')
+    if args.diff is not None and len(args.diff) > 2:
+        parser.error('--diff takes one or two revisions')
+    if args.missing < 1:
+        parser.error('--missing must be at least 1')
 
-    root = ast.parse(code)
+    try:
+        files, changed = changed_targets(args.target, args.diff, args.diff_stdin)
+    except GitError as e:
+        parser.exit(2, f'error: {e}\n')
 
-    for node in ast.walk(root):
-        if isinstance(node, ast.Match):
-            print(f"Checking pattern matching in line {node.lineno}:")
-            try:
-                pattern_matrix = convert_pattern_matrix(node)
-                subjects = get_subjects(node)
-                line_no_list = get_line_no(node)
+    # with two revisions, the files are analyzed as they are in the second one
+    revision = args.diff[1] if args.diff is not None and len(args.diff) == 2 else None
 
-                check_useless_patterns(pattern_matrix, subjects, line_no_list)
-                check_non_exhaustive_matches(pattern_matrix, subjects)
-                print()
-            except Exception as e:
-                print(f"Error converting match node {node}: {e}")
-                print()
+    analyze_files(files, args.jobs,
+                  cache_dir=args.cache_dir, cache_bytes=args.cache_size * 1024 * 1024, use_cache=not args.no_cache,
+                  output_format=args.format, budget=budget_from_args(args), stats_top=args.stats,
+                  witnesses=not args.no_witness, project=collect_targets(args.project),
+                  changed=changed, revision=revision, missing=args.missing,
+                  column_strategy=args.column_strategy)
@@ -0,0 +1,352 @@
+import argparse
+import ast
+import gc
+import json
+import platform
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from budget import Budget, BudgetExceeded
+from patterns import PatternVector, MatchPattern
+from pattern_converter import convert_pattern_matrix, get_subjects
+from pattern_matching_checker import (
+    usefulness_memo, build_coverage_space, WitnessSession, literal_types, is_useful, COLUMN_STRATEGIES,
+    set_column_strategy
+)
+from decision_tree import DecisionTree
+
+
+PHASES = ('convert', 'usefulness', 'witness')
+
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.25
+# timings below this many seconds are too noisy to be flagged as regressions
+DEFAULT_MIN_SECONDS = 0.005
+
+# a strategy whose decision tree needs more steps than this is reported as n/a
+STRATEGY_TREE_STEPS = 200_000
+
+
+def _match_source(subjects: List[str], cases: List[str]) -> str:
+    lines = [f"match {', '.join(subjects)}:"]
+    for case in cases:
+        lines.append(f"    case {case}:")
+        lines.append("        pass")
+    return '\n'.join(lines) + '\n'
+
+
+def wide_tuple(width: int, rows: int, seed: int = 0) -> str:
+    # many subjects, each column a mix of small int literals and wildcards
+    rng = random.Random(seed)
+    subjects = [f's{i}' for i in range(width)]
+    cases = [', '.join(rng.choice(['_', '_', str(rng.randint(0, 3))]) for _ in range(width)) for _ in range(rows)]
+    return _match_source(subjects, cases + ['_'])
+
+
+def trailing_tuple(width: int, rows: int, seed: int = 0) -> str:
+    # many subjects, tested mostly by the last ones: the first columns are wildcards almost everywhere
+    rng = random.Random(seed)
+    subjects = [f's{i}' for i in range(width)]
+    cases = []
+
+    for _ in range(rows):
+        elements = ['_'] * width
+        elements[-1] = str(rng.randint(0, 30))
+        if rng.random() < 0.5:
+            elements[-2] = str(rng.randint(0, 5))
+        if rng.random() < 0.2:
+            elements[rng.randrange(width - 2)] = str(rng.randint(0, 3))
+        cases.append(', '.join(elements))
+
+    return _match_source(subjects, cases)
+
+
+def deep_or(depth: int, rows: int, seed: int = 0) -> str:
+    # or-patterns nested `depth` levels deep, over two subjects
+    rng = random.Random(seed)
+
+    def nested(level: int) -> str:
+        if level == 0:
+            return str(rng.randint(0, 2 * depth))
+        return f'({rng.randint(0, 2 * depth)} | {nested(level - 1)})'
+
+    cases = [f'{nested(depth)}, {rng.choice(["_", nested(depth // 2)])}' for _ in range(rows)]
+    return _match_source(['x', 'y'], cases)
+
+
+def or_product(width: int, alternatives: int, rows: int = 3) -> str:
+    # every column an or of the same literals, repeated: expanding the ors gives alternatives ** width rows
+    subjects = [f's{i}' for i in range(width)]
+    case = ', '.join(f"({' | '.join(str(i) for i in range(alternatives))})" for _ in range(width))
+    return _match_source(subjects, [case] * rows)
+
+
+def literal_dispatch(size: int, seed: int = 0) -> str:
+    # a dispatch table: one subject, one int or string literal per case
+    rng = random.Random(seed)
+    cases = [str(i) if rng.random() < 0.7 else f"'key_{i}'" for i in range(size)]
+    return _match_source(['command'], cases + ['_'])
+
+
+def nested_sequence(depth: int, rows: int, seed: int = 0) -> str:
+    # sequence patterns nested `depth` levels deep, with literals and wildcards at the leaves
+    rng = random.Random(seed)
+
+    def nested(level: int) -> str:
+        if level == 0:
+            return rng.choice(['_', '0', '1'])
+        return f'[{", ".join(nested(level - 1) for _ in range(rng.randint(1, 2)))}]'
+
+    return _match_source(['x'], [nested(depth) for _ in range(rows)])
+
+
+def star_sequence(rows: int, max_length: int, seed: int = 0) -> str:
+    # a token-list parser: sequences with a star before, after or between literals, mixed with exact
+    # sequences up to max_length elements
+    rng = random.Random(seed)
+
+    def element(i: int) -> str:
+        return rng.choice(['_', f'x{i}', "'op'", "'end'", '0', '1'])
+
+    cases = []
+    for _ in range(rows):
+        elements = [element(i) for i in range(rng.randint(0, 3))]
+        if rng.random() < 0.6:
+            elements.insert(rng.randint(0, len(elements)), '*rest')
+        else:
+            elements += [element(i) for i in range(len(elements), rng.randint(len(elements), max_length))]
+        cases.append(f'[{", ".join(elements)}]')
+
+    return _match_source(['tokens'], cases + ['_'])
+
+
+def bool_none(width: int, rows: int, seed: int = 0) -> str:
+    # columns over True/False and None, whose signatures are complete
+    rng = random.Random(seed)
+    subjects = [f'flag{i}' for i in range(width)]
+    cases = [', '.join(rng.choice(['True', 'False', 'None', '_']) for _ in range(width)) for _ in range(rows)]
+    return _match_source(subjects, cases)
+
+
+Benchmark = Tuple[str, Callable[[], str]]
+
+BENCHMARKS: List[Benchmark] = [
+    ('wide_tuple(8x60)', lambda: wide_tuple(8, 60)),
+    ('wide_tuple(16x120)', lambda: wide_tuple(16, 120)),
+    ('trailing_tuple(10x150)', lambda: trailing_tuple(10, 150)),
+    ('deep_or(6x40)', lambda: deep_or(6, 40)),
+    ('deep_or(12x40)', lambda: deep_or(12, 40)),
+    ('or_product(8x4)', lambda: or_product(8, 4)),
+    ('or_product(16x4)', lambda: or_product(16, 4)),
+    ('literal_dispatch(200)', lambda: literal_dispatch(200)),
+    ('literal_dispatch(600)', lambda: literal_dispatch(600)),
+    ('nested_sequence(3x60)', lambda: nested_sequence(3, 60)),
+    ('nested_sequence(5x60)', lambda: nested_sequence(5, 60)),
+    ('star_sequence(60x8)', lambda: star_sequence(60, 8)),
+    ('star_sequence(200x16)', lambda: star_sequence(200, 16)),
+    ('bool_none(6x80)', lambda: bool_none(6, 80)),
+    ('bool_none(10x200)', lambda: bool_none(10, 200)),
+]
+
+
+def time_phases(source: str) -> Dict[str, Optional[float]]:
+    # convert: parsing and pattern conversion; usefulness: the coverage-space search for every
+    # case and the exhaustiveness (including its constructive witnesses); witness: the z3
+    # search for an example of every case and of a missing value, or None when the patterns
+    # have no z3 encoding (sequences, None)
+    start = time.perf_counter()
+    node = next(node for node in ast.walk(ast.parse(source)) if isinstance(node, ast.Match))
+    matrix = convert_pattern_matrix(node)
+    width = len(get_subjects(node))
+    convert_seconds = time.perf_counter() - start
+
+    usefulness_memo.clear()
+    start = time.perf_counter()
+    space, _ = build_coverage_space(matrix, width)
+    space.is_exhaustive()
+    usefulness_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    session = WitnessSession(width, literal_types(matrix))
+    try:
+        for row in matrix:
+            session.add_row(row, query=True)
+        session.find_test_case(PatternVector([MatchPattern.wildcard()] * width))
+        witness_seconds = time.perf_counter() - start
+    except (ValueError, NotImplementedError):
+        witness_seconds = None
+
+    return {'convert': convert_seconds, 'usefulness': usefulness_seconds, 'witness': witness_seconds}
+
+
+def run_benchmarks(benchmarks: List[Benchmark], repeat: int = DEFAULT_REPEAT) \
+        -> Dict[str, Dict[str, Optional[float]]]:
+    # the best of `repeat` runs, per phase
+    results = dict()
+
+    for name, generate in benchmarks:
+        source = generate()
+        runs = []
+
+        for _ in range(repeat):
+            # as in timeit, collections are kept out of the measurement
+            gc.collect()
+            gc.disable()
+            try:
+                runs.append(time_phases(source))
+            finally:
+                gc.enable()
+
+        results[name] = {phase: None if runs[0][phase] is None else min(run[phase] for run in runs)
+                         for phase in PHASES}
+
+    return results
+
+
+def _convert(source: str):
+    node = next(node for node in ast.walk(ast.parse(source)) if isinstance(node, ast.Match))
+    return convert_pattern_matrix(node), len(get_subjects(node))
+
+
+def time_strategy(source: str, strategy: str) -> Dict[str, Optional[float]]:
+    # coverage: the coverage space that analyze.py uses (--column-strategy), for every case and
+    # the exhaustiveness; usefulness: the same with the recursive search (_urec); tree:
+    # compiling the decision tree, and tree_nodes its size
+    matrix, width = _convert(source)
+    set_column_strategy(strategy)
+    usefulness_memo.clear()
+
+    try:
+        start = time.perf_counter()
+        space, _ = build_coverage_space(matrix, width)
+        space.is_exhaustive()
+        coverage_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i, row in enumerate(matrix):
+            is_useful(matrix[:i], row)
+        is_useful(matrix, PatternVector([MatchPattern.wildcard()] * width))
+        usefulness_seconds = time.perf_counter() - start
+    finally:
+        set_column_strategy('first')
+
+    start = time.perf_counter()
+    try:
+        with Budget(max_steps=STRATEGY_TREE_STEPS).start():
+            tree = DecisionTree.compile(matrix, COLUMN_STRATEGIES[strategy], width)
+        tree_seconds, tree_nodes = time.perf_counter() - start, tree.node_count()
+    except BudgetExceeded:
+        tree_seconds, tree_nodes = None, None
+
+    return {'coverage': coverage_seconds, 'usefulness': usefulness_seconds, 'tree': tree_seconds,
+            'tree_nodes': tree_nodes}
+
+
+def compare_strategies(benchmarks: List[Benchmark], strategies: List[str]) -> str:
+    lines = [f"{'benchmark':<24}{'strategy':<20}{'coverage':>14}{'usefulness':>14}{'tree':>14}{'tree nodes':>12}"]
+
+    for name, generate in benchmarks:
+        source = generate()
+
+        for strategy in strategies:
+            result = time_strategy(source, strategy)
+            tree = f"{result['tree'] * 1000:.2f}ms" if result['tree'] is not None else 'n/a'
+            nodes = result['tree_nodes'] if result['tree_nodes'] is not None else 'n/a'
+            lines.append(f"{name:<24}{strategy:<20}{result['coverage'] * 1000:>12.2f}ms"
+                         f"{result['usefulness'] * 1000:>12.2f}ms{tree:>14}{nodes:>12}")
+
+    return '\n'.join(lines)
+
+
+def find_regressions(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                     threshold: float = DEFAULT_THRESHOLD, min_seconds: float = DEFAULT_MIN_SECONDS) \
+        -> List[Tuple[str, str, float, float]]:
+    # (benchmark, phase, baseline seconds, current seconds) of every phase that got slower by more
+    # than the threshold; benchmarks missing from either side are not compared
+    regressions = []
+
+    for name, phases in results.items():
+        for phase, seconds in phases.items():
+            previous = baseline.get(name, {}).get(phase)
+
+            if previous is None or seconds is None or seconds < min_seconds:
+                continue
+
+            if seconds > previous * (1 + threshold):
+                regressions.append((name, phase, previous, seconds))
+
+    return regressions
+
+
+def save_baseline(path: str, results: Dict[str, Dict[str, float]]):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results},
+                  f, indent=2, sort_keys=True)
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, float]]:
+    with open(path, 'r') as f:
+        return json.load(f)['results']
+
+
+def format_results(results: Dict[str, Dict[str, float]],
+                   baseline: Optional[Dict[str, Dict[str, float]]] = None) -> str:
+    name_width = max([len('benchmark')] + [len(name) for name in results])
+    lines = [f"{'benchmark':<{name_width}}" + ''.join(f"{phase:>22}" for phase in PHASES)]
+
+    for name, phases in results.items():
+        cells = []
+        for phase in PHASES:
+            if phases[phase] is None:
+                cells.append(f"{'n/a':>22}")
+                continue
+            cell = f'{phases[phase] * 1000:.2f}ms'
+            previous = (baseline or {}).get(name, {}).get(phase)
+            if previous:
+                cell += f' ({(phases[phase] / previous - 1) * 100:+.0f}%)'
+            cells.append(f'{cell:>22}')
+        lines.append(f'{name:<{name_width}}' + ''.join(cells))
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # run:
+    # python benchmark.py [-k <filter>] [--repeat <n>] [--save-baseline <file>] [--compare <file>]
+    # python benchmark.py --strategies [-k <filter>]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--filter', default='', help='only run benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'runs per benchmark; the fastest one is reported (default: {DEFAULT_REPEAT})')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a saved baseline and flag regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'relative slowdown flagged as a regression (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--strategies', action='store_true',
+                        help='compare the column strategies on the coverage space, the recursive usefulness '
+                             'search and the decision trees')
+    args = parser.parse_args()
+
+    selected = [benchmark for benchmark in BENCHMARKS if args.filter in benchmark[0]]
+
+    if args.strategies:
+        print(compare_strategies(selected, list(COLUMN_STRATEGIES)))
+        sys.exit(0)
+    results = run_benchmarks(selected, args.repeat)
+    baseline = load_baseline(args.compare) if args.compare else None
+
+    print(format_results(results, baseline))
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.threshold)
+
+        for name, phase, previous, seconds in regressions:
+            print(f"! regression in {name} {phase}: {previous * 1000:.2f}ms -> {seconds * 1000:.2f}ms")
+
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
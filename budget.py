@@ -0,0 +1,103 @@
+import time
+from typing import Optional
+
+
+DEFAULT_Z3_TIMEOUT_MS = 10_000
+DEFAULT_MAX_STEPS = 2_000_000
+DEFAULT_MATCH_SECONDS = 30.0
+
+# the wall clock is read once every this many steps
+_CLOCK_INTERVAL = 256
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+    # Limits for the analysis of one match statement: a timeout for each z3 query, a cap on
+    # the steps of the usefulness search, and a wall-clock limit for the whole match.
+    # file_seconds bounds all matches of a file together (see report.analyze_source).
+    # None means unlimited.
+    def __init__(self, z3_timeout_ms: Optional[int] = DEFAULT_Z3_TIMEOUT_MS,
+                 max_steps: Optional[int] = DEFAULT_MAX_STEPS,
+                 match_seconds: Optional[float] = DEFAULT_MATCH_SECONDS,
+                 file_seconds: Optional[float] = None):
+        self.z3_timeout_ms = z3_timeout_ms
+        self.max_steps = max_steps
+        self.match_seconds = match_seconds
+        self.file_seconds = file_seconds
+
+        self.steps = 0
+        self.deadline: Optional[float] = None
+        self._previous = None
+
+    def start(self, deadline: Optional[float] = None) -> 'Budget':
+        # resets the step count and the clock for a new match; deadline is an outer
+        # time.monotonic() limit, such as the one of the file
+        self.steps = 0
+        self.deadline = deadline
+
+        if self.match_seconds is not None:
+            match_deadline = time.monotonic() + self.match_seconds
+            self.deadline = match_deadline if deadline is None else min(deadline, match_deadline)
+
+        return self
+
+    def file_deadline(self) -> Optional[float]:
+        return time.monotonic() + self.file_seconds if self.file_seconds is not None else None
+
+    def step(self):
+        self.steps += 1
+
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise BudgetExceeded(f"search step limit of {self.max_steps} reached")
+
+        if self.steps % _CLOCK_INTERVAL == 0:
+            self.check_clock()
+
+    def check_clock(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded("time limit reached")
+
+    def solver_timeout_ms(self) -> Optional[int]:
+        # the z3 timeout, shortened to what is left of the wall-clock limit
+        timeout = self.z3_timeout_ms
+
+        if self.deadline is not None:
+            remaining = max(1, int((self.deadline - time.monotonic()) * 1000))
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        return timeout
+
+    def __enter__(self):
+        global _active_budget
+        self._previous, _active_budget = _active_budget, self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active_budget
+        _active_budget, self._previous = self._previous, None
+        return False
+
+    def __getstate__(self):
+        # only the limits travel to worker processes
+        return {'z3_timeout_ms': self.z3_timeout_ms, 'max_steps': self.max_steps,
+                'match_seconds': self.match_seconds, 'file_seconds': self.file_seconds}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+UNLIMITED = Budget(z3_timeout_ms=None, max_steps=None, match_seconds=None)
+
+_active_budget = UNLIMITED
+
+
+def active_budget() -> Budget:
+    return _active_budget
+
+
+def step():
+    # charged by the usefulness search; the budget in effect is set with `with budget.start():`
+    _active_budget.step()
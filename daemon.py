@@ -0,0 +1,326 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+from analyze import add_budget_arguments, budget_from_args, build_symbol_index, collect_targets
+from budget import Budget
+from pattern_matching_checker import COLUMN_STRATEGIES, set_column_strategy
+from report import FileError, MatchStart, analyze_source, is_kept, record_from_dict, record_to_dict, render_text
+from result_cache import ResultCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from symbol_index import SymbolIndex
+from union_var import load_z3
+
+
+JSONRPC_VERSION = '2.0'
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RpcError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+@dataclass
+class FileState:
+    key: str  # the content hash of the analyzed source, with the options
+    records: List[dict]
+    layouts: Dict[str, Optional[list]]  # the classes and Enums its patterns name, as they were resolved
+
+
+class AnalysisDaemon:
+    # Keeps the analyzer warm between requests: z3 is loaded once, the usefulness memo and the
+    # result cache stay in memory, the symbol index of the project is kept up to date, and the
+    # records of every analyzed file are answered again until the content hash of the file, or
+    # the layout of a class its patterns name, changes.
+    # Requests are JSON-RPC 2.0 objects, one per line; see METHODS.
+    METHODS = ('analyze', 'invalidate', 'status', 'shutdown')
+
+    def __init__(self, project: Optional[List[str]] = None, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 cache_bytes: int = DEFAULT_MAX_BYTES, use_cache: bool = True, budget: Optional[Budget] = None,
+                 witnesses: bool = True):
+        self.cache = ResultCache(cache_dir if use_cache else None, cache_bytes)
+        self.budget = budget if budget is not None else Budget()
+        self.witnesses = witnesses
+
+        # the files whose classes are indexed: the project, and every file analyzed so far
+        self.project: Dict[str, None] = dict.fromkeys(os.path.abspath(path) for path in collect_targets(project or []))
+        self.symbols = build_symbol_index(list(self.project), cache_dir, use_cache)
+        self.files: Dict[str, FileState] = dict()
+
+        self.requests = 0
+        self.hits = 0
+        self.stopped = threading.Event()
+        # the analyzer keeps global state (memo, active budget), so requests are served one at a time
+        self._lock = threading.Lock()
+
+        if witnesses:
+            try:
+                # paid once here rather than on the first request that needs a witness
+                load_z3()
+            except ImportError:
+                pass
+
+    def analyze(self, file: str, source: Optional[str] = None, witnesses: Optional[bool] = None,
+                format: str = 'records', missing: int = 1) -> dict:
+        # the records of one file; source is the unsaved content of the file, read from disk when absent.
+        # missing is the number of uncovered examples reported for a non-exhaustive match
+        if not isinstance(file, str):
+            raise RpcError(INVALID_PARAMS, 'file must be a string')
+        if source is not None and not isinstance(source, str):
+            raise RpcError(INVALID_PARAMS, 'source must be a string')
+        if witnesses is not None and not isinstance(witnesses, bool):
+            raise RpcError(INVALID_PARAMS, 'witnesses must be a boolean')
+        if format not in ('records', 'text'):
+            raise RpcError(INVALID_PARAMS, f'unknown format {format!r}')
+        if not isinstance(missing, int) or isinstance(missing, bool) or missing < 1:
+            raise RpcError(INVALID_PARAMS, 'missing must be a positive integer')
+
+        path = os.path.abspath(file)
+        witnesses = self.witnesses if witnesses is None else witnesses
+
+        if source is None:
+            try:
+                with open(path, 'r') as f:
+                    source = f.read()
+            except (OSError, UnicodeDecodeError) as e:
+                self.files.pop(path, None)
+                return self._result(path, [record_to_dict(FileError(file, str(e)))], False, format)
+
+        symbols = self._symbols(path, source)
+        key = _state_key(source, witnesses, missing)
+        state = self.files.get(path)
+
+        if state is not None and state.key == key and symbols.layouts(state.layouts, path) == state.layouts:
+            self.hits += 1
+            return self._result(path, state.records, True, format)
+
+        records = []
+        kept = True
+        names: Set[str] = set()
+
+        for record in analyze_source(source, file, self.cache, self.budget, witnesses, symbols, missing=missing):
+            records.append(record_to_dict(record))
+            kept = kept and is_kept(record, witnesses)
+            if isinstance(record, MatchStart):
+                names.update(record.symbols)
+
+        # results cut short by the budget or missing an example are not kept, so that the next
+        # request tries again
+        if not kept:
+            self.files.pop(path, None)
+        else:
+            self.files[path] = FileState(key, records, symbols.layouts(sorted(names), path))
+
+        return self._result(path, records, False, format)
+
+    def _symbols(self, path: str, source: str) -> SymbolIndex:
+        # the project classes, with those of the analyzed file as given in the request
+        self.project.setdefault(path)
+        self.symbols.update(self.project)
+        return self.symbols.with_source(source, path)
+
+    @staticmethod
+    def _result(path: str, records: List[dict], cached: bool, format: str) -> dict:
+        result = {'file': path, 'cached': cached, 'records': records}
+        if format == 'text':
+            result['text'] = '\n'.join(render_text(record_from_dict(data) for data in records))
+        return result
+
+    def invalidate(self, file: Optional[str] = None) -> dict:
+        # forgets the records of one file, or of all files
+        if file is not None and not isinstance(file, str):
+            raise RpcError(INVALID_PARAMS, 'file must be a string')
+        if file is None:
+            dropped = len(self.files)
+            self.files.clear()
+        else:
+            dropped = 1 if self.files.pop(os.path.abspath(file), None) is not None else 0
+        return {'invalidated': dropped}
+
+    def status(self) -> dict:
+        return {'files': len(self.files), 'requests': self.requests, 'hits': self.hits,
+                'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses,
+                'indexed_files': len(self.symbols.files)}
+
+    def shutdown(self) -> dict:
+        self.stopped.set()
+        return {'stopping': True}
+
+    def handle(self, request) -> Optional[dict]:
+        # the response to one request, or None for a notification (a request without id)
+        if not isinstance(request, dict) or request.get('jsonrpc') != JSONRPC_VERSION or \
+                not isinstance(request.get('method'), str):
+            return _error(None, INVALID_REQUEST, 'invalid request')
+
+        request_id = request.get('id')
+        params = request.get('params', {})
+
+        try:
+            if request['method'] not in self.METHODS:
+                raise RpcError(METHOD_NOT_FOUND, f'method not found: {request["method"]}')
+            if not isinstance(params, dict):
+                raise RpcError(INVALID_PARAMS, 'params must be an object')
+
+            method = getattr(self, request['method'])
+            try:
+                _check_params(method, params)
+            except TypeError as e:
+                raise RpcError(INVALID_PARAMS, str(e))
+
+            with self._lock:
+                self.requests += 1
+                result = method(**params)
+        except RpcError as e:
+            return _error(request_id, e.code, str(e)) if 'id' in request else None
+        except Exception as e:
+            return _error(request_id, INTERNAL_ERROR, f'{type(e).__name__}: {e}') if 'id' in request else None
+
+        if 'id' not in request:
+            return None
+        return {'jsonrpc': JSONRPC_VERSION, 'id': request_id, 'result': result}
+
+    def handle_line(self, line: str) -> Optional[str]:
+        # one line of input (a request or a batch of them) -> one line of output, if any
+        try:
+            message = json.loads(line)
+        except ValueError as e:
+            return json.dumps(_error(None, PARSE_ERROR, f'parse error: {e}'))
+
+        if isinstance(message, list):
+            if not message:
+                return json.dumps(_error(None, INVALID_REQUEST, 'empty batch'))
+            responses = [response for response in map(self.handle, message) if response is not None]
+            return json.dumps(responses) if responses else None
+
+        response = self.handle(message)
+        return json.dumps(response) if response is not None else None
+
+
+def _state_key(source: str, witnesses: bool, missing: int) -> str:
+    digest = hashlib.sha256(source.encode('utf-8', 'surrogatepass'))
+    digest.update(f'\0{witnesses}\0{missing}'.encode())
+    return digest.hexdigest()
+
+
+def _check_params(method, params: dict):
+    # raises TypeError when the params do not fit the method
+    inspect.signature(method).bind(**params)
+
+
+def _error(request_id, code: int, message: str) -> dict:
+    return {'jsonrpc': JSONRPC_VERSION, 'id': request_id, 'error': {'code': code, 'message': message}}
+
+
+def serve_stdio(daemon: AnalysisDaemon, stdin=sys.stdin, stdout=sys.stdout):
+    for line in stdin:
+        if not line.strip():
+            continue
+
+        response = daemon.handle_line(line)
+        if response is not None:
+            stdout.write(response + '\n')
+            stdout.flush()
+
+        if daemon.stopped.is_set():
+            break
+
+
+class _ConnectionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon: AnalysisDaemon = self.server.daemon
+
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace')
+            if not line.strip():
+                continue
+
+            response = daemon.handle_line(line)
+            if response is not None:
+                self.wfile.write(response.encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+            if daemon.stopped.is_set():
+                threading.Thread(target=self.server.shutdown).start()
+                break
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class SocketPathError(Exception):
+    pass
+
+
+def serve_socket(daemon: AnalysisDaemon, path: str):
+    # every connection may send any number of requests; each is answered on the same connection.
+    # A socket left over at path (e.g. by a daemon that was killed) is replaced, anything else is not
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            raise SocketPathError(f'{path} exists and is not a socket')
+        os.remove(path)
+
+    with _UnixServer(path, _ConnectionHandler) as server:
+        server.daemon = daemon
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    # run:
+    # python daemon.py [--socket <path>] [--project <path> ...]
+    # then send one JSON-RPC request per line, e.g.
+    # {"jsonrpc": "2.0", "id": 1, "method": "analyze", "params": {"file": "test.py", "format": "text"}}
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', metavar='PATH',
+                        help='listen on a unix socket at PATH instead of reading requests from stdin')
+    parser.add_argument('--project', nargs='+', default=[], metavar='PATH',
+                        help='files, directories or glob patterns whose classes and Enums are indexed '
+                             'for resolving class patterns (analyzed files always are)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'directory of the on-disk result cache (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='size bound of the on-disk result cache in MB')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not read or write the on-disk cache (results are still kept in memory)')
+    add_budget_arguments(parser)
+    parser.add_argument('--no-witness', action='store_true',
+                        help='by default, only report useless cases and non-exhaustive matches (never loads z3)')
+    parser.add_argument('--column-strategy', choices=list(COLUMN_STRATEGIES), default='first',
+                        help='the order in which the subjects of a match are tested (default: first)')
+    args = parser.parse_args()
+
+    set_column_strategy(args.column_strategy)
+
+    analysis_daemon = AnalysisDaemon(args.project, args.cache_dir, args.cache_size * 1024 * 1024,
+                                     use_cache=not args.no_cache, budget=budget_from_args(args),
+                                     witnesses=not args.no_witness)
+
+    if args.socket is not None:
+        try:
+            serve_socket(analysis_daemon, args.socket)
+        except SocketPathError as e:
+            parser.exit(2, f'error: {e}\n')
+    else:
+        serve_stdio(analysis_daemon)
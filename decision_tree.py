@@ -0,0 +1,351 @@
+import argparse
+import ast
+import itertools
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+from patterns import PatternVector, PatternMatrix, MatchPattern, intern_constructor
+import budget
+from pattern_matching_checker import (
+    specialize_row, default_rows, head_constructors, is_complete_signature, length_classes, ColumnIndex, choose_column,
+    move_column_first, COLUMN_STRATEGIES
+)
+
+
+@dataclass
+class Leaf:
+    # the first case that matches every value reaching this node. A case only reached outside
+    # the type its earlier cases were taken to cover (see is_complete_signature) does not count
+    # as useful, as in the usefulness search
+    row: int
+    counted: bool = True
+
+
+@dataclass
+class Fail:
+    # no case matches the values reaching this node; width is the number of unexamined columns
+    width: int
+
+
+@dataclass
+class Switch:
+    # branch on one column (chosen by the column strategy; the others keep their order and the
+    # sub-columns of the tested value come first below it): one case per constructor of the
+    # column's signature, plus a default branch for every other value when the signature is incomplete
+    cases: List[Tuple[str, int, 'DecisionNode']] = field(default_factory=list)
+    default: Optional['DecisionNode'] = None
+    column: int = 0
+
+    @property
+    def is_complete(self) -> bool:
+        return self.default is None
+
+
+DecisionNode = Union[Leaf, Fail, Switch]
+
+# branching on the column needed by the most leading rows gave the smallest trees on the
+# benchmark inputs (python benchmark.py --strategies); the usefulness search keeps the first column
+DEFAULT_STRATEGY = 'needed'
+
+# (case, row, whether the row still counts for the usefulness of its case)
+IndexedMatrix = List[Tuple[int, PatternVector, bool]]
+
+
+@dataclass
+class TreeAnalysis:
+    useful: List[bool]
+    exhaustive: bool
+    uncovered: List[List[str]]
+
+
+def _covers_everything(row: PatternVector, width: int) -> bool:
+    # rows shorter than the examined width are dropped before the end, so they cannot cover it
+    return len(row) >= width and all(pattern.is_wildcard for pattern in itertools.islice(row, width))
+
+
+def _alternatives(row: PatternVector) -> List[PatternVector]:
+    # a row starting with an or, as a row per alternative (subject tuples spread over the row)
+    if row.is_empty or not row[0].is_or:
+        return [row]
+
+    return [alternative_row for alternative in row[0].args
+            for alternative_row in _alternatives(alternative.extend(row.rest()) if alternative.is_tuple
+                                                 else row.replace_first([alternative]))]
+
+
+def _earlier_signatures(rows: IndexedMatrix) -> Tuple[Dict[str, int], List[Optional[bool]]]:
+    # the first case each constructor of the column appears in, and for the rows starting with a
+    # wildcard, whether the constructors of the cases before theirs are a complete signature
+    first_cases: Dict[str, int] = dict()
+    completeness: List[Optional[bool]] = []
+    earlier, complete, case = set(), None, None
+
+    for i, row, _ in rows:
+        if i != case:
+            added = [constructor for constructor, first_case in first_cases.items()
+                     if first_case == case and constructor not in earlier] if case is not None else []
+            if added:
+                earlier.update(added)
+                complete = None
+            case = i
+
+        first = row[0] if not row.is_empty else None
+        if first is not None and first.is_wildcard:
+            if complete is None:
+                complete = is_complete_signature(earlier)
+            completeness.append(complete)
+        else:
+            completeness.append(None)
+
+        if first is not None:
+            for constructor in head_constructors(first):
+                first_cases.setdefault(constructor, i)
+
+    return first_cases, completeness
+
+
+def _compile(rows: IndexedMatrix, width: int, strategy=None) -> DecisionNode:
+    if not rows:
+        return Fail(width)
+
+    # the alternatives of a case do not shadow one another for the search, so those that count come first
+    rows = sorted(rows, key=lambda row: (row[0], not row[2]))
+    index, first, counted = rows[0]
+
+    if width == 0 or _covers_everything(first, width):
+        return Leaf(index, counted)
+
+    budget.step()
+
+    column = choose_column([row for _, row, _ in rows], PatternVector([MatchPattern.wildcard()] * width), strategy)
+    if column != 0:
+        rows = [(i, move_column_first(row, column), counted) for i, row, counted in rows]
+
+    # the usefulness search takes the alternatives of an or one at a time, each against the
+    # cases before the or: a wildcard counts where it does for the search, that is in the
+    # constructors of the earlier cases when they are a complete signature, and in the others otherwise
+    rows = [(i, alternative, counted) for i, row, counted in rows for alternative in _alternatives(row)]
+    first_cases, completeness = _earlier_signatures(rows)
+
+    def counts(k: int, constructor: Optional[str]) -> bool:
+        if not rows[k][2] or completeness[k] is None:
+            return rows[k][2]
+        elif constructor is None:
+            return not completeness[k]
+        return (first_cases.get(constructor, rows[k][0]) < rows[k][0]) == completeness[k]
+
+    # indexed by first pattern, so that a large literal switch is specialized in linear time
+    index = ColumnIndex([row for _, row, _ in rows])
+    signature = index.signature
+    complete = is_complete_signature(signature.keys())
+    switch = Switch(column=column)
+
+    if not complete:
+        # sequences of the lengths matched by star sequences only get a case of their own
+        heads = [row[0] for _, row, _ in rows if not row.is_empty]
+        signature = {**signature, **length_classes(heads, signature)}
+
+    for constructor, arity in signature.items():
+        constructor_id = intern_constructor(constructor)
+        specialized = [(rows[k][0], specialized_row, counts(k, constructor)) for k in index.row_ids(constructor_id)
+                       for specialized_row in specialize_row(constructor_id, arity, rows[k][1])]
+        switch.cases.append((constructor, arity, _compile(specialized, width - 1 + arity, strategy)))
+
+    if not complete:
+        defaulted = [(i, default, counts(k, None)) for k, (i, row, _) in enumerate(rows) for default in default_rows(row)]
+        switch.default = _compile(defaulted, width - 1, strategy)
+
+    return switch
+
+
+def _constructor_text(constructor: str, args: List[str]) -> str:
+    if constructor.startswith('literal_'):
+        return constructor[len('literal_'):]
+    elif constructor.endswith('_or_more'):
+        # the open length class of a column with star sequences: every length without a case of its own
+        return f'[{", ".join(args)}] (or any other length)'
+    elif constructor.startswith('sequence_'):
+        return f'[{", ".join(args)}]'
+    elif constructor.startswith('class_'):
+        # class_<name>(<attributes>); positional attributes are named #<position>
+        name, _, attributes = constructor[len('class_'):-1].partition('(')
+        elements = sorted(zip(attributes.split(',') if attributes else [], args),
+                          key=lambda element: not element[0].startswith('#'))
+        return f'{name}({", ".join(arg if attribute.startswith("#") else f"{attribute}={arg}" for attribute, arg in elements)})'
+    return f'{constructor}({", ".join(args)})'
+
+
+def _default_text(signature: List[Tuple[str, int]]) -> str:
+    if not signature:
+        return '_'
+    return f'_ not in ({" | ".join(_constructor_text(c, ["_"] * arity) for c, arity in signature)})'
+
+
+class DecisionTree:
+    def __init__(self, root: DecisionNode, row_count: int, width: int):
+        self.root = root
+        self.row_count = row_count
+        self.width = width
+
+    @classmethod
+    def compile(cls, matrix: PatternMatrix, strategy=None, width: Optional[int] = None) -> 'DecisionTree':
+        # strategy: a column strategy of pattern_matching_checker (default: DEFAULT_STRATEGY);
+        # width: the number of subjects, which defaults to the first row (an or of subject tuples is one pattern)
+        strategy = strategy if strategy is not None else COLUMN_STRATEGIES[DEFAULT_STRATEGY]
+        width = width if width is not None else (len(matrix[0]) if matrix else 0)
+        return cls(_compile([(i, row, True) for i, row in enumerate(matrix)], width, strategy), len(matrix), width)
+
+    def node_count(self) -> int:
+        def count(node: DecisionNode) -> int:
+            if isinstance(node, Switch):
+                children = [child for _, _, child in node.cases] + ([node.default] if node.default else [])
+                return 1 + sum(count(child) for child in children)
+            return 1
+
+        return count(self.root)
+
+    def analyze(self) -> TreeAnalysis:
+        # a single traversal: a case is useful iff it is the action of some leaf.
+        # Uncovered regions are the fail nodes reached the way the usefulness search explores
+        # a wildcard vector (every case of a complete switch, only the default of an incomplete
+        # one), so the verdict is the same as check_non_exhaustive_matches.
+        useful = [False] * self.row_count
+
+        def visit(node: DecisionNode, explored: bool) -> List[List[str]]:
+            if isinstance(node, Leaf):
+                useful[node.row] = useful[node.row] or node.counted
+                return []
+
+            if isinstance(node, Fail):
+                return [['_'] * node.width] if explored else []
+
+            witnesses = []
+
+            for constructor, arity, child in node.cases:
+                for witness in visit(child, explored and node.is_complete):
+                    witnesses.append([_constructor_text(constructor, witness[:arity])] + witness[arity:])
+
+            if node.default is not None:
+                missing = _default_text([(constructor, arity) for constructor, arity, _ in node.cases])
+                for witness in visit(node.default, explored):
+                    witnesses.append([missing] + witness)
+
+            # the tested value goes back to its column
+            return [witness[1:node.column + 1] + witness[:1] + witness[node.column + 1:] for witness in witnesses]
+
+        uncovered = visit(self.root, True)
+
+        return TreeAnalysis(useful, not uncovered, uncovered)
+
+    def to_dict(self) -> dict:
+        def encode(node: DecisionNode):
+            if isinstance(node, Leaf):
+                return {'leaf': node.row} if node.counted else {'leaf': node.row, 'counted': False}
+            elif isinstance(node, Fail):
+                return {'fail': node.width}
+            return {'switch': [[constructor, arity, encode(child)] for constructor, arity, child in node.cases],
+                    'default': encode(node.default) if node.default is not None else None,
+                    'column': node.column}
+
+        return {'rows': self.row_count, 'width': self.width, 'root': encode(self.root)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DecisionTree':
+        def decode(node) -> DecisionNode:
+            if 'leaf' in node:
+                return Leaf(node['leaf'], node.get('counted', True))
+            elif 'fail' in node:
+                return Fail(node['fail'])
+            return Switch([(constructor, arity, decode(child)) for constructor, arity, child in node['switch']],
+                          decode(node['default']) if node['default'] is not None else None,
+                          node.get('column', 0))
+
+        return cls(decode(data['root']), data['rows'], data['width'])
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    @classmethod
+    def from_json(cls, text: str) -> 'DecisionTree':
+        return cls.from_dict(json.loads(text))
+
+    def __str__(self):
+        lines = []
+
+        def render(node: DecisionNode, indent: str):
+            if isinstance(node, Leaf):
+                lines.append(f'{indent}-> case {node.row}')
+            elif isinstance(node, Fail):
+                lines.append(f'{indent}-> no match')
+            else:
+                if node.column != 0:
+                    lines.append(f'{indent}(column {node.column})')
+                for constructor, arity, child in node.cases:
+                    lines.append(f'{indent}{_constructor_text(constructor, ["_"] * arity)}:')
+                    render(child, indent + '  ')
+                if node.default is not None:
+                    lines.append(f'{indent}default:')
+                    render(node.default, indent + '  ')
+
+        render(self.root, '')
+        return '\n'.join(lines)
+
+
+def compile_decision_tree(matrix: PatternMatrix, cache=None, subjects: Optional[List[str]] = None,
+                          strategy=None) -> DecisionTree:
+    # cache is an optional result_cache.ResultCache; trees are stored in their json form
+    width = len(subjects) if subjects is not None else None
+    if cache is None:
+        return DecisionTree.compile(matrix, strategy, width)
+
+    from result_cache import match_key
+
+    # the shape of the tree depends on the column strategy
+    strategy = strategy if strategy is not None else COLUMN_STRATEGIES[DEFAULT_STRATEGY]
+    key = match_key(matrix, subjects or [], options=f'decision_tree:{strategy.__name__}')
+    cached = cache.get(key)
+
+    if cached is not None:
+        return DecisionTree.from_dict(cached)
+
+    tree = DecisionTree.compile(matrix, strategy, width)
+    cache.put(key, tree.to_dict())
+    return tree
+
+
+if __name__ == '__main__':
+    # run:
+    # python decision_tree.py -t <target_file> [--json] [--strategy <name>]
+    from pattern_converter import convert_pattern_matrix, get_subjects, get_line_no, match_statements
+    from symbol_index import SymbolIndex
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--target', required=True)
+    parser.add_argument('--json', action='store_true', help='print the serialized trees')
+    parser.add_argument('--strategy', choices=list(COLUMN_STRATEGIES), default=DEFAULT_STRATEGY,
+                        help=f'how the column to branch on is chosen (default: {DEFAULT_STRATEGY})')
+    args = parser.parse_args()
+
+    with open(args.target, 'r') as f:
+        root = ast.parse(f.read())
+
+    symbols = SymbolIndex.for_tree(root, args.target)
+
+    for node in match_statements(root):
+        tree = compile_decision_tree(convert_pattern_matrix(node, symbols, args.target), subjects=get_subjects(node),
+                                     strategy=COLUMN_STRATEGIES[args.strategy])
+
+        if args.json:
+            print(json.dumps({'line': node.lineno, 'subjects': get_subjects(node), 'tree': tree.to_dict()}))
+            continue
+
+        analysis = tree.analyze()
+        line_no_list = get_line_no(node)
+
+        print(f"Decision tree of the match in line {node.lineno}:")
+        print(tree)
+        for line_no, useful in zip(line_no_list, analysis.useful):
+            print(f"{'*' if useful else '!'} L{line_no} pattern is {'useful' if useful else 'useless'}")
+        for witness in analysis.uncovered:
+            print(f"Uncovered: {', '.join(witness)}")
+        print()
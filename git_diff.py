@@ -0,0 +1,119 @@
+import os
+import re
+import subprocess
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+LineRange = Tuple[int, int]  # first and last line, both included
+
+_HUNK_HEADER = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+
+class GitError(Exception):
+    pass
+
+
+def parse_unified_diff(lines: Iterable[str]) -> Dict[str, List[LineRange]]:
+    # the changed lines of every file in a unified diff, as line ranges of the new version of the
+    # file; a hunk that only deletes lines changes the lines around the deletion
+    changed: Dict[str, List[LineRange]] = dict()
+    path = None
+
+    for line in lines:
+        if line.startswith('+++ '):
+            name = line[4:].rstrip('\n').split('\t')[0]
+            if name == '/dev/null':  # a deleted file has nothing left to analyze
+                path = None
+            else:
+                path = name[2:] if name.startswith('b/') else name
+                changed.setdefault(path, [])
+            continue
+
+        match = _HUNK_HEADER.match(line)
+        if match is None or path is None:
+            continue
+
+        start = int(match.group(1))
+        count = int(match.group(2)) if match.group(2) is not None else 1
+
+        if count == 0:
+            changed[path].append((max(start, 1), start + 1))
+        else:
+            changed[path].append((start, start + count - 1))
+
+    return changed
+
+
+def _git(args: List[str], cwd: Optional[str] = None) -> str:
+    try:
+        completed = subprocess.run(['git', *args], cwd=cwd, capture_output=True, text=True)
+    except OSError as e:
+        raise GitError(f'cannot run git: {e}')
+
+    if completed.returncode != 0:
+        raise GitError(completed.stderr.strip() or f'git {" ".join(args)} failed')
+    return completed.stdout
+
+
+def repository_root(cwd: Optional[str] = None) -> str:
+    return _git(['rev-parse', '--show-toplevel'], cwd).strip()
+
+
+def changed_lines(base: str, head: Optional[str] = None, root: Optional[str] = None) -> Dict[str, List[LineRange]]:
+    # the changed lines of the python files between two revisions, or between a revision and the
+    # working tree when head is None; paths are made absolute
+    root = root if root is not None else repository_root()
+    revisions = [base] if head is None else [base, head]
+    diff = _git(['diff', '--unified=0', '--no-color', '--no-ext-diff', '--no-renames', *revisions, '--', '*.py'], root)
+    return {os.path.join(root, path): ranges for path, ranges in parse_unified_diff(diff.splitlines()).items()}
+
+
+def read_revision(path: str, revision: str, root: Optional[str] = None) -> str:
+    # the content of a file at a revision; the file need not exist in the working tree
+    root = root if root is not None else repository_root()
+    return _git(['show', f'{revision}:{os.path.relpath(os.path.abspath(path), root)}'], root)
+
+
+def read_revisions(paths: Iterable[str], revision: str, root: Optional[str] = None) -> Dict[str, str]:
+    # the contents of several files at a revision, read by a single git process; the files that
+    # are not in the revision (or not text) are left out
+    root = root if root is not None else repository_root()
+    paths = list(paths)
+    names = ''.join(f'{revision}:{os.path.relpath(os.path.abspath(path), root)}\n' for path in paths)
+
+    try:
+        completed = subprocess.run(['git', 'cat-file', '--batch'], cwd=root, input=names.encode(), capture_output=True)
+    except OSError as e:
+        raise GitError(f'cannot run git: {e}')
+    if completed.returncode != 0:
+        raise GitError(completed.stderr.decode(errors='replace').strip() or 'git cat-file failed')
+
+    # each object is a header line "<name> <type> <size>", its content and a newline, or "<name> missing"
+    contents = dict()
+    output, position = completed.stdout, 0
+
+    for path in paths:
+        end = output.index(b'\n', position)
+        header = output[position:end].split()
+        position = end + 1
+
+        if len(header) != 3 or not header[2].isdigit():
+            continue
+
+        size = int(header[2])
+        content = output[position:position + size]
+        position += size + 1
+
+        if header[1] != b'blob':
+            continue
+
+        try:
+            contents[path] = content.decode()
+        except UnicodeDecodeError:
+            pass
+
+    return contents
+
+
+def overlaps(first: int, last: int, ranges: List[LineRange]) -> bool:
+    return any(start <= last and first <= end for start, end in ranges)
@@ -1,13 +1,38 @@
 import ast
-from copy import deepcopy
+import re
+from collections import deque
+from typing import Iterator
 from patterns import *
+from symbol_index import SymbolIndex
 from todo_error import TodoError
 
 
 def _extract_literal_value(node: ast.expr):
     if isinstance(node, ast.Constant):
         return node.value
-    return ast.unparse(node)
+
+    try:  # e.g. negative or complex numbers
+        return ast.literal_eval(node)
+    except ValueError:
+        return ValueReference(ast.unparse(node))
+
+
+def _normalize_or(alternatives: List[MatchPattern]) -> MatchPattern:
+    # nested or-patterns are flattened and repeated alternatives dropped (patterns are interned,
+    # so equal alternatives are the same object); an or with a wildcard alternative matches anything
+    flattened = []
+
+    for alternative in alternatives:
+        flattened.extend(alternative.args if alternative.is_or and alternative.var_name is None else [alternative])
+
+    flattened = list(dict.fromkeys(flattened))
+
+    if any(alternative.is_wildcard for alternative in flattened):
+        return MatchPattern.wildcard()
+    elif len(flattened) == 1:
+        return flattened[0]
+
+    return MatchPattern.or_pattern(flattened)
 
 
 def convert_pattern(pattern: ast.pattern) -> MatchPattern:
@@ -16,8 +41,7 @@ def convert_pattern(pattern: ast.pattern) -> MatchPattern:
         return MatchPattern.literal(value)
 
     elif isinstance(pattern, ast.MatchOr):
-        args = [convert_pattern(p) for p in pattern.patterns]
-        return MatchPattern.or_pattern(args)
+        return _normalize_or([convert_pattern(p) for p in pattern.patterns])
 
     elif isinstance(pattern, ast.MatchSingleton):
         # MatchSingleton handles only None, True, or False
@@ -25,7 +49,12 @@ def convert_pattern(pattern: ast.pattern) -> MatchPattern:
         return MatchPattern.literal(value)
 
     elif isinstance(pattern, ast.MatchSequence):
-        elements = [convert_pattern(pattern) for pattern in pattern.patterns]
+        stars = [i for i, element in enumerate(pattern.patterns) if isinstance(element, ast.MatchStar)]
+        elements = [convert_pattern(element) for element in pattern.patterns if not isinstance(element, ast.MatchStar)]
+
+        if stars:
+            # a variable-length sequence: the star matches whatever lies between prefix and suffix
+            return MatchPattern.star_sequence(elements[:stars[0]], elements[stars[0]:])
         return MatchPattern.sequence(elements)
 
     elif isinstance(pattern, ast.MatchAs):
@@ -41,15 +70,9 @@ def convert_pattern(pattern: ast.pattern) -> MatchPattern:
         base_pattern = convert_pattern(pattern.pattern)
         if pattern.name is not None:
             # If there's a variable name, we treat it as a variable binding
-            base_pattern.var_name = pattern.name
+            base_pattern = base_pattern.with_var_name(pattern.name)
         return base_pattern
 
-    elif isinstance(pattern, ast.MatchStar):
-        # MatchStar matches the rest of the sequence in a variable length match sequence pattern
-        # This is syntactically similar to a sequence of wildcards with variable-length
-        # To properly analyze overall matching, we treat it as a wildcard sequence
-        return MatchPattern.wildcard_seq()
-
     elif isinstance(pattern, ast.MatchMapping):
         keys = [_extract_literal_value(key) for key in pattern.keys]
         values = [convert_pattern(value) for value in pattern.patterns]
@@ -68,7 +91,168 @@ def convert_pattern(pattern: ast.pattern) -> MatchPattern:
         raise ValueError(f"Unsupported pattern: {type(pattern)}")
 
 
-def convert_pattern_matrix(match_node: ast.Match) -> PatternMatrix:
+def _subject_tuple_or(pattern: MatchPattern, width: int) -> MatchPattern:
+    # alternatives of an or over several subjects match a tuple of exactly `width` values: they
+    # become subject tuples, with star sequences fixed to that length; the alternatives that
+    # cannot match such a tuple (other lengths, literals, ...) are dropped
+    alternatives = []
+
+    for alternative in pattern.args:
+        if alternative.is_star_sequence:
+            elements = alternative.elements_for_length(width)
+        elif alternative.is_sequence:
+            elements = list(alternative.args) if len(alternative.args) == width else None
+        elif alternative.is_wildcard:
+            elements = [MatchPattern.wildcard()] * width
+        else:
+            elements = None
+
+        if elements is not None:
+            alternatives.append(MatchPattern.subject_tuple(elements))
+
+    if not alternatives:
+        return MatchPattern.empty()
+    return _normalize_or(alternatives).with_var_name(pattern.var_name)
+
+
+def _map_pattern(pattern: MatchPattern, function) -> MatchPattern:
+    # rebuilds a pattern with function applied to each of its subpatterns, innermost first
+    if pattern.is_or:
+        rebuilt = MatchPattern.or_pattern([_map_pattern(arg, function) for arg in pattern.args])
+    elif pattern.is_sequence:
+        rebuilt = MatchPattern.sequence([_map_pattern(arg, function) for arg in pattern.args])
+    elif pattern.is_tuple:
+        rebuilt = MatchPattern.subject_tuple([_map_pattern(arg, function) for arg in pattern.args])
+    elif pattern.is_star_sequence:
+        elements = [_map_pattern(arg, function) for arg in pattern.args]
+        rebuilt = MatchPattern.star_sequence(elements[:pattern.value], elements[pattern.value:])
+    elif pattern.is_map:
+        rebuilt = MatchPattern.map([key for key, _ in pattern.kwarg_items],
+                                   [_map_pattern(value, function) for _, value in pattern.kwarg_items])
+    elif pattern.is_object:
+        rebuilt = MatchPattern.object(pattern.constructor[len('object_'):],
+                                      [_map_pattern(arg, function) for arg in pattern.args],
+                                      {key: _map_pattern(value, function) for key, value in pattern.kwarg_items})
+    else:
+        return function(pattern)
+
+    return function(rebuilt.with_var_name(pattern.var_name))
+
+
+def _subpatterns(pattern: MatchPattern) -> Iterator[MatchPattern]:
+    yield pattern
+    for arg in pattern.args:
+        yield from _subpatterns(arg)
+    for _, value in pattern.kwarg_items or ():
+        yield from _subpatterns(value)
+
+
+def resolve_symbols(matrix: PatternMatrix, symbols: SymbolIndex, file: Optional[str] = None) -> PatternMatrix:
+    # Class patterns become class_pattern nodes with one element per attribute: positional
+    # subpatterns are named through __match_args__ (as `#<position>` when it is unknown), and
+    # every pattern of a class gets the attributes that any pattern of the class, or of one of
+    # its base classes, looks at in this match. Enum members are spelled <Enum>.<member>
+    # whatever the module path they are written with, and all the members of an Enum are
+    # registered as a closed signature.
+    # Every class derives from object, and object() (which matches anything) is a wildcard.
+    attributes: Dict[str, Dict[str, None]] = dict()
+    ancestry: Dict[str, frozenset] = dict()
+    match_args: Dict[str, Optional[List[str]]] = dict()
+    members: Dict[ValueReference, ValueReference] = dict()
+
+    for row in matrix:
+        for pattern in row:
+            for subpattern in _subpatterns(pattern):
+                if subpattern.is_literal and isinstance(subpattern.value, ValueReference) and \
+                        subpattern.value not in members:
+                    member = _resolve_enum_member(subpattern.value, symbols, file)
+                    if member is not None:
+                        members[subpattern.value] = member
+
+                if not subpattern.is_object:
+                    continue
+
+                name = subpattern.constructor[len('object_'):].rsplit('.', 1)[-1]
+                if name not in ancestry:
+                    info = symbols.resolve(name, file)
+                    known = symbols.ancestry(info) if info is not None else {name, *BUILTIN_BASES.get(name, ())}
+                    ancestry[name] = frozenset(known) | {'object'}
+                    match_args[name] = symbols.match_args(info) if info is not None else None
+                    attributes[name] = dict()
+
+                # as Python does when the match runs
+                positional = match_args[name]
+                if positional is not None and len(subpattern.args) > len(positional):
+                    raise TypeError(f'{name}() accepts {len(positional)} positional sub-patterns '
+                                    f'({len(subpattern.args)} given)')
+
+                names = _attribute_names(len(subpattern.args), match_args[name])
+                attributes[name].update(dict.fromkeys(names + [key for key, _ in subpattern.kwarg_items]))
+
+    if not attributes and all(value == member for value, member in members.items()):
+        return matrix
+
+    # the attributes of a class come after those of its base classes
+    layouts = dict()
+    for name in attributes:
+        bases = sorted((base for base in attributes if base != name and base in ancestry[name]),
+                       key=lambda base: len(ancestry[base]))
+        layout = dict()
+        for base in bases + [name]:
+            layout.update(attributes[base])
+        layouts[name] = tuple(layout)
+
+    def resolve(pattern: MatchPattern) -> MatchPattern:
+        if pattern.is_literal and pattern.value in members and isinstance(pattern.value, ValueReference):
+            return MatchPattern.literal(members[pattern.value]).with_var_name(pattern.var_name)
+        elif not pattern.is_object:
+            return pattern
+
+        name = pattern.constructor[len('object_'):].rsplit('.', 1)[-1]
+        if name == 'object' and ancestry[name] == {'object'} and not pattern.args and not pattern.kwarg_items:
+            return MatchPattern.var_binding(pattern.var_name) if pattern.var_name else MatchPattern.wildcard()
+
+        # bool() and bool(x) match exactly True and False, and bool(True) matches True
+        if name == 'bool' and ancestry[name] == {'bool', 'int', 'object'} and not pattern.kwarg_items and \
+                len(pattern.args) <= 1:
+            value = pattern.args[0] if pattern.args else MatchPattern.wildcard()
+            if value.is_wildcard:
+                return _normalize_or([MatchPattern.literal(True), MatchPattern.literal(False)]).with_var_name(
+                    pattern.var_name or value.var_name)
+            elif value.is_literal and isinstance(value.value, bool):
+                return value.with_var_name(pattern.var_name or value.var_name)
+
+        elements = dict(zip(_attribute_names(len(pattern.args), match_args[name]), pattern.args))
+        elements.update(pattern.kwarg_items)
+
+        resolved = MatchPattern.class_pattern(
+            name, layouts[name], [elements.get(attribute, MatchPattern.wildcard()) for attribute in layouts[name]],
+            ancestry[name])
+        return resolved.with_var_name(pattern.var_name)
+
+    return [PatternVector([_map_pattern(pattern, resolve) for pattern in row], row.guard) for row in matrix]
+
+
+def _attribute_names(positional: int, match_args: Optional[List[str]]) -> List[str]:
+    return [match_args[i] if match_args is not None and i < len(match_args) else f'#{i}' for i in range(positional)]
+
+
+def _resolve_enum_member(value: ValueReference, symbols: SymbolIndex, file: Optional[str]) -> Optional[ValueReference]:
+    # the canonical spelling of a value pattern naming an Enum member, or None for other values
+    owner, _, member = value.rpartition('.')
+    info = symbols.resolve(owner, file) if owner else None
+    members = symbols.enum_members(info) if info is not None else None
+
+    if not members or member not in members:
+        return None
+
+    register_closed_signature(ValueReference(f'{info.name}.{name}') for name in members)
+    return ValueReference(f'{info.name}.{member}')
+
+
+def convert_pattern_matrix(match_node: ast.Match, symbols: Optional[SymbolIndex] = None,
+                           file: Optional[str] = None) -> PatternMatrix:
+    # symbols resolves class and value patterns; without it, classes are matched by name only
     subject_node = match_node.subject
 
     if isinstance(subject_node, ast.Tuple) or isinstance(subject_node, ast.List):
@@ -85,11 +269,19 @@ def convert_pattern_matrix(match_node: ast.Match) -> PatternMatrix:
         guard = match_case.guard
 
         if width > 1:
-            if pattern_vector.is_sequence:
+            if pattern_vector.is_or:
+                pattern_vector = _subject_tuple_or(pattern_vector, width)
+
+            if pattern_vector.is_tuple:
+                row = list(pattern_vector.args)
+            elif pattern_vector.is_sequence:
                 if len(pattern_vector.args) != width:  # useless clause
                     row = [MatchPattern.empty()] * width
                 else:
-                    row = pattern_vector.args
+                    row = list(pattern_vector.args)
+            elif pattern_vector.is_star_sequence:
+                elements = pattern_vector.elements_for_length(width)
+                row = elements if elements is not None else [MatchPattern.empty()] * width
             elif pattern_vector.is_wildcard:
                 row = [MatchPattern.wildcard()] * width
             elif pattern_vector.is_or:
@@ -99,22 +291,37 @@ def convert_pattern_matrix(match_node: ast.Match) -> PatternMatrix:
         else:  # width == 1
             row = [pattern_vector]
 
-        pattern_matrix.append(PatternVector(row, deepcopy(guard)))
+        pattern_matrix.append(PatternVector(row, guard))  # the guard is shared with the AST, not copied
 
-    return pattern_matrix
+    return resolve_symbols(pattern_matrix, symbols if symbols is not None else SymbolIndex(), file)
 
 
 def get_subjects(match_node: ast.Match):
     subject_node = match_node.subject
 
+    # a subject that is not a name (`match ...:`, `match self.state:`) is shown as its source
     if isinstance(subject_node, ast.Tuple) or isinstance(subject_node, ast.List):
-        subjects = [elt.id for elt in subject_node.elts]
+        subjects = [elt.id if isinstance(elt, ast.Name) else ast.unparse(elt) for elt in subject_node.elts]
     else:  # only a single subject
-        subjects = [subject_node.id]
+        subjects = [subject_node.id if isinstance(subject_node, ast.Name) else ast.unparse(subject_node)]
 
     return subjects
 
 
+def get_symbol_names(match_node: ast.Match) -> List[str]:
+    # the classes and Enums the patterns name, by their last component as the symbol index resolves them
+    names = set()
+
+    for match_case in match_node.cases:
+        for node in ast.walk(match_case.pattern):
+            if isinstance(node, ast.MatchClass):
+                names.add(ast.unparse(node.cls).rsplit('.', 1)[-1])
+            elif isinstance(node, ast.MatchValue) and isinstance(node.value, ast.Attribute):
+                names.add(ast.unparse(node.value.value).rsplit('.', 1)[-1])
+
+    return sorted(names)
+
+
 def get_line_no(match_node: ast.Match):
     line_no_list = []
 
@@ -122,3 +329,32 @@ def get_line_no(match_node: ast.Match):
         line_no_list.append(match_case.pattern.lineno)
 
     return line_no_list
+
+
+# a match statement starts a logical line with the soft keyword `match`, followed by the subject:
+# lines where `match` is followed by what cannot start an expression (`match = ...`, `match.group()`,
+# `match: int`, ...) are names, not statements; a `.` only starts a subject as `...` or a number
+# (`match .5:`). A backslash may continue the line before the keyword
+_MATCH_STATEMENT_START = re.compile(
+    r'^[ \t\f]*(?:\\\r?\n[ \t\f]*)*match\b(?![ \t\f]*(?:[=,:;)\]}<>/%&|^@!#\r\n]|\.(?![.\d])|\*\*|[-+*]=|$))',
+    re.MULTILINE)
+
+
+def may_contain_match(code: str) -> bool:
+    # a scan of the source that rejects most files without a match statement before they are
+    # parsed; a match in a string or a comment is a false positive, which only costs the parse
+    return _MATCH_STATEMENT_START.search(code) is not None
+
+
+def match_statements(root: ast.AST) -> Iterator[ast.Match]:
+    # the match statements in the order of ast.walk, visiting only the nodes that hold statements
+    # (match statements never appear inside expressions)
+    pending = deque([root])
+
+    while pending:
+        node = pending.popleft()
+        if isinstance(node, ast.Match):
+            yield node
+
+        pending.extend(child for child in ast.iter_child_nodes(node)
+                       if isinstance(child, (ast.stmt, ast.match_case, ast.excepthandler)))
@@ -1,9 +1,62 @@
 from patterns import *
-from typing import Set, Dict
-import z3
-from union_var import TYPE_INT, TYPE_BOOL, TYPE_STRING, UnionVar
+import functools
+import heapq
+import itertools
+from typing import Set, Dict, Iterable, Iterator, Tuple
+import budget
+import stats
+from union_var import ALL_TYPES, UnionVar, load_z3, value_type
 
 
+DEFAULT_MEMO_ENTRIES = 1 << 16
+
+
+class UsefulnessMemo:
+    # Bounded table of already solved (matrix, vector) sub-problems.
+    # Patterns are hash-consed and the column cells of pattern vectors hash once and compare
+    # pattern by pattern identity, so the first column cell of each row is a cheap structural key.
+    def __init__(self, max_entries: int = DEFAULT_MEMO_ENTRIES):
+        self.max_entries = max_entries
+        self.table: Dict[tuple, bool] = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[bool]:
+        result = self.table.get(key)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return result
+
+    def put(self, key: tuple, result: bool):
+        if len(self.table) >= self.max_entries:
+            # evict the oldest entry; dicts keep insertion order
+            del self.table[next(iter(self.table))]
+
+        self.table[key] = result
+
+    def clear(self):
+        self.table.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+
+usefulness_memo = UsefulnessMemo()
+
+
+def _memo_key(matrix: PatternMatrix, pattern_vector: PatternVector) -> tuple:
+    # guards are not part of the key: the usefulness search does not look at them
+    return tuple([row.columns for row in matrix]), pattern_vector.columns
+
+
+@stats.recursion('urec')
 def _urec(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
     if not pattern_vector:
         if len(matrix) != 0:
@@ -11,7 +64,201 @@ def _urec(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
         else:
             return True
 
-    return _urec_inductive(matrix, pattern_vector)
+    budget.step()
+
+    key = _memo_key(matrix, pattern_vector)
+    result = usefulness_memo.get(key)
+
+    if result is None:
+        matrix, pattern_vector = arrange_columns(matrix, pattern_vector)
+        result = _urec_inductive(matrix, pattern_vector)
+        usefulness_memo.put(key, result)
+
+    return result
+
+
+# Column selection. Usefulness does not depend on the order of the columns, so the search may
+# branch on any column: a strategy picks one, and it is moved to the front of the matrix and
+# the vector. A strategy is any callable (matrix, pattern_vector) -> column index.
+
+def first_column(matrix: PatternMatrix, pattern_vector: PatternVector) -> int:
+    return 0
+
+
+def _column_constructors(matrix: PatternMatrix, pattern_vector: PatternVector) -> List[Dict[str, int]]:
+    # the constructors of every column, in one pass over each row: indexing a vector walks its columns
+    columns = [extract_constructor_and_arity(pattern) for pattern in pattern_vector]
+    for row in matrix:
+        for constructors, pattern in zip(columns, row):
+            constructors.update(extract_constructor_and_arity(pattern))
+    return columns
+
+
+def needed_column(matrix: PatternMatrix, pattern_vector: PatternVector) -> int:
+    # the column needed by the longest run of leading rows (non-wildcard patterns from the first row on)
+    runs = [0] * len(pattern_vector)
+    running = [True] * len(pattern_vector)
+
+    for row in matrix:
+        if not any(running):
+            break
+        for column, pattern in enumerate(row):
+            if running[column]:
+                if pattern.is_wildcard:
+                    running[column] = False
+                else:
+                    runs[column] += 1
+
+    return runs.index(max(runs)) if runs else 0
+
+
+def small_branching(matrix: PatternMatrix, pattern_vector: PatternVector) -> int:
+    # the column with the fewest branches (its constructors, plus the default of an incomplete
+    # signature), among the columns that have any constructor
+    best, best_branches = 0, None
+
+    for column, constructors in enumerate(_column_constructors(matrix, pattern_vector)):
+        if not constructors:
+            continue
+
+        branches = len(constructors) + (0 if is_complete_signature(constructors.keys()) else 1)
+        if best_branches is None or branches < best_branches:
+            best, best_branches = column, branches
+
+    return best
+
+
+def most_constructors(matrix: PatternMatrix, pattern_vector: PatternVector) -> int:
+    # the column that tells the most rows apart
+    best, best_count = 0, 0
+
+    for column, constructors in enumerate(_column_constructors(matrix, pattern_vector)):
+        count = len(constructors)
+        if count > best_count:
+            best, best_count = column, count
+
+    return best
+
+
+COLUMN_STRATEGIES = {
+    'first': first_column,
+    'needed': needed_column,
+    'small_branching': small_branching,
+    'most_constructors': most_constructors,
+}
+
+column_strategy = first_column
+
+
+def set_column_strategy(strategy):
+    # a name from COLUMN_STRATEGIES, or a callable
+    global column_strategy
+    column_strategy = COLUMN_STRATEGIES[strategy] if isinstance(strategy, str) else strategy
+
+
+_CLOSED_LITERALS = {'literal_True', 'literal_False', 'literal_None'}
+
+
+def _has_closed_literal(pattern: MatchPattern) -> bool:
+    return _has_closed_constructor(pattern, closed_signature_version())
+
+
+@functools.lru_cache(maxsize=DEFAULT_MEMO_ENTRIES)
+def _has_closed_constructor(pattern: MatchPattern, version: int) -> bool:
+    # True/False, None and Enum members complete a signature by themselves (see
+    # is_complete_signature), so whether they do depends on which rows share the column, and
+    # with it on the column order. version keeps the cache in step with the registered Enums.
+    if pattern.is_literal:
+        return pattern.constructor in _CLOSED_LITERALS or closed_signature(pattern.constructor) is not None
+    return any(_has_closed_constructor(arg, version) for arg in pattern.args)
+
+
+def _can_rearrange(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
+    # columns can only be moved when every row has one pattern per column (an or of subject
+    # tuples is spread over its row, see MatchPattern.extend), and when the
+    # verdict does not depend on the order. The rows left in a column depend on the order, so a
+    # column reads the same in every order when no part of its constructors is complete without
+    # the rest; below the first patterns, no True/False/None or Enum pattern may appear.
+    width = len(pattern_vector)
+    columns = [dict() for _ in range(width)]
+
+    for row in [pattern_vector] + matrix:
+        if len(row) != width:
+            return False
+        for column, pattern in enumerate(row):
+            if pattern.is_or and any(alternative.is_tuple for alternative in pattern.args):
+                return False
+            if any(_has_closed_literal(arg) for head in (pattern.args if pattern.is_or else [pattern])
+                   for arg in head.args):
+                return False
+            columns[column].update(extract_constructor_and_arity(pattern))
+
+    return not any(_has_complete_part(constructors.keys()) for constructors in columns)
+
+
+def _has_complete_part(constructors: Iterable[str]) -> bool:
+    # whether some of the constructors, but not all of them, form a complete signature
+    constructors = set(constructors)
+
+    if {'literal_True', 'literal_False'} < constructors or 'literal_None' in constructors and len(constructors) > 1:
+        return True
+
+    for constructor in constructors:
+        closed = closed_signature(constructor)
+        if closed is not None and closed < constructors:
+            return True
+
+    return False
+
+
+def move_column_first(pattern_vector: PatternVector, column: int) -> PatternVector:
+    # only the columns up to the moved one are rebuilt; the ones after it are shared
+    columns = pattern_vector.columns
+    leading = []
+    for _ in range(column):
+        leading.append(columns.head)
+        columns = columns.tail
+
+    leading.insert(0, columns.head)
+    return PatternVector._of(columns.tail, pattern_vector.guard).prepend(leading)
+
+
+def choose_column(matrix: PatternMatrix, pattern_vector: PatternVector, strategy=None) -> int:
+    strategy = strategy if strategy is not None else column_strategy
+
+    if strategy is first_column or len(pattern_vector) < 2 or not _can_rearrange(matrix, pattern_vector):
+        return 0
+
+    return strategy(matrix, pattern_vector)
+
+
+def column_order(matrix: PatternMatrix, width: int, strategy=None) -> Optional[Tuple[int, ...]]:
+    # the order in which a coverage space tests the subjects: the column the strategy picks,
+    # then its pick among the other columns, and so on; None keeps the order of the subjects
+    strategy = strategy if strategy is not None else column_strategy
+    if strategy is first_column or width < 2 or \
+            not _can_rearrange(matrix, PatternVector([MatchPattern.wildcard()] * width)):
+        return None
+
+    remaining = list(range(width))
+    order = []
+
+    while len(remaining) > 1:
+        column = strategy(matrix, PatternVector([MatchPattern.wildcard()] * len(remaining)))
+        order.append(remaining.pop(column))
+        matrix = [PatternVector(row.patterns[:column] + row.patterns[column + 1:], row.guard) for row in matrix]
+
+    order.extend(remaining)
+    return tuple(order) if order != sorted(order) else None
+
+
+def arrange_columns(matrix: PatternMatrix, pattern_vector: PatternVector) -> Tuple[PatternMatrix, PatternVector]:
+    column = choose_column(matrix, pattern_vector)
+
+    if column == 0:
+        return matrix, pattern_vector
+
+    return [move_column_first(row, column) for row in matrix], move_column_first(pattern_vector, column)
 
 
 def _urec_inductive(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
@@ -23,6 +270,8 @@ def _urec_inductive(matrix: PatternMatrix, pattern_vector: PatternVector) -> boo
         return _handle_wildcard(matrix, pattern_vector)
     elif first_pattern.is_or:
         return _handle_or(matrix, pattern_vector)
+    elif first_pattern.is_star_sequence:
+        return _handle_star_sequence(matrix, pattern_vector)
     else:  # non-handled case; temporarily return False
         return False
 
@@ -55,7 +304,7 @@ def collect_constructor_and_arity_from_first_column(matrix: PatternMatrix) -> Di
 
         first = row[0]
 
-        constructors.update(extract_constructor_and_arity(first))
+        constructors.update(head_constructors(first))
 
     return constructors
 
@@ -64,7 +313,7 @@ def extract_constructor_and_arity(pattern: MatchPattern) -> Dict[str, int]:
     if pattern.is_literal:
         return {pattern.constructor: 0}
 
-    elif pattern.is_sequence:
+    elif pattern.is_sequence or pattern.is_class:
         return {pattern.constructor: len(pattern.args)}
 
     elif pattern.is_wildcard:
@@ -79,10 +328,28 @@ def extract_constructor_and_arity(pattern: MatchPattern) -> Dict[str, int]:
     return dict()
 
 
+def head_constructors(pattern: MatchPattern) -> Dict[str, int]:
+    # the constructors of the first pattern of a row in its column: the subject tuples of an or
+    # are spread over the columns (see _specialize_first), so only their first element is in this column
+    if not pattern.is_or:
+        return extract_constructor_and_arity(pattern)
+
+    constructors = dict()
+    for alternative in pattern.args:
+        if alternative.is_tuple:
+            if alternative.args:
+                constructors.update(head_constructors(alternative.args[0]))
+        else:
+            constructors.update(head_constructors(alternative))
+    return constructors
+
+
 def _handle_complete_signature(
         matrix: PatternMatrix, pattern_vector: PatternVector, constructor_arity_dict: Dict[str, int]) -> bool:
+    index = ColumnIndex(matrix)
+
     for constructor, arity in constructor_arity_dict.items():
-        specialized_matrix = specialize_matrix(constructor, arity, matrix)
+        specialized_matrix = index.specialize(intern_constructor(constructor), arity)
         specialized_vector = specialize_pattern_vector(constructor, arity, pattern_vector)
 
         if _urec(specialized_matrix, specialized_vector):
@@ -95,17 +362,33 @@ def _handle_incomplete_signature(
         matrix: PatternMatrix, pattern_vector: PatternVector, constructor_arity_dict: Dict[str, int]) -> bool:
     default_mat = default_matrix(matrix)
 
-    guard = pattern_vector.guard
-    rest_vec = PatternVector(pattern_vector[1:], guard)
+    return _urec(default_mat, pattern_vector.rest())
+
+
+def _handle_star_sequence(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
+    # a star sequence is useful if it is useful for one of the length classes of the column
+    first = pattern_vector[0]
+    column = [row[0] for row in matrix if not row.is_empty] + [first]
+    classes = length_classes(column, collect_constructor_and_arity_from_first_column(matrix))
+
+    for constructor, arity in classes.items():
+        if arity < len(first.args):
+            continue
+
+        specialized_matrix = specialize_matrix(constructor, arity, matrix)
+        specialized_vector = specialize_pattern_vector(constructor, arity, pattern_vector)
+
+        if _urec(specialized_matrix, specialized_vector):
+            return True
 
-    return _urec(default_mat, rest_vec)
+    return False
 
 
 def _handle_or(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
-    for alternative in pattern_vector[0].args:
-        guard = pattern_vector.guard
+    rest = pattern_vector.rest()
 
-        new_pattern_vector = PatternVector(alternative.extend(pattern_vector[1:]), guard)
+    for alternative in pattern_vector[0].args:
+        new_pattern_vector = alternative.extend(rest)
 
         if _urec(matrix, new_pattern_vector):
             return True
@@ -113,96 +396,246 @@ def _handle_or(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
     return False
 
 
+def default_rows(row: PatternVector) -> PatternMatrix:
+    # the rows of the default matrix that a row gives: its rest when it starts with a wildcard,
+    # and for an or, those of its alternatives (subject tuples spread over the row)
+    if row.is_empty:
+        return []
+
+    first = row[0]
+
+    if first.is_wildcard:
+        stats.count('default_rows')
+        return [row.rest()]
+    elif first.is_or:
+        default_rows_by_columns = dict()
+        for alternative in first.args:
+            alternative_row = alternative.extend(row.rest()) if alternative.is_tuple else row.replace_first([alternative])
+            for default in default_rows(alternative_row):
+                default_rows_by_columns.setdefault(default.columns, default)
+        return list(default_rows_by_columns.values())
+
+    return []
+
+
 def default_matrix(matrix: PatternMatrix) -> PatternMatrix:
     result = []
 
     for row in matrix:
-        if row.is_empty:
-            continue
+        result.extend(default_rows(row))
 
-        first = row[0]
-        rest = row[1:]
-        guard = row.guard
+    return result
 
-        if first.is_wildcard:
-            result.append(PatternVector(rest, guard))
-        elif first.is_or:
-            for alternative in first.args:
-                if alternative.is_wildcard:
-                    result.append(PatternVector(rest, guard))
-                    break
 
-    return result
+def specialize_row(constructor_id: int, arity: int, row: PatternVector) -> PatternMatrix:
+    if row.is_empty:
+        return []
 
+    return _specialize_first(constructor_id, arity, row[0], row)
 
-def specialize_matrix(constructor: str, arity: int, matrix: PatternMatrix) -> PatternMatrix:
-    def get_specialized_rows(row: PatternVector) -> PatternMatrix:
-        if row.is_empty:
-            return []
 
-        first = row[0]
-        rest = row[1:]
-        guard = row.guard
+def _specialize_first(constructor_id: int, arity: int, first: MatchPattern, row: PatternVector) -> PatternMatrix:
+    # specializes the row made of `first` and the columns of `row` after its first one, so the
+    # alternatives of an or-pattern are specialized without building a row for each
+    if first.constructor_id == constructor_id:
+        stats.count('specialized_rows')
+        return [row.replace_first(first.args)]
 
-        if first.constructor == constructor:
-            if first.args:
-                specialized_row = first.args + rest
-            else:
-                specialized_row = rest
-            return [PatternVector(specialized_row, guard)]
+    elif first.is_wildcard:
+        stats.count('specialized_rows')
+        return [row.replace_first([MatchPattern.wildcard()] * arity)]
+
+    elif first.is_class and class_layout(constructor_id) is None and specializes_into(first.constructor_id, constructor_id):
+        # a builtin class pattern by a literal of its type: its positional subpattern matches the
+        # literal itself. Rows that also test attributes are left out, as the literals are not modeled
+        elements = dict(zip(first.value[1], first.args))
+        if any(not element.is_wildcard for attribute, element in elements.items() if attribute != '#0'):
+            return []
+        return _specialize_first(constructor_id, arity, elements.get('#0', MatchPattern.wildcard()), row)
+
+    elif first.is_class and specializes_into(first.constructor_id, constructor_id):
+        # a pattern of a base class matches the instances of the subclass as well
+        _, attributes, _ = class_layout(constructor_id)
+        elements = dict(zip(first.value[1], first.args))
+        stats.count('specialized_rows')
+        return [row.replace_first([elements.get(attribute, MatchPattern.wildcard()) for attribute in attributes])]
+
+    elif first.is_star_sequence:
+        # a star sequence specializes into every length class it covers, with wildcards for the star
+        elements = first.elements_for_length(arity) if sequence_class(constructor_id) is not None else None
+        if elements is None:
+            return []
+        stats.count('specialized_rows')
+        return [row.replace_first(elements)]
 
-        elif first.is_wildcard:
-            specialized_row = [MatchPattern.wildcard()] * arity + rest
-            return [PatternVector(specialized_row, guard)]
+    elif first.is_or:
+        # alternatives that specialize to the same row (e.g. `1 | _` by 1) give that row once
+        specialized_rows = dict()
 
-        elif first.is_or:
-            specialized_rows = []
+        for alternative in first.args:
+            if alternative.is_tuple:  # spread over the columns
+                alternative_rows = specialize_row(constructor_id, arity, alternative.extend(row.rest()))
+            else:
+                alternative_rows = _specialize_first(constructor_id, arity, alternative, row)
 
-            for alternative in first.args:
-                temp_row = PatternVector(alternative.extend(rest), guard)
-                specialized_rows.extend(get_specialized_rows(temp_row))
+            for specialized in alternative_rows:
+                specialized_rows.setdefault(specialized.columns, specialized)
 
-            return specialized_rows
+        return list(specialized_rows.values())
 
-        else:  # non-handled case: temporarily return empty rows
-            return []
+    else:  # non-handled case: temporarily return empty rows
+        return []
 
 
+def specialize_matrix(constructor: str, arity: int, matrix: PatternMatrix) -> PatternMatrix:
+    constructor_id = intern_constructor(constructor)
     result = []
 
     for row in matrix:
-        specialized_rows = get_specialized_rows(row)
+        specialized_rows = specialize_row(constructor_id, arity, row)
         result.extend(specialized_rows)
 
     return result
 
 
+class ColumnIndex:
+    # The rows of a matrix by their first pattern: constructor id -> row ids, with the wildcard,
+    # or and star sequence rows (which can specialize into several constructors) kept apart. Specializing through
+    # the index only visits the rows that can produce a specialized row, so specializing by
+    # every constructor of a column is linear in the rows rather than rows x constructors.
+    def __init__(self, matrix: PatternMatrix):
+        self.matrix = matrix
+        self.headed: Dict[int, List[int]] = dict()
+        self.generic: List[int] = []
+        self.signature: Dict[str, int] = dict()
+        self.class_heads: List[int] = []  # the constructors of the class patterns among the headed rows
+
+        for i, row in enumerate(matrix):
+            if row.is_empty:
+                continue
+
+            first = row[0]
+            self.signature.update(head_constructors(first))
+
+            if first.is_constructed:
+                if first.is_class and first.constructor_id not in self.headed:
+                    self.class_heads.append(first.constructor_id)
+                self.headed.setdefault(first.constructor_id, []).append(i)
+            elif first.is_wildcard or first.is_or or first.is_star_sequence:
+                self.generic.append(i)
+
+    def row_ids(self, constructor_id: int) -> Iterator[int]:
+        # in matrix order, since the first matching row decides usefulness
+        headed = self.headed.get(constructor_id, [])
+        if self.class_heads:
+            headed = merge_headed(headed, [self.headed[head] for head in self.class_heads
+                                           if head != constructor_id and specializes_into(head, constructor_id)])
+        return merge_row_ids(headed, self.generic)
+
+    def specialize(self, constructor_id: int, arity: int) -> PatternMatrix:
+        result = []
+
+        for i in self.row_ids(constructor_id):
+            result.extend(specialize_row(constructor_id, arity, self.matrix[i]))
+
+        return result
+
+
+def specializes_into(pattern_constructor_id: int, constructor_id: int) -> bool:
+    # whether a class pattern matches the instances of the class of constructor_id: it is that
+    # class, or one of its base classes; or whether a builtin class pattern matches a literal
+    if pattern_constructor_id == constructor_id:
+        return True
+
+    pattern_layout = class_layout(pattern_constructor_id)
+    if pattern_layout is None:
+        return False
+
+    layout = class_layout(constructor_id)
+    if layout is not None:
+        return pattern_layout[0] in layout[2]
+
+    builtin = builtin_class(pattern_constructor_id)
+    if builtin is None or not constructor_name(constructor_id).startswith('literal_'):
+        return False
+
+    value = literal_value(constructor_id)
+    return not isinstance(value, ValueReference) and isinstance(value, builtin)
+
+
+def merge_headed(headed: list, more: List[list]) -> list:
+    # the rows headed by a class together with those headed by its base classes, in order
+    more = [rows for rows in more if rows]
+    return list(heapq.merge(headed, *more)) if more else headed
+
+
+def merge_row_ids(headed: list, generic: list) -> Iterator:
+    # two sorted id lists (or lists of (id, ...) tuples) merged in order
+    if not generic:
+        return iter(headed)
+    elif not headed:
+        return iter(generic)
+    return heapq.merge(headed, generic)
+
+
 def specialize_pattern_vector(constructor: str, arity: int, pattern_vector: PatternVector) -> PatternVector:
     if pattern_vector.is_empty:
         return PatternVector([])
 
     first = pattern_vector[0]
-    rest = pattern_vector[1:]
-    guard = pattern_vector.guard
 
-    if first.constructor == constructor:
-        if first.args:
-            patterns = first.args + rest
-        else:
-            patterns = rest
-        return PatternVector(patterns, guard)
+    if first.constructor_id == intern_constructor(constructor):
+        return pattern_vector.replace_first(first.args)
 
     elif first.is_wildcard:
-        wildcards = [MatchPattern.wildcard()] * arity
-        return PatternVector(wildcards + rest, guard)
+        return pattern_vector.replace_first([MatchPattern.wildcard()] * arity)
+
+    elif first.is_star_sequence and sequence_class(intern_constructor(constructor)) is not None:
+        elements = first.elements_for_length(arity)
+        return pattern_vector.replace_first(elements) if elements is not None else PatternVector([])
 
     else:
         return PatternVector([])
 
 
+def star_bounds(pattern: MatchPattern) -> Optional[Tuple[int, int]]:
+    # the longest prefix and suffix around the star of the star sequences in a pattern's head
+    if pattern.is_star_sequence:
+        return pattern.value, len(pattern.args) - pattern.value
+    elif pattern.is_or:
+        bounds = [bound for bound in map(star_bounds, pattern.args) if bound is not None]
+        if bounds:
+            return max(prefix for prefix, _ in bounds), max(suffix for _, suffix in bounds)
+    elif pattern.is_tuple and pattern.args:
+        return star_bounds(pattern.args[0])
+    return None
+
+
+def length_classes(column: Iterable[MatchPattern], constructors: Dict[str, int]) -> Dict[str, int]:
+    # The lengths a column with star sequences is split into (constructor -> arity), instead of
+    # every concrete length. Below prefix + suffix (the longest prefix and suffix around the
+    # stars), the elements of different rows line up differently for each length, so each length
+    # is a class of its own. From there on, only the exact sequence lengths of the column (in
+    # constructors) are told apart: every other length is matched by the same rows as the open
+    # class of N or more elements, N being past the longest exact sequence.
+    bounds = [bound for bound in map(star_bounds, column) if bound is not None]
+    if not bounds:
+        return dict()
+
+    shortest = max(prefix for prefix, _ in bounds) + max(suffix for _, suffix in bounds)
+    exact = [arity for constructor, arity in constructors.items()
+             if sequence_class(intern_constructor(constructor)) is False]
+    open_length = max([shortest] + [length + 1 for length in exact])
+
+    classes = {sequence_constructor(length): length for length in sorted(set(range(shortest)).union(exact))}
+    classes[sequence_constructor(open_length, open_ended=True)] = open_length
+    return classes
+
+
 def is_complete_signature(constructors: Set[str]) -> bool:
-    # Now, only consider boolean patterns as complete
-    # This can be extended to Enum or other types in the future
+    # Booleans, None and the members of an Enum are complete when all of them are present.
+    # Class patterns never are: the subject may be of any class, so covering a class, even
+    # the base class of all the others, leaves the other classes out.
 
     bool_set = {"literal_True", "literal_False"}
     none_set = {"literal_None"}
@@ -211,93 +644,751 @@ def is_complete_signature(constructors: Set[str]) -> bool:
         return True
     elif constructors == none_set:
         return True
-    return False
+
+    constructors = set(constructors)
+    if not constructors:
+        return False
+
+    closed = closed_signature(next(iter(constructors)))
+    return closed is not None and constructors == closed
 
 
 def is_useful(matrix: PatternMatrix, pattern_vector: PatternVector) -> bool:
     return _urec(matrix, pattern_vector)
 
 
+class _SpaceNode:
+    # One node stands for one specialization path of the usefulness search: its rows are
+    # exactly the (specialized/default) matrix that _urec would rebuild for that path.
+    # Children are materialized on first use and then kept up to date as rows are added.
+    __slots__ = ('count', 'constructors', 'star_heads', 'headed_rows', 'class_heads', 'generic_rows', 'children',
+                 'default')
+
+    def __init__(self):
+        self.count = 0
+        self.constructors: Dict[str, int] = dict()
+        self.star_heads: List[MatchPattern] = []  # the distinct first patterns with star sequences
+
+        # rows are bucketed by their first pattern, so that a child only looks at the rows
+        # that can specialize into it: rows headed by that constructor, and wildcard/or rows
+        self.headed_rows: Dict[int, List[Tuple[int, PatternVector]]] = dict()
+        self.class_heads: List[int] = []  # the constructors of the class patterns among the headed rows
+        self.generic_rows: List[Tuple[int, PatternVector]] = []
+
+        self.children: Dict[int, Tuple[int, '_SpaceNode']] = dict()
+        self.default: Optional['_SpaceNode'] = None
+
+    def add(self, row: PatternVector):
+        budget.step()
+
+        seq = self.count
+        self.count += 1
+
+        if row.is_empty:
+            return
+
+        first = row[0]
+        self.constructors.update(head_constructors(first))
+
+        if (first.is_star_sequence or first.is_or) and first not in self.star_heads and \
+                star_bounds(first) is not None:
+            self.star_heads.append(first)
+
+        if first.is_constructed:
+            if first.is_class and first.constructor_id not in self.headed_rows:
+                self.class_heads.append(first.constructor_id)
+            self.headed_rows.setdefault(first.constructor_id, []).append((seq, row))
+
+            child = self.children.get(first.constructor_id)
+            if child is not None:
+                arity, node = child
+                for specialized in specialize_row(first.constructor_id, arity, row):
+                    node.add(specialized)
+
+            if first.is_class:  # the children of the subclasses (and, for a builtin class, of its literals)
+                for constructor_id, (arity, node) in self.children.items():
+                    if constructor_id != first.constructor_id and specializes_into(first.constructor_id, constructor_id):
+                        for specialized in specialize_row(constructor_id, arity, row):
+                            node.add(specialized)
+
+        elif first.is_wildcard or first.is_or or first.is_star_sequence:
+            self.generic_rows.append((seq, row))
+
+            for constructor_id, (arity, node) in self.children.items():
+                for specialized in specialize_row(constructor_id, arity, row):
+                    node.add(specialized)
+
+            if self.default is not None:
+                for default in default_rows(row):
+                    self.default.add(default)
+
+        # any other first pattern is not handled by the search: it only counts as a row
+
+    def child(self, constructor_id: int, arity: int) -> '_SpaceNode':
+        child = self.children.get(constructor_id)
+        if child is not None:
+            return child[1]
+
+        node = _SpaceNode()
+
+        # replay the rows that can specialize into this constructor, in their original order
+        headed = self.headed_rows.get(constructor_id, [])
+        if self.class_heads:
+            headed = merge_headed(headed, [self.headed_rows[head] for head in self.class_heads
+                                           if head != constructor_id and specializes_into(head, constructor_id)])
+
+        for _, row in merge_row_ids(headed, self.generic_rows):
+            for specialized in specialize_row(constructor_id, arity, row):
+                node.add(specialized)
+
+        self.children[constructor_id] = (arity, node)
+        return node
+
+    def specialization_key(self, constructor_id: int) -> tuple:
+        # identifies the rows of child(constructor_id) for a constructor without arguments: two
+        # such constructors with the same key have children with the same rows, so a query
+        # answers the same way for both
+        if constructor_id in self.headed_rows:
+            return 'headed', constructor_id
+
+        return tuple((seq, tuple(specialized.columns for specialized in specialize_row(constructor_id, 0, row)))
+                     for seq, row in self.generic_rows)
+
+    def default_child(self) -> '_SpaceNode':
+        if self.default is None:
+            node = _SpaceNode()
+
+            for _, row in self.generic_rows:
+                for default in default_rows(row):
+                    node.add(default)
+
+            self.default = node
+
+        return self.default
+
+    def is_useful(self, pattern_vector: PatternVector) -> bool:
+        return self.witness(pattern_vector) is not None
+
+    @stats.recursion('space_search')
+    def witness(self, pattern_vector: PatternVector) -> Optional[list]:
+        # same case analysis as _urec, walking the materialized nodes instead of specializing
+        # the matrix again; a useful vector comes back with one example value per column
+        budget.step()
+
+        if not pattern_vector:
+            return [] if self.count == 0 else None
+
+        first = pattern_vector[0]
+
+        if first.is_constructed:
+            arity = len(first.args) if first.args else 0
+            node = self.child(first.constructor_id, arity)
+            witness = node.witness(specialize_pattern_vector(first.constructor, arity, pattern_vector))
+            return _construct_witness(first.constructor_id, arity, witness, (self.constructors, node.constructors))
+
+        elif first.is_wildcard:
+            if is_complete_signature(self.constructors.keys()):
+                for constructor, arity in list(self.constructors.items()):
+                    constructor_id = intern_constructor(constructor)
+                    node = self.child(constructor_id, arity)
+                    witness = node.witness(specialize_pattern_vector(constructor, arity, pattern_vector))
+                    if witness is not None:
+                        return _construct_witness(constructor_id, arity, witness,
+                                                  (self.constructors, node.constructors))
+                return None
+            else:
+                witness = self.default_child().witness(pattern_vector.rest())
+                if witness is None:
+                    return None
+                return [missing_value(self.constructors)] + witness
+
+        elif first.is_or:
+            # literal alternatives that the rows here do not tell apart are queried once, so
+            # ors in several columns do not multiply into one child per combination
+            tried = set()
+
+            for alternative in first.args:
+                if alternative.is_literal:
+                    key = self.specialization_key(alternative.constructor_id)
+                    if key in tried:
+                        continue
+                    tried.add(key)
+
+                new_pattern_vector = alternative.extend(pattern_vector.rest())
+                witness = self.witness(new_pattern_vector)
+                if witness is not None:
+                    return witness
+            return None
+
+        elif first.is_star_sequence:
+            classes = self.length_classes([first])
+
+            for constructor, arity in classes.items():
+                if arity < len(first.args):
+                    continue
+                constructor_id = intern_constructor(constructor)
+                node = self.child(constructor_id, arity)
+                witness = node.witness(specialize_pattern_vector(constructor, arity, pattern_vector))
+                if witness is not None:
+                    return _construct_witness(constructor_id, arity, witness)
+            return None
+
+        else:  # non-handled case, as in _urec
+            return None
+
+    def length_classes(self, heads: List[MatchPattern]) -> Dict[str, int]:
+        # the length classes of the star sequences of the rows here and of the given heads
+        classes = length_classes(self.star_heads + heads, self.constructors)
+
+        # an open class left over from before longer rows were added no longer stands for its lengths
+        for constructor_id in [constructor_id for constructor_id in self.children
+                               if sequence_class(constructor_id) and constructor_name(constructor_id) not in classes]:
+            del self.children[constructor_id]
+
+        return classes
+
+    def missing_witnesses(self, width: int, limit: int) -> List[list]:
+        # examples of up to `limit` distinct uncovered regions of `width` columns: the values
+        # outside an incomplete signature of the first column first, then the uncovered values
+        # of each of its constructors. The regions do not overlap, so neither do the examples.
+        if limit <= 0 or self.witness(PatternVector([MatchPattern.wildcard()] * width)) is None:
+            return []
+        if width == 0:
+            return [[]]
+
+        found = []
+
+        if not is_complete_signature(self.constructors.keys()):
+            value = missing_value(self.constructors)
+            found.extend([value] + witness for witness in self.default_child().missing_witnesses(width - 1, limit))
+
+        # the lengths of the star sequences here are told apart as well
+        signature = dict(self.constructors)
+        if self.star_heads:
+            for constructor, arity in self.length_classes([]).items():
+                signature.setdefault(constructor, arity)
+
+        for constructor, arity in signature.items():
+            if len(found) >= limit:
+                break
+
+            constructor_id = intern_constructor(constructor)
+            node = self.child(constructor_id, arity)
+            found.extend(_construct_witness(constructor_id, arity, witness, (self.constructors, node.constructors))
+                         for witness in node.missing_witnesses(arity + width - 1, limit - len(found)))
+
+        return found[:limit]
+
+
+def missing_value(constructors: Dict[str, int]):
+    # a value outside an incomplete signature: a missing Enum member, or else the smallest natural
+    # number not used as a literal. Where a builtin class pattern such as int() matches every
+    # number, None, or else an instance of a class of its own that no pattern names
+    for constructor in constructors:
+        missing = (closed_signature(constructor) or frozenset()) - set(constructors)
+        if missing:
+            return literal_value(intern_constructor(min(missing)))
+
+    builtins = {builtin_class(intern_constructor(constructor)) for constructor in constructors}
+
+    if int not in builtins:
+        value = 0
+        while f'literal_{value}' in constructors:
+            value += 1
+        return value
+    elif 'literal_None' not in constructors:
+        return None
+    return ClassInstance('object', (), [])
+
+
+def _construct_witness(constructor_id: int, arity: int, witness: Optional[list],
+                       literals: Tuple[Dict[str, int], ...] = ()) -> Optional[list]:
+    # literals are the signatures of the column and of the first column of the child, which the
+    # value of a builtin class pattern must stay out of
+    if witness is None:
+        return None
+
+    if constructor_name(constructor_id).startswith('literal_'):
+        value = literal_value(constructor_id)
+    elif builtin_class(constructor_id) is not None:
+        name, attributes, _ = class_layout(constructor_id)
+        hint = witness[attributes.index('#0')] if '#0' in attributes[:arity] else None
+        value = builtin_value(builtin_class(constructor_id), hint, literals)
+        if value is None:
+            value = ValueReference(f'{name}(...)')
+    elif class_layout(constructor_id) is not None:
+        name, attributes, _ = class_layout(constructor_id)
+        value = ClassInstance(name, attributes, witness[:arity])
+    else:  # a sequence class of <arity> elements
+        value = witness[:arity]
+
+    return [value] + witness[arity:]
+
+
+def builtin_value(builtin: type, hint, literals: Iterable[Dict[str, int]]):
+    # a value of a builtin class equal to none of the literals: the hint (the example of the
+    # positional subpattern, which is the value itself) when it is one, or else the first one of
+    # False, True / 0, 1, ... / '', 'a', ...; None when every bool is taken
+    taken = [literal_value(intern_constructor(constructor)) for signature in literals for constructor in signature
+             if constructor.startswith('literal_')]
+    taken = [value for value in taken if not isinstance(value, ValueReference)]
+
+    candidates = itertools.chain([hint] if hint is not None else [],
+                                 [False, True] if builtin is bool else
+                                 (builtin('a' * i) if builtin is str else b'a' * i if builtin is bytes else builtin(i)
+                                  for i in itertools.count()))
+
+    for value in candidates:
+        if isinstance(value, builtin) and not isinstance(value, ValueReference) and \
+                not any(value == other for other in taken):  # `case 0:` matches 0.0 as well
+            return value
+    return None
+
+
+class ClassInstance:
+    # an example instance of a class pattern, with a value for each attribute the patterns look at
+    def __init__(self, name: str, attributes: Tuple[str, ...], values: list):
+        self.name = name
+        self.attributes = attributes
+        self.values = values
+
+
+def format_value(value) -> str:
+    # z3 values print as they did before; python values follow z3's notation for strings
+    if isinstance(value, ValueReference):
+        return str(value)
+    elif isinstance(value, ClassInstance):
+        # positional attributes (whose names are unknown) are shown by position, before the others
+        elements = sorted(zip(value.attributes, value.values), key=lambda element: not element[0].startswith('#'))
+        arguments = [format_value(element) if attribute.startswith('#') else f'{attribute}={format_value(element)}'
+                     for attribute, element in elements]
+        return f'{value.name}({", ".join(arguments)})'
+    elif isinstance(value, str):
+        return f'"{value}"'
+    elif isinstance(value, list):
+        return f'[{", ".join(format_value(element) for element in value)}]'
+    return str(value)
+
+
+def format_test_case(test_case: Optional[list]) -> Optional[List[str]]:
+    return [format_value(value) for value in test_case] if test_case is not None else None
+
+
+class CoverageSpace:
+    # Incremental usefulness: rows are added one by one, and each query is answered
+    # against the rows added so far, without re-checking every prefix from scratch.
+    # With an order (see column_order), the subjects are tested in that order: rows and
+    # queries are rearranged on the way in, and examples put back in subject order.
+    def __init__(self, width: int = 0, order: Optional[Tuple[int, ...]] = None):
+        self.width = width
+        self.order = order
+        self.root = _SpaceNode()
+
+    @classmethod
+    def for_matrix(cls, matrix: PatternMatrix, width: Optional[int] = None) -> 'CoverageSpace':
+        # the subjects are tested in the order the column strategy picks for the whole matrix
+        width = width if width is not None else (len(matrix[0]) if matrix else 0)
+        return cls(width, column_order(matrix, width))
+
+    def __len__(self):
+        return self.root.count
+
+    def _arranged(self, row: PatternVector) -> PatternVector:
+        if self.order is None:
+            return row
+        patterns = row.patterns
+        return PatternVector([patterns[column] for column in self.order], row.guard)
+
+    def _restored(self, witness: Optional[list]) -> Optional[list]:
+        if self.order is None or witness is None:
+            return witness
+        restored = list(witness)
+        for position, column in enumerate(self.order):
+            restored[column] = witness[position]
+        return restored
+
+    def is_useful(self, pattern_vector: PatternVector) -> bool:
+        return self.root.is_useful(self._arranged(pattern_vector))
+
+    def add(self, row: PatternVector) -> bool:
+        # returns whether the row was useful with respect to the rows added before it
+        return self.check(row) is not None
+
+    def check(self, row: PatternVector) -> Optional[list]:
+        # adds the row, and returns an example value it matches that the previous rows do not
+        row = self._arranged(row)
+        witness = self.root.witness(row)
+        self.root.add(row)
+        return self._restored(witness)
+
+    def missing_witness(self) -> Optional[list]:
+        return self._restored(self.root.witness(PatternVector([MatchPattern.wildcard()] * self.width)))
+
+    def missing_witnesses(self, limit: int) -> List[list]:
+        # examples of up to `limit` distinct uncovered regions (see _SpaceNode.missing_witnesses)
+        return [self._restored(witness) for witness in self.root.missing_witnesses(self.width, limit)]
+
+    def is_exhaustive(self) -> bool:
+        return self.missing_witness() is None
+
+
+def build_coverage_space(matrix: PatternMatrix, width: Optional[int] = None) -> Tuple[CoverageSpace, List[bool]]:
+    space = CoverageSpace.for_matrix(matrix, width)
+    usefulness = [space.add(row) for row in matrix]
+    return space, usefulness
+
+
 def condition_expr_from_pattern_vector(pattern_vector: PatternVector, union_vars: List[UnionVar]):
+    z3 = load_z3()
+
     if pattern_vector.is_empty:
         return False
 
     conditions = []
 
-    for i in range(len(pattern_vector)):
-        pattern = pattern_vector[i]
-
+    for i, pattern in enumerate(pattern_vector):
         condition = pattern.convert_to_condition(union_vars[i], union_vars=union_vars)  # union_vars[i] is the relevant UnionVar
         conditions.append(condition)
 
     return z3.And(*conditions)
 
 
-def find_test_case(pattern_matrix: PatternMatrix, pattern_vector: PatternVector, arity):
-    union_vars = [UnionVar(f'var_{i}') for i in range(arity)]
+def literal_types(matrix: PatternMatrix) -> Tuple[int, ...]:
+    # the union types the literals of the matrix need; values of any other type can only be
+    # matched by wildcards, so one of the needed types (or int, if there are none) is enough
+    types = set()
+
+    def visit(pattern: MatchPattern):
+        if pattern.is_literal:
+            type_tag = value_type(pattern.value) if not isinstance(pattern.value, ValueReference) else None
+            types.update(ALL_TYPES if type_tag is None else (type_tag,))
 
-    solver = z3.Solver()
+        for arg in pattern.args:
+            visit(arg)
+        for _, value in pattern.kwarg_items or ():
+            visit(value)
 
-    for var in union_vars:
-        solver.add(var.default_constraints())
+    for row in matrix:
+        for pattern in row:
+            visit(pattern)
+
+    return tuple(sorted(types)) if types else ALL_TYPES[:1]
+
+
+class WitnessSession:
+    # One solver per match statement. The assertions for row i extend those for row i-1 by the
+    # negation of row i-1, so rows are asserted once and each query is a push/check/pop on top.
+    # Each row's condition is translated once, and z3 is not touched until the first query.
+    # Subjects are encoded with the given union types only; a query that has no solution
+    # there is retried once with the full int/bool/string union.
+    # A row z3 cannot encode (star sequences, class patterns, named constants, ...) cannot be
+    # excluded either, so from that row on, the queries have no test case (an unknown example).
+    def __init__(self, width: int, types: Tuple[int, ...] = ALL_TYPES):
+        self.width = width
+        self.types = types
+        self.row_count = 0
+
+        self._solver = None
+        self._union_vars = None
+        self._rows: List[PatternVector] = []
+        self._opaque = False
+
+    def _start(self):
+        z3 = load_z3()
+
+        if self._solver is None:
+            self._union_vars = [UnionVar(f'var_{i}', self.types) for i in range(self.width)]
+            self._solver = z3.Solver()
+
+            for var in self._union_vars:
+                self._solver.add(var.default_constraints())
+
+    def _widen(self):
+        # switch to the full union encoding; the rows added so far are translated again
+        z3 = load_z3()
+
+        self.types = ALL_TYPES
+        self._solver = None
+        self._start()
+
+        for row in self._rows:
+            condition = self._condition(row)
+            if condition is not None:
+                self._solver.add(z3.Not(condition))
+
+    @property
+    def solver(self) -> 'z3.Solver':
+        self._start()
+        return self._solver
+
+    def _condition(self, pattern_vector: PatternVector):
+        # None when the vector has no z3 encoding
+        self._start()
+        try:
+            return condition_expr_from_pattern_vector(pattern_vector, self._union_vars)
+        except (NotImplementedError, ValueError):
+            stats.count('opaque_rows')
+            return None
+
+    def add_row(self, row: PatternVector, query: bool = False) -> Optional[list]:
+        # asserts that later queries are not matched by this row; with query=True, first looks
+        # for a test case matched by this row and none of the rows added before it
+        z3 = load_z3()
+
+        condition = self._condition(row)
+        test_case = None
+
+        if query:
+            test_case, condition = self._solve(row, condition)
+
+        if condition is None:
+            self._opaque = True
+        else:
+            self.solver.add(z3.Not(condition))
+        self._rows.append(row)
+        self.row_count += 1
+
+        return test_case
+
+    def add_rows(self, matrix: PatternMatrix, end: int):
+        # catch up with the rows [row_count, end) of the matrix
+        for row in matrix[self.row_count:end]:
+            self.add_row(row)
+
+    def find_test_case(self, pattern_vector: PatternVector) -> Optional[list]:
+        test_case, _ = self._solve(pattern_vector, self._condition(pattern_vector))
+        return test_case
+
+    def find_test_cases(self, pattern_vector: PatternVector, limit: int) -> List[list]:
+        # up to `limit` test cases of the vector from one incremental query: after each one, the
+        # region it lies in (in every column, the literal of the rows it is equal to, or none of
+        # them) is blocked, so that the next one lies in another region
+        z3 = load_z3()
+
+        test_case, condition = self._solve(pattern_vector, self._condition(pattern_vector))
+        if test_case is None or condition is None or limit <= 1:
+            return [test_case] if test_case is not None else []
+
+        literals = column_literals(self._rows + [pattern_vector], self.width)
+        found = [test_case]
+        solver = self.solver
+        solver.push()
+
+        try:
+            solver.add(condition)
+            solver.add(z3.Not(self._region(test_case, literals)))
+
+            while len(found) < limit:
+                with stats.timer('z3_check'):
+                    result = solver.check()
+                if result != z3.sat:
+                    break
 
-    for i in range(len(pattern_matrix)):
-        row = pattern_matrix[i]
+                test_case = [var.value_from_model(solver.model()) for var in self._union_vars]
+                found.append(test_case)
+                solver.add(z3.Not(self._region(test_case, literals)))
+        finally:
+            solver.pop()
 
-        solver.add(z3.Not(condition_expr_from_pattern_vector(row, union_vars)))
+        return found
 
-    solver.add(condition_expr_from_pattern_vector(pattern_vector, union_vars))
+    def _region(self, test_case: list, literals: List[list]):
+        z3 = load_z3()
 
-    if solver.check() == z3.sat:
-        model = solver.model()
+        constraints = []
+        for var, value, column in zip(self._union_vars, test_case, literals):
+            value = python_value(value)
+            equal = [literal for literal in column if type(literal) is type(value) and literal == value]
 
-        test_case = []
-        for var in union_vars:
-            if model[var.get_type_var()] == TYPE_INT:
-                test_case.append(model[var.get_int_var()])
-            elif model[var.get_type_var()] == TYPE_BOOL:
-                test_case.append(model[var.get_bool_var()])
-            elif model[var.get_type_var()] == TYPE_STRING:
-                test_case.append(model[var.get_string_var()])
+            if equal:
+                constraints.append(var == equal[0])
             else:
-                raise ValueError("Unknown type variable in model")
+                constraints.extend(var != literal for literal in column if value_type(literal) in var.types)
 
-        return test_case
+        return z3.And(*constraints) if constraints else z3.BoolVal(True)
 
-    else:
-        print("No test case found that satisfies the pattern vector.")
-        return None
+    def _solve(self, pattern_vector: PatternVector, condition) -> Tuple[Optional[list], object]:
+        # returns the test case, and the condition in the encoding that is current afterwards
+        # a query that times out has no test case; running out of the match's time is an error
+        z3 = load_z3()
+
+        if condition is None or self._opaque:
+            return None, condition
+
+        solver = self.solver
+        timeout = budget.active_budget().solver_timeout_ms()
+        solver.set('timeout', timeout if timeout is not None else 0)
+        solver.push()
+
+        try:
+            solver.add(condition)
+            with stats.timer('z3_check'):
+                result = solver.check()
+
+            if result == z3.sat:
+                model = solver.model()
+                return [var.value_from_model(model) for var in self._union_vars], condition
+        finally:
+            solver.pop()
 
+        if result == z3.unknown:
+            budget.active_budget().check_clock()
+            return None, condition
 
-def check_useless_patterns(matrix: PatternMatrix, subjects: List[str], line_no_list: List[int]):
-    arity = len(matrix[0]) if matrix else 0
+        if self.types != ALL_TYPES:
+            self._widen()
+            return self._solve(pattern_vector, self._condition(pattern_vector))
+
+        return None, condition
+
+
+def column_literals(rows: Iterable[PatternVector], width: int) -> List[list]:
+    # the literal values each subject is compared with, in the z3 encoding of the rows (where
+    # the elements of a subject tuple stand for the subjects)
+    columns = [dict() for _ in range(width)]
+
+    def visit(pattern: MatchPattern, column: int):
+        if pattern.is_literal and not isinstance(pattern.value, ValueReference) and column < width:
+            columns[column][(type(pattern.value), pattern.value)] = pattern.value
+        elif pattern.is_or:
+            for alternative in pattern.args:
+                visit(alternative, column)
+        elif pattern.is_tuple:
+            for i, element in enumerate(pattern.args):
+                visit(element, i)
+
+    for row in rows:
+        for i, pattern in enumerate(row):
+            visit(pattern, i)
+
+    return [list(column.values()) for column in columns]
+
+
+def python_value(value):
+    # the python value of a z3 value from a model
+    z3 = load_z3()
+
+    if z3.is_int_value(value):
+        return value.as_long()
+    elif z3.is_true(value) or z3.is_false(value):
+        return z3.is_true(value)
+    elif z3.is_string_value(value):
+        return value.as_string()
+    return value
+
+
+def find_test_case(pattern_matrix: PatternMatrix, pattern_vector: PatternVector, arity):
+    session = WitnessSession(arity, literal_types(pattern_matrix + [pattern_vector]))
+    session.add_rows(pattern_matrix, len(pattern_matrix))
+    return session.find_test_case(pattern_vector)
+
+
+def useless_pattern_results(matrix: PatternMatrix, space: Optional[CoverageSpace] = None,
+                            width: Optional[int] = None,
+                            session: Optional[WitnessSession] = None,
+                            witnesses: bool = True) -> Iterator[Tuple[bool, Optional[list]]]:
+    # rows are added to the coverage space as they are checked; pass the same space (and
+    # session) to non_exhaustive_result afterwards to answer exhaustiveness from them as well.
+    # The witness comes from the usefulness search itself; z3 is only asked when the search
+    # cannot line its example up with the subjects (width, which defaults to the first row).
+    # With witnesses=False, only the usefulness is reported, and z3 is never used.
+    width = width if width is not None else (len(matrix[0]) if matrix else 0)
+    space = space if space is not None else CoverageSpace.for_matrix(matrix, width)
+    session = session if session is not None else WitnessSession(width, literal_types(matrix))
 
     for i in range(len(matrix)):
-        partial_matrix = matrix[:i]
         current_row = matrix[i]
-
-        if not is_useful(partial_matrix, current_row):
-            print(f"! L{line_no_list[i]} pattern is useless. (It does not match any cases)")
+        witness = space.check(current_row)
+
+        if witness is None:
+            yield False, None
+        elif not witnesses:
+            yield True, None
+        elif len(witness) == width:
+            yield True, witness
         else:
-            print(f"* L{line_no_list[i]} pattern is useful")
+            session.add_rows(matrix, i)
+            yield True, session.add_row(current_row, query=True)
+
 
-            test_case = find_test_case(partial_matrix, current_row, arity)
-            for j, subject in enumerate(subjects):
-                print(f" {subject}: {test_case[j] if test_case else 'N/A'}", end=" ")
-            print()
+def non_exhaustive_result(matrix: PatternMatrix, space: Optional[CoverageSpace] = None,
+                          width: Optional[int] = None,
+                          session: Optional[WitnessSession] = None,
+                          witnesses: bool = True) -> Tuple[bool, Optional[list]]:
+    exhaustive, missing = missing_results(matrix, space, width, session, witnesses)
+    return exhaustive, missing[0] if missing else None
 
 
-def check_non_exhaustive_matches(matrix: PatternMatrix, subjects: List[str]):
-    arity = len(matrix[0]) if matrix else 0
-    wildcards = [MatchPattern.wildcard()] * arity
+def missing_results(matrix: PatternMatrix, space: Optional[CoverageSpace] = None,
+                    width: Optional[int] = None,
+                    session: Optional[WitnessSession] = None,
+                    witnesses: bool = True, limit: int = 1) -> Tuple[bool, List[list]]:
+    # the exhaustiveness, and examples of up to `limit` distinct uncovered regions
+    width = width if width is not None else (len(matrix[0]) if matrix else 0)
+    wildcards = [MatchPattern.wildcard()] * width
 
-    if is_useful(matrix, PatternVector(wildcards)):
-        print("The match is non-exhaustive. There are patterns that are not covered by the match cases.")
-        print("Check cases such as:")
+    if space is None or len(space) != len(matrix) or space.width != width:
+        space, _ = build_coverage_space(matrix, width)
 
-        test_case = find_test_case(matrix, PatternVector(wildcards), arity)
-        for j, subject in enumerate(subjects):
-            print(f" {subject}: {test_case[j] if test_case else 'N/A'}", end=" ")
-        print()
+    witness = space.missing_witness()
+
+    if witness is None:
+        return True, []
+    elif not witnesses:
+        return False, []
+    elif len(witness) == width:
+        return False, [witness] if limit <= 1 else space.missing_witnesses(limit)
     else:
-        print("The match is exhaustive. All possible patterns are covered by the match cases.")
+        if session is None or session.width != width or session.row_count > len(matrix):
+            session = WitnessSession(width, literal_types(matrix))
+        session.add_rows(matrix, len(matrix))
+        return False, session.find_test_cases(PatternVector(wildcards), limit)
+
+
+NO_TEST_CASE_MESSAGE = "No test case found that satisfies the pattern vector."
+
+
+def test_case_lines(test_case: Optional[List[str]], subjects: List[str]) -> List[str]:
+    lines = [NO_TEST_CASE_MESSAGE] if test_case is None else []
+    lines.append(''.join(f" {subject}: {test_case[j] if test_case else 'N/A'} " for j, subject in enumerate(subjects)))
+    return lines
+
+
+def useless_pattern_lines(useful: bool, test_case: Optional[List[str]], subjects: List[str], line_no: int) -> List[str]:
+    if not useful:
+        return [f"! L{line_no} pattern is useless. (It does not match any cases)"]
+    return [f"* L{line_no} pattern is useful"] + test_case_lines(test_case, subjects)
+
+
+def non_exhaustive_lines(exhaustive: bool, test_case: Optional[List[str]], subjects: List[str],
+                         with_test_case: bool = True, more_test_cases: Optional[List[List[str]]] = None) -> List[str]:
+    if exhaustive:
+        return ["The match is exhaustive. All possible patterns are covered by the match cases."]
+    elif not with_test_case:
+        return ["The match is non-exhaustive. There are patterns that are not covered by the match cases."]
+
+    lines = ["The match is non-exhaustive. There are patterns that are not covered by the match cases.",
+             "Check cases such as:"] + test_case_lines(test_case, subjects)
+    for more in more_test_cases or []:
+        lines.extend(test_case_lines(more, subjects))
+    return lines
+
+
+def print_useless_pattern_result(useful: bool, test_case: Optional[List[str]], subjects: List[str], line_no: int):
+    print('\n'.join(useless_pattern_lines(useful, test_case, subjects, line_no)))
+
+
+def print_non_exhaustive_result(exhaustive: bool, test_case: Optional[List[str]], subjects: List[str]):
+    print('\n'.join(non_exhaustive_lines(exhaustive, test_case, subjects)))
+
+
+def check_useless_patterns(matrix: PatternMatrix, subjects: List[str], line_no_list: List[int],
+                           space: Optional[CoverageSpace] = None, session: Optional[WitnessSession] = None):
+    for i, (useful, test_case) in enumerate(useless_pattern_results(matrix, space, len(subjects), session)):
+        print_useless_pattern_result(useful, format_test_case(test_case), subjects, line_no_list[i])
+
+
+def check_non_exhaustive_matches(matrix: PatternMatrix, subjects: List[str], space: Optional[CoverageSpace] = None,
+                                 session: Optional[WitnessSession] = None):
+    exhaustive, test_case = non_exhaustive_result(matrix, space, len(subjects), session)
+    print_non_exhaustive_result(exhaustive, format_test_case(test_case), subjects)
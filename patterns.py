@@ -1,94 +1,316 @@
-from dataclasses import dataclass
-from typing import List, Dict, Optional
+from typing import List, Dict, FrozenSet, Iterable, Optional, Sequence, Tuple
 import ast
-import z3
-from union_var import UnionVar
+import weakref
+from union_var import UnionVar, load_z3
+
+
+KIND_EMPTY = 1 << 0
+KIND_WILDCARD = 1 << 1
+KIND_VAR_BINDING = 1 << 2
+KIND_WILDCARD_SEQ = 1 << 3
+KIND_LITERAL = 1 << 4
+KIND_OR = 1 << 5
+KIND_SEQUENCE = 1 << 6
+KIND_MAP = 1 << 7
+KIND_OBJECT = 1 << 8
+KIND_STAR_SEQUENCE = 1 << 9
+KIND_CLASS = 1 << 10
+KIND_TUPLE = 1 << 11
+
+_WILDCARD_KINDS = KIND_WILDCARD | KIND_VAR_BINDING
+_CONSTRUCTED_KINDS = KIND_LITERAL | KIND_SEQUENCE | KIND_CLASS
+
+_constructor_ids: Dict[str, int] = {}
+_constructor_names: List[str] = []
+_literal_values: Dict[int, object] = {}
+# sequence constructors: constructor id -> whether it stands for a length and every longer one
+_sequence_classes: Dict[int, bool] = {}
+# class pattern constructors: constructor id -> (class name, attribute names, names of the class and its bases)
+_class_layouts: Dict[int, Tuple[str, Tuple[str, ...], FrozenSet[str]]] = {}
+# literal constructors of a closed set of values (the members of an Enum) -> the constructors of the whole set
+_closed_signatures: Dict[str, FrozenSet[str]] = {}
+_closed_signature_version = 0
+
+
+class ValueReference(str):
+    # value pattern naming a constant (e.g. Color.RED) rather than spelling out a literal
+    pass
+
+
+def intern_constructor(name: str) -> int:
+    constructor_id = _constructor_ids.get(name)
+
+    if constructor_id is None:
+        constructor_id = len(_constructor_names)
+        _constructor_ids[name] = constructor_id
+        _constructor_names.append(name)
+
+    return constructor_id
+
+
+def constructor_name(constructor_id: int) -> str:
+    return _constructor_names[constructor_id]
+
+
+def literal_value(constructor_id: int):
+    return _literal_values[constructor_id]
+
+
+def sequence_constructor(length: int, open_ended: bool = False) -> str:
+    # the length class of a sequence: exactly `length` elements, or (open_ended) at least that many
+    name = f'sequence_{length}_or_more' if open_ended else f'sequence_{length}'
+    _sequence_classes.setdefault(intern_constructor(name), open_ended)
+    return name
+
+
+def sequence_class(constructor_id: int) -> Optional[bool]:
+    # None when the constructor is not a sequence constructor; otherwise whether it is open-ended
+    return _sequence_classes.get(constructor_id)
+
+
+def class_layout(constructor_id: int) -> Optional[Tuple[str, Tuple[str, ...], FrozenSet[str]]]:
+    return _class_layouts.get(constructor_id)
+
+
+# the builtin classes whose patterns match literal values: a pattern such as int() or int(x)
+# matches the values of the type itself (its one positional subpattern matches the whole value)
+BUILTIN_CLASSES = {'bool': bool, 'int': int, 'float': float, 'complex': complex, 'str': str, 'bytes': bytes}
+BUILTIN_BASES = {'bool': ('int',)}
+
+
+def builtin_class(constructor_id: int) -> Optional[type]:
+    # the type of a class pattern constructor naming a builtin class, rather than a class of the project
+    layout = class_layout(constructor_id)
+    if layout is None or layout[0] not in BUILTIN_CLASSES or not layout[2] <= BUILTIN_CLASSES.keys() | {'object'}:
+        return None
+    return BUILTIN_CLASSES[layout[0]]
+
+
+def register_closed_signature(values: Iterable['ValueReference']):
+    # the given named constants are all the values of their type (the members of an Enum), so a
+    # column with a value pattern for each of them is a complete signature
+    global _closed_signature_version
+    constructors = frozenset(MatchPattern.literal(value).constructor for value in values)
+
+    for constructor in constructors:
+        if _closed_signatures.get(constructor) != constructors:
+            _closed_signatures[constructor] = constructors
+            _closed_signature_version += 1
+
+
+def closed_signature(constructor: str) -> Optional[FrozenSet[str]]:
+    return _closed_signatures.get(constructor)
+
+
+def closed_signature_version() -> int:
+    # changes whenever a closed signature is registered
+    return _closed_signature_version
+
+
+def _rebuild(kind, constructor, args, kwarg_items, var_name, value):
+    if kind == KIND_SEQUENCE:
+        sequence_constructor(len(args))
+    elif kind == KIND_CLASS:
+        return MatchPattern.class_pattern(value[0], value[1], list(args), value[2])
+    return MatchPattern._make(kind, constructor, args, kwarg_items, var_name, value)
 
 
-@dataclass
 class MatchPattern:
-    constructor: str
-    args: List['MatchPattern'] = None
-    kwargs: Dict[str, 'MatchPattern'] = None
-    var_name: Optional[str] = None
+    # Patterns are immutable and hash-consed: building a pattern equal to a live one returns
+    # the existing object, so equal subpatterns are shared, equality is identity, and
+    # the property checks below are integer operations on the kind tag.
+    __slots__ = ('kind', 'constructor_id', 'args', 'kwarg_items', 'var_name', 'value', '_hash', '__weakref__')
+
+    _table = weakref.WeakValueDictionary()
+    _singletons = {}
+
+    @classmethod
+    def _make(cls, kind: int, constructor: str, args: Tuple['MatchPattern', ...] = (),
+              kwarg_items: Optional[Tuple[Tuple[str, 'MatchPattern'], ...]] = None,
+              var_name: Optional[str] = None, value=None) -> 'MatchPattern':
+        constructor_id = intern_constructor(constructor)
+        # the value type is part of the key, since e.g. 1 and '1' share the constructor name
+        key = (kind, constructor_id, args, kwarg_items, var_name, type(value), value)
+
+        pattern = cls._table.get(key)
+        if pattern is not None:
+            return pattern
+
+        pattern = object.__new__(cls)
+        setattr_ = object.__setattr__
+        setattr_(pattern, 'kind', kind)
+        setattr_(pattern, 'constructor_id', constructor_id)
+        setattr_(pattern, 'args', args)
+        setattr_(pattern, 'kwarg_items', kwarg_items)
+        setattr_(pattern, 'var_name', var_name)
+        setattr_(pattern, 'value', value)
+        setattr_(pattern, '_hash', hash(key))
+
+        cls._table[key] = pattern
+        return pattern
+
+    @classmethod
+    def _singleton(cls, kind: int, constructor: str) -> 'MatchPattern':
+        # the argument-less patterns are created on every specialization step, so keep them alive
+        pattern = cls._singletons.get(kind)
+        if pattern is None:
+            pattern = cls._singletons[kind] = cls._make(kind, constructor)
+        return pattern
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'MatchPattern is immutable; cannot assign to {name}')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'MatchPattern is immutable; cannot delete {name}')
+
+    def __hash__(self):
+        return self._hash
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return _rebuild, (self.kind, self.constructor, self.args, self.kwarg_items, self.var_name, self.value)
+
+    def __repr__(self):
+        return f'MatchPattern(constructor={self.constructor!r}, args={list(self.args)!r}, ' \
+               f'kwargs={self.kwargs!r}, var_name={self.var_name!r})'
+
+    @property
+    def constructor(self) -> str:
+        return _constructor_names[self.constructor_id]
+
+    @property
+    def kwargs(self) -> Optional[Dict[str, 'MatchPattern']]:
+        return dict(self.kwarg_items) if self.kwarg_items is not None else None
+
+    def with_var_name(self, var_name: Optional[str]) -> 'MatchPattern':
+        return self._make(self.kind, self.constructor, self.args, self.kwarg_items, var_name, self.value)
 
     @classmethod
     def empty(cls):
-        return cls(constructor='empty', args=[])
+        return cls._singleton(KIND_EMPTY, 'empty')
 
     @classmethod
     def wildcard(cls):
-        return cls(constructor='_', args=[])
+        return cls._singleton(KIND_WILDCARD, '_')
 
     @classmethod
     def wildcard_seq(cls):
-        return cls(constructor='_seq', args=[])
+        return cls._singleton(KIND_WILDCARD_SEQ, '_seq')
 
     @classmethod
     def var_binding(cls, var_name: str):
-        return cls(constructor='var_binding', args=[], var_name=var_name)
+        return cls._make(KIND_VAR_BINDING, 'var_binding', var_name=var_name)
 
     @classmethod
     def literal(cls, value):
-        return cls(constructor=f'literal_{value}', args=[])
+        # a string is named by its repr, so that '1' and 1 (or 'None' and None) are told apart
+        name = repr(value) if isinstance(value, str) and not isinstance(value, ValueReference) else value
+        pattern = cls._make(KIND_LITERAL, f'literal_{name}', value=value)
+        _literal_values.setdefault(pattern.constructor_id, value)
+        return pattern
 
     @classmethod
     def or_pattern(cls, args: List['MatchPattern']):
-        return cls(constructor='or', args=args)
+        return cls._make(KIND_OR, 'or', tuple(args))
 
     @classmethod
     def sequence(cls, elements: List['MatchPattern']):
-        return cls(constructor=f'sequence_{len(elements)}', args=elements)
+        return cls._make(KIND_SEQUENCE, sequence_constructor(len(elements)), tuple(elements))
+
+    @classmethod
+    def subject_tuple(cls, elements: List['MatchPattern']):
+        # an alternative of an or over all the subjects of a match (`case (1, 2) | (3, 4):` in
+        # `match x, y:`): one element per subject, spread over the columns rather than tested as
+        # a sequence (see extend)
+        return cls._make(KIND_TUPLE, f'tuple_{len(elements)}', tuple(elements))
+
+    @classmethod
+    def star_sequence(cls, prefix: List['MatchPattern'], suffix: List['MatchPattern']):
+        # a variable-length sequence pattern such as [first, *rest, last]: the elements before
+        # and after the star, with the length of the prefix kept in value
+        return cls._make(KIND_STAR_SEQUENCE, f'star_sequence_{len(prefix)}_{len(suffix)}',
+                         tuple(prefix) + tuple(suffix), value=len(prefix))
+
+    @classmethod
+    def class_pattern(cls, name: str, attributes: Tuple[str, ...], elements: List['MatchPattern'],
+                      ancestry: Iterable[str] = ()):
+        # a class pattern resolved against the other class patterns of its match: one element per
+        # attribute that any pattern of the class (or of a base class) in the match looks at, in
+        # the order of `attributes`. ancestry names the class and its base classes.
+        attributes = tuple(attributes)
+        ancestry = frozenset(ancestry) | {name}
+        pattern = cls._make(KIND_CLASS, f'class_{name}({",".join(attributes)})', tuple(elements),
+                            value=(name, attributes, ancestry))
+        # the latest resolution wins: a match is analyzed right after it is converted
+        _class_layouts[pattern.constructor_id] = (name, attributes, ancestry)
+        return pattern
 
     @classmethod
     def map(cls, keys: List[str], values: List['MatchPattern']):
         if len(keys) != len(values):
             raise ValueError("Keys and values must have the same length")
-        return cls(constructor=f'map_{len(keys)}', kwargs={k: v for k, v in zip(keys, values)})
+        return cls._make(KIND_MAP, f'map_{len(keys)}', kwarg_items=tuple(zip(keys, values)))
 
     @classmethod
     def object(cls, name: str, args: List['MatchPattern'], kwargs: Dict[str, 'MatchPattern']):
-        return cls(constructor=f'object_{name}', args=args, kwargs=kwargs)
+        return cls._make(KIND_OBJECT, f'object_{name}', tuple(args), tuple(kwargs.items()))
 
     @property
     def is_empty(self):
-        return self.constructor == 'empty'
+        return self.kind == KIND_EMPTY
 
     @property
     def is_wildcard(self):
-        return self.constructor == '_' or self.constructor == 'var_binding'
+        return self.kind & _WILDCARD_KINDS != 0
 
     @property
     def is_wildcard_seq(self):
-        return self.constructor == '_seq'
+        return self.kind == KIND_WILDCARD_SEQ
 
     @property
     def is_literal(self):
-        return self.constructor.startswith('literal_')
+        return self.kind == KIND_LITERAL
 
     @property
     def is_or(self):
-        return self.constructor == 'or'
+        return self.kind == KIND_OR
 
     @property
     def is_sequence(self):
-        return self.constructor.startswith('sequence_')
+        return self.kind == KIND_SEQUENCE
+
+    @property
+    def is_tuple(self):
+        return self.kind == KIND_TUPLE
+
+    @property
+    def is_star_sequence(self):
+        return self.kind == KIND_STAR_SEQUENCE
 
     @property
     def is_map(self):
-        return self.constructor.startswith('map_')
+        return self.kind == KIND_MAP
 
     @property
     def is_object(self):
-        return self.constructor.startswith('object_')
+        return self.kind == KIND_OBJECT
+
+    @property
+    def is_class(self):
+        return self.kind == KIND_CLASS
 
     @property
     def is_constructed(self):
-        return self.is_literal or self.is_sequence
+        return self.kind & _CONSTRUCTED_KINDS != 0
 
     @property
     def is_var_binding(self):
-        return self.constructor == 'var_binding' and self.var_name is not None
+        return self.kind == KIND_VAR_BINDING and self.var_name is not None
 
     def __str__(self):
         if self.is_empty:
@@ -112,10 +334,22 @@ class MatchPattern:
         elif self.is_sequence:
             return f'Sequence({", ".join(str(arg) for arg in self.args)})'
 
+        elif self.is_tuple:
+            return f'Tuple({", ".join(str(arg) for arg in self.args)})'
+
+        elif self.is_star_sequence:
+            elements = [str(arg) for arg in self.args]
+            elements.insert(self.value, '*')
+            return f'StarSequence({", ".join(elements)})'
+
         elif self.is_map:
             items_str = ', '.join(f'{k}: {v}' for k, v in self.kwargs.items())
             return f'Map({items_str})'
 
+        elif self.is_class:
+            name, attributes, _ = self.value
+            return f'Class({name}, {", ".join(f"{a}={arg}" for a, arg in zip(attributes, self.args))})'
+
         elif self.is_object:
             name = self.constructor[len('object_'):]
 
@@ -126,57 +360,164 @@ class MatchPattern:
         else:
             return f'{self.constructor}({", ".join(str(arg) for arg in self.args)})'
 
-    def extend(self, other: List['MatchPattern']) -> List['MatchPattern']:
-        if self.is_sequence:
-            return self.args + other
+    def elements_for_length(self, length: int) -> Optional[List['MatchPattern']]:
+        # the element patterns of a star sequence matched against a sequence of the given length
+        # (wildcards in place of the star), or None when the sequence is too short
+        if length < len(self.args):
+            return None
+        prefix, suffix = self.args[:self.value], self.args[self.value:]
+        return list(prefix) + [MatchPattern.wildcard()] * (length - len(self.args)) + list(suffix)
+
+    def extend(self, other: 'PatternVector') -> 'PatternVector':
+        if self.is_tuple:
+            return other.prepend(self.args)
         else:
-            return [self] + other
+            return other.prepend((self,))
 
     def convert_to_condition(self, union_var: UnionVar, union_vars: Optional[List[UnionVar]] = None):
+        z3 = load_z3()
+
         if self.is_empty:  # empty pattern, never matches
             return z3.BoolVal(False)
         elif self.is_wildcard:  # wildcard matches anything
             return z3.BoolVal(True)
         elif self.is_literal:  # literal matches specific value
-            value = ast.literal_eval(self.constructor[len('literal_'):])
-            return union_var == value
+            if isinstance(self.value, ValueReference):  # the value of a named constant is unknown
+                raise NotImplementedError(f'Pattern conversion not implemented for {self.constructor} type')
+            return union_var == self.value
         elif self.is_or:
             compares = [arg.convert_to_condition(union_var, union_vars=union_vars) for arg in self.args]
             return z3.Or(*compares)
-        elif self.is_sequence:
+        elif self.is_tuple:
             if union_vars is None or len(union_vars) != len(self.args):
-                raise ValueError("Union variables must be provided for sequence patterns")
+                raise ValueError("Union variables must be provided for subject tuples")
             compares = [arg.convert_to_condition(union_vars[i]) for i, arg in enumerate(self.args)]
-            return z3.And(*compares)
+            return z3.And(*compares) if compares else z3.BoolVal(True)
         else:
             raise NotImplementedError(f'Pattern conversion not implemented for {self.constructor} type')
 
 
+class _Columns:
+    # A pattern vector as a persistent list: one cell per column, pointing at the cell of the
+    # columns after it. Dropping the first columns of a vector or putting patterns in front of
+    # it shares the rest instead of copying it. Cells compare structurally, with the hash
+    # computed once, so they serve as keys for the rows they start.
+    __slots__ = ('head', 'tail', 'length', '_hash')
+
+    def __init__(self, head: MatchPattern, tail: Optional['_Columns']):
+        self.head = head
+        self.tail = tail
+        if tail is None:
+            self.length = 1
+            self._hash = head._hash
+        else:
+            self.length = tail.length + 1
+            self._hash = (head._hash * 1000003 ^ tail._hash) & 0xFFFFFFFFFFFFFFF
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        # patterns are hash-consed, so each column compares by identity
+        cell = self
+        while cell is not other:
+            if cell is None or other is None or cell._hash != other._hash or cell.head is not other.head:
+                return False
+            cell, other = cell.tail, other.tail
+        return True
+
+
 class PatternVector:
-    def __init__(self, patterns: List[MatchPattern], guard: Optional[ast.AST] = None):
-        self.patterns = patterns
+    # Guards are shared references to the case's guard expression; nothing modifies them.
+    __slots__ = ('columns', 'guard')
+
+    def __init__(self, patterns: Iterable[MatchPattern] = (), guard: Optional[ast.AST] = None):
+        columns = None
+        for pattern in reversed(list(patterns)):
+            columns = _Columns(pattern, columns)
+
+        self.columns = columns
         self.guard = guard
 
+    @staticmethod
+    def _of(columns: Optional[_Columns], guard: Optional[ast.AST]) -> 'PatternVector':
+        vector = _new_vector(PatternVector)
+        vector.columns = columns
+        vector.guard = guard
+        return vector
+
+    @property
+    def patterns(self) -> List[MatchPattern]:
+        return list(self)
+
     def __len__(self):
-        return len(self.patterns)
+        return self.columns.length if self.columns is not None else 0
 
     def __getitem__(self, index):
-        return self.patterns[index]
+        if index == 0 and self.columns is not None:
+            return self.columns.head
+
+        if isinstance(index, slice):
+            return self.patterns[index]
+
+        if index < 0:
+            index += len(self)
+
+        cell = self.columns
+        for _ in range(index):
+            if cell is None:
+                break
+            cell = cell.tail
+
+        if cell is None or index < 0:
+            raise IndexError('pattern vector index out of range')
+        return cell.head
 
     def __iter__(self):
-        return iter(self.patterns)
+        cell = self.columns
+        while cell is not None:
+            yield cell.head
+            cell = cell.tail
 
     def __str__(self):
-        return f'PatternVector({", ".join(str(pattern) for pattern in self.patterns)})' + \
+        return f'PatternVector({", ".join(str(pattern) for pattern in self)})' + \
                 (f' with guard {ast.unparse(self.guard)}' if self.guard else '')
 
+    def rest(self) -> 'PatternVector':
+        # the vector without its first column
+        return PatternVector._of(self.columns.tail, self.guard)
+
+    def prepend(self, patterns: Sequence[MatchPattern]) -> 'PatternVector':
+        # the given patterns followed by the columns of this vector
+        columns = self.columns
+        for pattern in reversed(patterns):
+            columns = _Columns(pattern, columns)
+
+        vector = _new_vector(PatternVector)
+        vector.columns = columns
+        vector.guard = self.guard
+        return vector
+
+    def replace_first(self, patterns: Sequence[MatchPattern]) -> 'PatternVector':
+        # the vector with its first column replaced by the given patterns
+        columns = self.columns.tail
+        for pattern in reversed(patterns):
+            columns = _Columns(pattern, columns)
+
+        vector = _new_vector(PatternVector)
+        vector.columns = columns
+        vector.guard = self.guard
+        return vector
+
     @property
     def has_guard(self):
         return self.guard is not None
 
     @property
     def is_empty(self):
-        return len(self.patterns) == 0
+        return self.columns is None
+
 
+_new_vector = object.__new__
 
 PatternMatrix = List[PatternVector]
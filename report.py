@@ -0,0 +1,326 @@
+import ast
+import json
+import time
+from dataclasses import dataclass, asdict, field, replace
+from typing import Dict, Iterator, List, Optional, Union
+import stats
+import pattern_matching_checker
+from budget import Budget, BudgetExceeded
+from pattern_converter import (
+    convert_pattern_matrix, get_subjects, get_line_no, get_symbol_names, may_contain_match, match_statements
+)
+from pattern_matching_checker import (
+    CoverageSpace, WitnessSession, literal_types, useless_pattern_results, missing_results, format_test_case,
+    useless_pattern_lines, non_exhaustive_lines
+)
+from git_diff import LineRange, overlaps
+from result_cache import ResultCache, match_key, source_key
+from symbol_index import SymbolIndex
+
+
+@dataclass
+class MatchStart:
+    file: Optional[str]
+    line: int
+    subjects: List[str]
+    cases: List[int]  # line numbers of the cases
+    witnesses: bool = True  # whether the results carry example values
+    symbols: List[str] = field(default_factory=list)  # the classes and Enums the patterns name
+
+
+@dataclass
+class CaseResult:
+    file: Optional[str]
+    match_line: int
+    line: int
+    index: int
+    useful: Optional[bool]  # None when the budget ran out before the case was checked
+    witness: Optional[List[str]]  # one example value per subject; None when no example was found
+
+
+@dataclass
+class MatchResult:
+    file: Optional[str]
+    line: int
+    exhaustive: Optional[bool]  # None when the budget ran out; the case results are then partial
+    witness: Optional[List[str]]  # an uncovered example, for non-exhaustive matches
+    reason: Optional[str] = None  # why the result is unknown
+    more_witnesses: List[List[str]] = field(default_factory=list)  # examples of other uncovered regions
+
+
+@dataclass
+class MatchError:
+    file: Optional[str]
+    line: int
+    message: str
+
+
+@dataclass
+class FileError:
+    file: Optional[str]
+    message: str
+
+
+Record = Union[MatchStart, CaseResult, MatchResult, MatchError, FileError]
+
+RECORD_TYPES = {
+    'match_start': MatchStart,
+    'case': CaseResult,
+    'match': MatchResult,
+    'match_error': MatchError,
+    'file_error': FileError,
+}
+_RECORD_NAMES = {record_type: name for name, record_type in RECORD_TYPES.items()}
+
+
+def record_to_dict(record: Record) -> dict:
+    return {'type': _RECORD_NAMES[type(record)], **asdict(record)}
+
+
+def record_from_dict(data: dict) -> Record:
+    fields = dict(data)
+    return RECORD_TYPES[fields.pop('type')](**fields)
+
+
+def to_json_line(record: Record) -> str:
+    return json.dumps(record_to_dict(record))
+
+
+def analyze_match(node: ast.Match, file: Optional[str] = None, cache: Optional[ResultCache] = None,
+                  budget: Optional[Budget] = None, deadline: Optional[float] = None,
+                  witnesses: bool = True, symbols: Optional[SymbolIndex] = None, missing: int = 1) -> Iterator[Record]:
+    # yields the records of one match statement as they are computed; when the budget runs out,
+    # the cases not checked yet and the exhaustiveness are reported as unknown.
+    # With witnesses=False, no example values are searched for, and z3 is never loaded.
+    # symbols resolves the class and Enum patterns (see pattern_converter.resolve_symbols).
+    # A non-exhaustive match reports examples of up to `missing` distinct uncovered regions.
+    started = time.perf_counter()
+
+    try:
+        yield from _match_records(node, file, cache, budget, deadline, witnesses, symbols, missing)
+    finally:
+        collector = stats.active_stats()
+        if collector is not None:
+            collector.add_match(file, node.lineno, time.perf_counter() - started)
+
+
+def _match_records(node: ast.Match, file: Optional[str], cache: Optional[ResultCache],
+                   budget: Optional[Budget], deadline: Optional[float], witnesses: bool,
+                   symbols: Optional[SymbolIndex], missing: int) -> Iterator[Record]:
+    try:
+        with stats.timer('convert'):
+            pattern_matrix = convert_pattern_matrix(node, symbols, file)
+            subjects = get_subjects(node)
+            line_no_list = get_line_no(node)
+            symbol_names = get_symbol_names(node)
+    except Exception as e:
+        yield MatchError(file, node.lineno, str(e))
+        return
+
+    yield MatchStart(file, node.lineno, subjects, line_no_list, witnesses, symbol_names)
+
+    key = match_key(pattern_matrix, subjects, _cache_options(witnesses, missing)) if cache is not None else None
+    cached = cache.get(key) if key is not None else None
+
+    if cached is not None:
+        stats.count('match_cache_hits')
+        for i, (useful, test_case) in enumerate(cached['cases']):
+            yield CaseResult(file, node.lineno, line_no_list[i], i, useful, test_case)
+        yield MatchResult(file, node.lineno, cached['exhaustive'], cached['missing'],
+                          more_witnesses=cached.get('more_missing', []))
+        return
+
+    # one coverage space (and, when z3 is needed, one solver session) answers both
+    # the per-case and the exhaustiveness questions
+    space = CoverageSpace.for_matrix(pattern_matrix, len(subjects))
+    session = WitnessSession(len(subjects), literal_types(pattern_matrix))
+    budget = budget if budget is not None else Budget()
+    cases = []
+    kept = True
+
+    with budget.start(deadline):
+        try:
+            budget.check_clock()
+
+            for i, (useful, test_case) in enumerate(
+                    useless_pattern_results(pattern_matrix, space, len(subjects), session, witnesses)):
+                test_case = format_test_case(test_case)
+                cases.append([useful, test_case])
+                case_result = CaseResult(file, node.lineno, line_no_list[i], i, useful, test_case)
+                kept = kept and is_kept(case_result, witnesses)
+                yield case_result
+
+            exhaustive, test_cases = missing_results(pattern_matrix, space, len(subjects), session, witnesses,
+                                                     missing)
+            test_cases = [format_test_case(test_case) for test_case in test_cases]
+            test_case = test_cases[0] if test_cases else None
+        except BudgetExceeded as e:
+            for i in range(len(cases), len(line_no_list)):
+                yield CaseResult(file, node.lineno, line_no_list[i], i, None, None)
+            yield MatchResult(file, node.lineno, None, None, str(e))
+            return
+        except Exception as e:
+            yield MatchError(file, node.lineno, str(e))
+            return
+
+    match_result = MatchResult(file, node.lineno, exhaustive, test_case, more_witnesses=test_cases[1:])
+    yield match_result
+
+    if key is not None and kept and is_kept(match_result, witnesses):
+        cache.put(key, {'cases': cases, 'exhaustive': exhaustive, 'missing': test_case,
+                        'more_missing': test_cases[1:]})
+
+
+def _cache_options(witnesses: bool, missing: int = 1) -> str:
+    # the examples of the coverage space depend on the order it tests the subjects in
+    options = '' if witnesses else 'no_witness'
+    if witnesses and missing != 1:
+        options += f'missing={missing}'
+    strategy = pattern_matching_checker.column_strategy
+    if witnesses and strategy is not pattern_matching_checker.first_column:
+        options += f':columns={strategy.__name__}'
+    return options
+
+
+def is_partial(record: Record) -> bool:
+    return (isinstance(record, CaseResult) and record.useful is None) or \
+        (isinstance(record, MatchResult) and record.exhaustive is None)
+
+
+def is_kept(record: Record, witnesses: bool = True) -> bool:
+    # whether a record may be cached: not cut short by the budget and, with witnesses, not
+    # missing an example, which may be a z3 timeout that a larger budget would not repeat
+    if is_partial(record):
+        return False
+    elif not witnesses:
+        return True
+    elif isinstance(record, CaseResult):
+        return not record.useful or record.witness is not None
+    elif isinstance(record, MatchResult):
+        return record.exhaustive or record.witness is not None
+    return True
+
+
+def _may_contain_match(code: str) -> bool:
+    with stats.timer('prefilter'):
+        if may_contain_match(code):
+            return True
+    stats.count('files_skipped')
+    return False
+
+
+def analyze_source(code: str, file: Optional[str] = None, cache: Optional[ResultCache] = None,
+                   budget: Optional[Budget] = None, witnesses: bool = True,
+                   symbols: Optional[SymbolIndex] = None, lines: Optional[List[LineRange]] = None,
+                   missing: int = 1, scanned: bool = False) -> Iterator[Record]:
+    # without a symbol index, the classes of the source itself are indexed.
+    # With lines, only the match statements that span one of the line ranges are analyzed.
+    # A source without a match statement yields nothing, and is not parsed; scanned means that
+    # the caller has already looked for one
+    if not scanned and not _may_contain_match(code):
+        return
+
+    try:
+        with stats.timer('parse'):
+            root = ast.parse(code)
+    except (SyntaxError, ValueError) as e:
+        yield FileError(file, str(e))
+        return
+
+    budget = budget if budget is not None else Budget()
+    deadline = budget.file_deadline()
+    symbols = symbols if symbols is not None else SymbolIndex.for_tree(root, file)
+
+    for node in match_statements(root):
+        if lines is None or overlaps(node.lineno, node.end_lineno, lines):
+            yield from analyze_match(node, file, cache, budget, deadline, witnesses, symbols, missing)
+
+
+def analyze_file(path: str, cache: Optional[ResultCache] = None, budget: Optional[Budget] = None,
+                 witnesses: bool = True, symbols: Optional[SymbolIndex] = None,
+                 lines: Optional[List[LineRange]] = None, code: Optional[str] = None,
+                 missing: int = 1) -> Iterator[Record]:
+    # code is the content of the file when it is not read from disk (e.g. at a git revision)
+    if code is None:
+        try:
+            with open(path, 'r') as f:
+                code = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            yield FileError(path, str(e))
+            return
+
+    # a file without a match statement is neither hashed for the cache nor parsed
+    if not _may_contain_match(code):
+        return
+
+    # the records of only some of the matches are left to the per-match cache
+    if lines is not None:
+        yield from analyze_source(code, path, cache, budget, witnesses, symbols, lines, missing, scanned=True)
+        return
+
+    # an unchanged file replays its records without being parsed again, as long as the classes
+    # and Enums its patterns name resolve as they did. Without a symbol index, they are the
+    # classes of the file itself, which its content already stands for
+    options = _cache_options(witnesses, missing) + ('' if symbols is not None else ':own_classes')
+    key = source_key(code, options) if cache is not None else None
+    cached = cache.get(key) if key is not None else None
+
+    if cached is not None and (symbols is None or symbols.layouts(cached['layouts'], path) == cached['layouts']):
+        for data in cached['records']:
+            yield replace(record_from_dict(data), file=path)
+        return
+
+    records = []
+    kept = True
+    names = set()
+
+    for record in analyze_source(code, path, cache, budget, witnesses, symbols, missing=missing, scanned=True):
+        records.append(record_to_dict(record))
+        kept = kept and is_kept(record, witnesses)
+        if isinstance(record, MatchStart):
+            names.update(record.symbols)
+        yield record
+
+    if key is not None and kept:
+        layouts = symbols.layouts(sorted(names), path) if symbols is not None else {}
+        cache.put(key, {'records': records, 'layouts': layouts})
+
+
+def render_text(records: Iterator[Record]) -> Iterator[str]:
+    # the plain-text report, one line at a time
+    subjects: Dict[int, List[str]] = dict()
+    witnesses = True
+
+    for record in records:
+        if isinstance(record, MatchStart):
+            subjects = {record.line: record.subjects}
+            witnesses = record.witnesses
+            yield f"Checking pattern matching in line {record.line}:"
+
+        elif isinstance(record, CaseResult) and record.useful is None:
+            yield f"? L{record.line} pattern was not checked. (The analysis budget ran out)"
+
+        elif isinstance(record, MatchResult) and record.exhaustive is None:
+            yield f"The match could not be fully checked: {record.reason}. The results above are partial."
+            yield ""
+
+        elif isinstance(record, CaseResult):
+            # without witnesses, only the findings (useless cases) are listed
+            if witnesses or not record.useful:
+                yield from useless_pattern_lines(record.useful, record.witness, subjects[record.match_line],
+                                                 record.line)
+
+        elif isinstance(record, MatchResult):
+            yield from non_exhaustive_lines(record.exhaustive, record.witness, subjects[record.line], witnesses,
+                                            record.more_witnesses)
+            yield ""
+
+        elif isinstance(record, MatchError):
+            if record.line not in subjects:
+                yield f"Checking pattern matching in line {record.line}:"
+            yield f"Error converting match node in line {record.line}: {record.message}"
+            yield ""
+
+        elif isinstance(record, FileError):
+            yield f"Error reading {record.file}: {record.message}"
+            yield ""
@@ -0,0 +1,206 @@
+import ast
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from typing import List, Optional
+from patterns import MatchPattern, PatternMatrix, closed_signature
+
+
+DEFAULT_CACHE_DIR = '.pattern_cache'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_ENTRIES = 4096
+
+# evict down to this fraction of the limit, so that eviction does not run on every write
+EVICTION_LOW_WATERMARK = 0.8
+
+
+# the modules whose code the results depend on (not the benchmarks or the sample files)
+ANALYZER_MODULES = (
+    'analyze.py', 'budget.py', 'daemon.py', 'decision_tree.py', 'git_diff.py', 'pattern_converter.py',
+    'pattern_matching_checker.py', 'patterns.py', 'report.py', 'result_cache.py', 'stats.py', 'symbol_index.py',
+    'union_var.py',
+)
+
+
+def _analyzer_fingerprint() -> str:
+    # results depend on the analyzer itself, so any change to its sources invalidates the cache
+    digest = hashlib.sha256()
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+
+    for name in ANALYZER_MODULES:
+        with open(os.path.join(module_dir, name), 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+ANALYZER_FINGERPRINT = _analyzer_fingerprint()
+
+
+def canonical_pattern(pattern: MatchPattern) -> str:
+    # variable names do not change what a pattern matches, so they are left out of the key; how
+    # the classes and Enums were resolved does (the base classes of a class, all the members of
+    # an Enum), so the key holds it rather than depending on the whole symbol index. Literals
+    # share their constructor with the literals of other types (1 and '1'), so they are keyed on
+    # their type and value
+    if pattern.is_wildcard:
+        return '_'
+
+    parts = [canonical_pattern(arg) for arg in pattern.args or []]
+    parts.extend(f'{key}={canonical_pattern(value)}' for key, value in sorted((pattern.kwargs or {}).items()))
+
+    constructor = pattern.constructor
+    if pattern.is_class:
+        constructor += f'<{",".join(sorted(pattern.value[2]))}>'
+    elif pattern.is_literal:
+        constructor = f'literal:{type(pattern.value).__name__}:{pattern.value!r}'
+        if closed_signature(pattern.constructor) is not None:
+            constructor += f'<{",".join(sorted(closed_signature(pattern.constructor)))}>'
+
+    return f'{constructor}({",".join(parts)})'
+
+
+def canonical_matrix(matrix: PatternMatrix) -> str:
+    rows = []
+
+    for row in matrix:
+        patterns = ' '.join(canonical_pattern(pattern) for pattern in row)
+        guard = f' if {ast.unparse(row.guard)}' if row.has_guard else ''
+        rows.append(f'[{patterns}]{guard}')
+
+    return '\n'.join(rows)
+
+
+def _digest(*parts: str) -> str:
+    digest = hashlib.sha256(ANALYZER_FINGERPRINT.encode())
+
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(part.encode('utf-8', 'surrogatepass'))
+
+    return digest.hexdigest()
+
+
+def match_key(matrix: PatternMatrix, subjects: List[str], options: str = '') -> str:
+    return _digest('match', options, ','.join(subjects), canonical_matrix(matrix))
+
+
+def source_key(code: str, options: str = '') -> str:
+    return _digest('source', options, code)
+
+
+class ResultCache:
+    # two layers: an in-memory LRU that dedups repeated match statements within a run,
+    # and an optional on-disk store (one json file per key) with size-bounded eviction
+    def __init__(self, cache_dir: Optional[str] = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 memory_entries: int = DEFAULT_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+
+        self._memory = OrderedDict()
+        self._disk_bytes = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, key: str):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+
+        value = self._read_disk(key)
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str, value):
+        self._remember(key, value)
+        self._write_disk(key, value)
+
+    def _remember(self, key: str, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str):
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+            # the modification time doubles as the recency used for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return value
+
+    def _write_disk(self, key: str, value):
+        if self.cache_dir is None:
+            return
+
+        path = self._path(key)
+        data = json.dumps(value, separators=(',', ':'))
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # write to a temporary file first, so concurrent readers never see a partial entry
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+        else:
+            self._disk_bytes += len(data)
+
+        if self._disk_bytes > self.max_bytes:
+            self._evict()
+
+    def _disk_entries(self):
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.json')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICTION_LOW_WATERMARK
+
+        for path, size, _ in entries:
+            if total <= target:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # already evicted by another process
+
+            total -= size
+
+        self._disk_bytes = total
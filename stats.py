@@ -0,0 +1,144 @@
+import functools
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+
+DEFAULT_TOP = 10
+
+# always listed by Stats.format, even when nothing was recorded
+STANDARD_TIMERS = ('parse', 'convert', 'z3_check')
+STANDARD_COUNTERS = ('space_search', 'specialized_rows', 'default_rows')
+STANDARD_DEPTHS = ('space_search',)
+
+
+class Stats:
+    # Opt-in engine instrumentation. While a Stats is active (`with Stats() as stats:`), the
+    # analyzer records counters, timers (total seconds and number of calls) and the time of
+    # every match statement. Nothing is recorded when no Stats is active.
+    def __init__(self):
+        self.counters: Counter = Counter()
+        self.timers: Dict[str, float] = dict()
+        self.max_depths: Dict[str, int] = dict()
+        self.matches: List[Tuple[Optional[str], int, float]] = []
+
+        self._depths: Counter = Counter()
+        self._previous = None
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def add_time(self, name: str, seconds: float):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+        self.counters[name] += 1
+
+    def enter(self, name: str):
+        self.counters[name] += 1
+        self._depths[name] += 1
+        if self._depths[name] > self.max_depths.get(name, 0):
+            self.max_depths[name] = self._depths[name]
+
+    def leave(self, name: str):
+        self._depths[name] -= 1
+
+    def add_match(self, file: Optional[str], line: int, seconds: float):
+        self.matches.append((file, line, seconds))
+
+    def slowest(self, top: int = DEFAULT_TOP) -> List[Tuple[Optional[str], int, float]]:
+        return sorted(self.matches, key=lambda match: match[2], reverse=True)[:top]
+
+    def merge(self, other: 'Stats'):
+        self.counters.update(other.counters)
+        for name, seconds in other.timers.items():
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+        for name, depth in other.max_depths.items():
+            self.max_depths[name] = max(depth, self.max_depths.get(name, 0))
+        self.matches.extend(other.matches)
+
+    def to_dict(self) -> dict:
+        return {'counters': dict(self.counters), 'timers': self.timers, 'max_depths': self.max_depths,
+                'matches': [list(match) for match in self.matches]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Stats':
+        stats = cls()
+        stats.counters.update(data['counters'])
+        stats.timers.update(data['timers'])
+        stats.max_depths.update(data['max_depths'])
+        stats.matches.extend(tuple(match) for match in data['matches'])
+        return stats
+
+    def format(self, top: int = DEFAULT_TOP) -> str:
+        lines = ["Timers:"]
+        for name in sorted(set(STANDARD_TIMERS) | set(self.timers)):
+            lines.append(f"  {name}: {self.timers.get(name, 0.0) * 1000:.2f}ms in {self.counters[name]} calls")
+
+        lines.append("Counters:")
+        for name in sorted(set(STANDARD_COUNTERS) | set(self.counters) - set(self.timers) - set(STANDARD_TIMERS)):
+            lines.append(f"  {name}: {self.counters[name]}")
+        for name in sorted(set(STANDARD_DEPTHS) | set(self.max_depths)):
+            lines.append(f"  {name} max depth: {self.max_depths.get(name, 0)}")
+
+        lines.append(f"Slowest match statements (top {top} of {len(self.matches)}):")
+        for file, line, seconds in self.slowest(top):
+            location = f"{file}:{line}" if file is not None else f"line {line}"
+            lines.append(f"  {seconds * 1000:10.2f}ms  {location}")
+
+        return '\n'.join(lines)
+
+    def __enter__(self):
+        global _active_stats
+        self._previous, _active_stats = _active_stats, self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active_stats
+        _active_stats, self._previous = self._previous, None
+        return False
+
+
+_active_stats: Optional[Stats] = None
+
+
+def active_stats() -> Optional[Stats]:
+    return _active_stats
+
+
+def count(name: str, amount: int = 1):
+    if _active_stats is not None:
+        _active_stats.count(name, amount)
+
+
+@contextmanager
+def timer(name: str):
+    if _active_stats is None:
+        yield
+        return
+
+    collector = _active_stats
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        collector.add_time(name, time.perf_counter() - start)
+
+
+def recursion(name: str):
+    # decorator: counts the calls of a recursive function and its maximum depth
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            collector = _active_stats
+            if collector is None:
+                return function(*args, **kwargs)
+
+            collector.enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                collector.leave(name)
+
+        return wrapper
+
+    return decorate
@@ -0,0 +1,348 @@
+import ast
+import json
+import os
+import re
+import tempfile
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Iterable, List, Optional, Set
+
+
+INDEX_FILE = 'symbols.json'
+INDEX_VERSION = 2
+
+ENUM_BASES = {'Enum', 'IntEnum', 'StrEnum', 'Flag', 'IntFlag', 'ReprEnum'}
+
+# classes whose bases are followed further than this are assumed to be malformed (e.g. cyclic)
+_MAX_BASE_DEPTH = 32
+
+# a class statement starts a logical line (decorators are lines of their own)
+_CLASS_STATEMENT_START = re.compile(r'^[ \t\f]*(?:\\\r?\n[ \t\f]*)*class\b', re.MULTILINE)
+
+
+@dataclass
+class ClassInfo:
+    name: str
+    file: str
+    bases: List[str]  # the last component of each base class expression
+    match_args: Optional[List[str]] = None  # an explicit __match_args__
+    fields: Optional[List[str]] = None  # positional dataclass / NamedTuple fields, the implicit __match_args__
+    members: List[str] = field(default_factory=list)  # public names assigned in the body (the members of an Enum)
+    plain: bool = False  # no decorator, class keyword or __match_args__: only a base class could give it __match_args__
+
+
+def _last_name(node: ast.expr) -> Optional[str]:
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        return node.attr
+    elif isinstance(node, ast.Call):
+        return _last_name(node.func)
+    elif isinstance(node, ast.Subscript):  # e.g. Generic[T]
+        return _last_name(node.value)
+    return None
+
+
+def _string_sequence(node: ast.expr) -> Optional[List[str]]:
+    if isinstance(node, (ast.Tuple, ast.List)) and \
+            all(isinstance(elt, ast.Constant) and isinstance(elt.value, str) for elt in node.elts):
+        return [elt.value for elt in node.elts]
+    return None
+
+
+def _dataclass_options(node: ast.ClassDef) -> Optional[Dict[str, bool]]:
+    # the boolean keywords of a @dataclass(...) decorator, or None for other classes
+    for decorator in node.decorator_list:
+        if _last_name(decorator) == 'dataclass':
+            keywords = decorator.keywords if isinstance(decorator, ast.Call) else []
+            return {keyword.arg: keyword.value.value for keyword in keywords
+                    if isinstance(keyword.value, ast.Constant) and isinstance(keyword.value.value, bool)}
+    return None
+
+
+def _field_flags(value: Optional[ast.expr]) -> Dict[str, bool]:
+    # the boolean keywords of a `= field(...)` default
+    if isinstance(value, ast.Call) and _last_name(value.func) == 'field':
+        return {keyword.arg: keyword.value.value for keyword in value.keywords
+                if isinstance(keyword.value, ast.Constant) and isinstance(keyword.value.value, bool)}
+    return {}
+
+
+def _class_info(node: ast.ClassDef, file: str) -> ClassInfo:
+    info = ClassInfo(node.name, file, [name for name in map(_last_name, node.bases) if name])
+    info.plain = not node.decorator_list and not node.keywords and len(info.bases) == len(node.bases)
+
+    dataclass_options = _dataclass_options(node)
+    is_named_tuple = 'NamedTuple' in info.bases
+    fields = []
+    keyword_only = dataclass_options is not None and dataclass_options.get('kw_only', False)
+
+    for statement in node.body:
+        if isinstance(statement, ast.Assign):
+            for target in statement.targets:
+                if isinstance(target, ast.Name) and target.id == '__match_args__':
+                    info.match_args = _string_sequence(statement.value)
+                    info.plain = False
+                elif isinstance(target, ast.Name) and not target.id.startswith('_'):
+                    info.members.append(target.id)
+
+        elif isinstance(statement, ast.AnnAssign) and isinstance(statement.target, ast.Name):
+            name = statement.target.id
+            annotation = _last_name(statement.annotation)
+
+            if annotation == 'KW_ONLY':
+                keyword_only = True
+            elif annotation != 'ClassVar':
+                flags = _field_flags(statement.value)
+                if flags.get('init', True) and not flags.get('kw_only', keyword_only):
+                    fields.append(name)
+
+    if is_named_tuple or (dataclass_options is not None and dataclass_options.get('match_args', True)):
+        info.fields = fields
+
+    return info
+
+
+def index_source(code: str, file: str) -> List[ClassInfo]:
+    # every class of a module, nested ones included; a file that does not parse has none,
+    # and one without a class statement is not parsed
+    if _CLASS_STATEMENT_START.search(code) is None:
+        return []
+
+    try:
+        root = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return []
+    return index_tree(root, file)
+
+
+def index_tree(root: ast.AST, file: str) -> List[ClassInfo]:
+    return [_class_info(node, file) for node in ast.walk(root) if isinstance(node, ast.ClassDef)]
+
+
+class SymbolIndex:
+    # The classes of the analyzed project, for resolving class and value patterns: bases,
+    # __match_args__, dataclass fields and Enum members. Each file is parsed once, and the
+    # index is kept on disk (INDEX_FILE in the cache directory) and updated incrementally:
+    # a file is only parsed again when its size or modification time changed.
+    def __init__(self):
+        self.files: Dict[str, dict] = dict()  # path -> {'mtime_ns', 'size', 'classes'}
+        self._by_name: Optional[Dict[str, List[ClassInfo]]] = None
+
+    @classmethod
+    def load(cls, cache_dir: Optional[str]) -> 'SymbolIndex':
+        index = cls()
+        if cache_dir is None:
+            return index
+
+        try:
+            with open(os.path.join(cache_dir, INDEX_FILE), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return index
+
+        if data.get('version') == INDEX_VERSION:
+            index.files = data['files']
+        return index
+
+    def save(self, cache_dir: Optional[str]):
+        if cache_dir is None:
+            return
+
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # written to a temporary file first, so that a concurrent reader never sees half an index
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'files': self.files}, f, separators=(',', ':'))
+            os.replace(temp_path, os.path.join(cache_dir, INDEX_FILE))
+        except OSError:
+            pass
+
+    def update(self, paths: Iterable[str]) -> int:
+        # brings the given files up to date and forgets the files that no longer exist;
+        # returns the number of files parsed
+        parsed = 0
+
+        for path in list(self.files):
+            if not os.path.exists(path):
+                del self.files[path]
+                self._invalidate()
+
+        for path in dict.fromkeys(os.path.abspath(path) for path in paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entry = self.files.get(path)
+            if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                continue
+
+            try:
+                with open(path, 'r') as f:
+                    code = f.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+
+            self.files[path] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                                'classes': [asdict(info) for info in index_source(code, path)]}
+            self._invalidate()
+            parsed += 1
+
+        return parsed
+
+    def restrict(self, paths: Iterable[str]) -> 'SymbolIndex':
+        # the index of only the given files: the one on disk may hold the files of other projects
+        index = SymbolIndex()
+        for path in map(os.path.abspath, paths):
+            if path in self.files:
+                index.files[path] = self.files[path]
+        return index
+
+    def add_tree(self, root: ast.AST, file: Optional[str]):
+        # indexes an already parsed module that is not (or not necessarily) on disk
+        path = os.path.abspath(file) if file is not None else '<source>'
+        self.files[path] = {'mtime_ns': None, 'size': None,
+                            'classes': [asdict(info) for info in index_tree(root, path)]}
+        self._invalidate()
+
+    def add_source(self, code: str, file: str):
+        # indexes a version of a file that is not the one on disk (e.g. at a git revision)
+        self.files[os.path.abspath(file)] = {'mtime_ns': None, 'size': None, 'classes': [
+            asdict(info) for info in index_source(code, os.path.abspath(file))]}
+        self._invalidate()
+
+    def with_source(self, code: str, file: str) -> 'SymbolIndex':
+        # the index with the classes of an unsaved version of a file in place of those on disk;
+        # the index itself when they are the same classes
+        path = os.path.abspath(file)
+        classes = [asdict(info) for info in index_source(code, path)]
+
+        entry = self.files.get(path)
+        if entry is not None and entry['classes'] == classes:
+            return self
+
+        index = SymbolIndex()
+        index.files = dict(self.files)
+        index.files[path] = {'mtime_ns': None, 'size': None, 'classes': classes}
+        return index
+
+    @classmethod
+    def for_tree(cls, root: ast.AST, file: Optional[str] = None) -> 'SymbolIndex':
+        index = cls()
+        index.add_tree(root, file)
+        return index
+
+    def _invalidate(self):
+        self._by_name = None
+
+    def classes(self, name: str) -> List[ClassInfo]:
+        if self._by_name is None:
+            self._by_name = dict()
+            for entry in self.files.values():
+                for data in entry['classes']:
+                    self._by_name.setdefault(data['name'], []).append(ClassInfo(**data))
+
+        return self._by_name.get(name, [])
+
+    def resolve(self, name: str, file: Optional[str] = None) -> Optional[ClassInfo]:
+        # a dotted name resolves by its last component; of several classes with that name, the
+        # one defined in the same file wins, and otherwise the name is ambiguous (None)
+        candidates = self.classes(name.rsplit('.', 1)[-1])
+
+        if len(candidates) == 1:
+            return candidates[0]
+
+        if file is not None:
+            path = os.path.abspath(file)
+            local = [info for info in candidates if info.file == path]
+            if len(local) == 1:
+                return local[0]
+
+        return None
+
+    def ancestry(self, info: ClassInfo) -> Set[str]:
+        # the names of the class and of all its base classes, as far as they are known
+        names = {info.name}
+        pending = [(info, 0)]
+
+        while pending:
+            current, depth = pending.pop()
+            if depth > _MAX_BASE_DEPTH:
+                continue
+
+            for base in current.bases:
+                if base in names:
+                    continue
+                names.add(base)
+                resolved = self.resolve(base, current.file)
+                if resolved is not None:
+                    pending.append((resolved, depth + 1))
+
+        return names
+
+    def match_args(self, info: ClassInfo) -> Optional[List[str]]:
+        # __match_args__ as Python sees it, or [] when the class is known to have none (a
+        # positional subpattern is then a TypeError); None when it is not known
+        found = self._match_args(info)
+        if found is None and self._lacks_match_args(info):
+            return []
+        return found
+
+    def _match_args(self, info: ClassInfo, depth: int = 0) -> Optional[List[str]]:
+        # explicit, generated for a dataclass (fields of the base dataclasses first) or
+        # NamedTuple, or inherited from a base class
+        if info.match_args is not None:
+            return info.match_args
+
+        inherited = None
+        if depth < _MAX_BASE_DEPTH:
+            for base in info.bases:
+                resolved = self.resolve(base, info.file)
+                if resolved is not None:
+                    inherited = self._match_args(resolved, depth + 1)
+                    if inherited is not None:
+                        break
+
+        if info.fields is not None:
+            inherited = inherited or []
+            return inherited + [name for name in info.fields if name not in inherited]
+
+        return inherited
+
+    def _lacks_match_args(self, info: ClassInfo, depth: int = 0) -> bool:
+        # a plain class whose base classes are all plain classes of the project
+        if not info.plain or depth >= _MAX_BASE_DEPTH:
+            return False
+
+        for base in info.bases:
+            if base == 'object':
+                continue
+            resolved = self.resolve(base, info.file)
+            if resolved is None or not self._lacks_match_args(resolved, depth + 1):
+                return False
+
+        return True
+
+    def enum_members(self, info: ClassInfo) -> Optional[List[str]]:
+        if not self.ancestry(info) & ENUM_BASES:
+            return None
+        return info.members
+
+    def layout(self, name: str, file: Optional[str] = None) -> Optional[list]:
+        # what the analysis of the patterns naming a class relies on; None when the name does not resolve
+        info = self.resolve(name, file)
+        if info is None:
+            return None
+        return [info.name, self.match_args(info), sorted(self.ancestry(info)), self.enum_members(info)]
+
+    def layouts(self, names: Iterable[str], file: Optional[str] = None) -> Dict[str, Optional[list]]:
+        return {name: self.layout(name, file) for name in names}
+
+    def __getstate__(self):
+        # handed to worker processes without the lookup tables, which are rebuilt on first use
+        return {'files': self.files}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.files = state['files']
@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from report import CaseResult, MatchError, MatchResult, analyze_source
+
+
+CLASSES = '''
+from dataclasses import dataclass
+
+class Plain:
+    pass
+
+class Shape:
+    pass
+
+class Circle(Shape):
+    pass
+
+class Square(Shape):
+    pass
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+class Labeled(Point):
+    pass
+
+class External(Base):
+    pass
+'''
+
+
+def records(match: str):
+    return list(analyze_source(CLASSES + match))
+
+
+def test_positional_subpatterns_need_match_args():
+    assert isinstance(records('match p:\n    case Plain(1): pass\n')[-1], MatchError)
+    assert isinstance(records('match p:\n    case Point(1, 2, 3): pass\n')[-1], MatchError)
+
+    # __match_args__ is inherited, and a class with an unknown base may have it
+    for match in ['match p:\n    case Labeled(1, 2): pass\n', 'match p:\n    case External(1): pass\n',
+                  'match p:\n    case Plain(): pass\n    case Plain(x=1): pass\n']:
+        assert not any(isinstance(record, MatchError) for record in records(match)), match
+
+
+def test_class_patterns_do_not_assume_the_type_of_the_subject():
+    # a base class covers its subclasses, but neither it nor they are taken to be the subject's type
+    for match in ['match p:\n    case Shape(): pass\n', 'match p:\n    case Circle(): pass\n    case Square(): pass\n']:
+        result = records(match)[-1]
+        assert isinstance(result, MatchResult) and result.exhaustive is False, match
+
+    cases = [record.useful for record in records('match p:\n    case Shape(): pass\n    case Circle(): pass\n')
+             if isinstance(record, CaseResult)]
+    assert cases == [True, False]
@@ -0,0 +1,70 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from daemon import INVALID_PARAMS, INVALID_REQUEST, METHOD_NOT_FOUND, PARSE_ERROR, AnalysisDaemon
+
+
+def make_daemon(tmp_path):
+    return AnalysisDaemon(cache_dir=str(tmp_path / 'cache'), use_cache=False, witnesses=False)
+
+
+def request(method, params=None, request_id=1):
+    message = {'jsonrpc': '2.0', 'method': method, 'params': params or {}}
+    if request_id is not None:
+        message['id'] = request_id
+    return message
+
+
+def error_code(response):
+    return response['error']['code']
+
+
+def test_analyze_answers_with_the_records_of_the_file(tmp_path):
+    daemon = make_daemon(tmp_path)
+    source = 'match x:\n    case _: pass\n    case 1: pass\n'
+
+    response = json.loads(daemon.handle_line(json.dumps(request('analyze', {'file': 'm.py', 'source': source}))))
+    assert response['id'] == 1 and not response['result']['cached']
+    assert [record['useful'] for record in response['result']['records'] if 'useful' in record] == [True, False]
+
+    again = daemon.handle(request('analyze', {'file': 'm.py', 'source': source}, 2))
+    assert again['id'] == 2 and again['result']['cached']
+
+
+def test_notifications_are_not_answered(tmp_path):
+    daemon = make_daemon(tmp_path)
+
+    assert daemon.handle_line(json.dumps(request('status', request_id=None))) is None
+    assert daemon.handle_line(json.dumps(request('missing', request_id=None))) is None
+    assert daemon.status()['requests'] == 1
+
+
+def test_batches_are_answered_together(tmp_path):
+    daemon = make_daemon(tmp_path)
+    batch = [request('status', request_id=1), request('status', request_id=None), request('nope', request_id=2), 3]
+
+    responses = json.loads(daemon.handle_line(json.dumps(batch)))
+    assert [response['id'] for response in responses] == [1, 2, None]
+    assert 'result' in responses[0]
+    assert error_code(responses[1]) == METHOD_NOT_FOUND
+    assert error_code(responses[2]) == INVALID_REQUEST
+
+    assert daemon.handle_line(json.dumps([request('status', request_id=None)])) is None
+    assert error_code(json.loads(daemon.handle_line('[]'))) == INVALID_REQUEST
+
+
+def test_errors(tmp_path):
+    daemon = make_daemon(tmp_path)
+
+    assert error_code(json.loads(daemon.handle_line('{"jsonrpc": "2.0", '))) == PARSE_ERROR
+    assert error_code(daemon.handle({'id': 1, 'method': 'status'})) == INVALID_REQUEST
+    assert error_code(daemon.handle(request('status', {'verbose': True}))) == INVALID_PARAMS
+    assert error_code(daemon.handle({'jsonrpc': '2.0', 'id': 1, 'method': 'status', 'params': [1]})) == INVALID_PARAMS
+
+    for params in ({'file': 5}, {}, {'file': 'm.py', 'source': 1}, {'file': 'm.py', 'format': 'xml'},
+                   {'file': 'm.py', 'missing': 0}, {'file': 'm.py', 'witnesses': 'yes'}):
+        assert error_code(daemon.handle(request('analyze', params))) == INVALID_PARAMS, params
+    assert error_code(daemon.handle(request('invalidate', {'file': 5}))) == INVALID_PARAMS
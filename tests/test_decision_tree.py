@@ -0,0 +1,91 @@
+import ast
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decision_tree import DecisionTree
+from pattern_converter import convert_pattern_matrix, get_subjects
+from pattern_matching_checker import COLUMN_STRATEGIES, build_coverage_space
+
+
+MATCHES = [
+    '''
+match x:
+    case [1, 2] | [3, 4]: pass
+''',
+    '''
+match x, y:
+    case (1, 2): pass
+    case [1, *_]: pass
+    case (8, 8): pass
+''',
+    '''
+match x, y:
+    case (1, _) | (_, 1): pass
+    case [2, 2] | (3, 3): pass
+    case _, 1: pass
+''',
+    '''
+match x:
+    case None: pass
+    case _: pass
+    case 1 | False: pass
+''',
+    '''
+match x:
+    case 2: pass
+    case 1 | _: pass
+    case y: pass
+''',
+    '''
+match x, y:
+    case _, True: pass
+    case None, _: pass
+    case (v, _) | (False, _): pass
+    case _, _: pass
+''',
+    '''
+match x, y, z:
+    case (_, 1, 3) | ([3], [], None): pass
+    case [2], 1, None: pass
+''',
+    '''
+match x:
+    case [1, *_]: pass
+    case [*_, 2]: pass
+    case []: pass
+    case [_, _]: pass
+''',
+    '''
+match x, y:
+    case True, False: pass
+    case False, True: pass
+    case True | False, _: pass
+    case _, None: pass
+''',
+]
+
+
+def test_tree_verdicts_agree_with_the_coverage_space():
+    for source in MATCHES:
+        node = ast.parse(source).body[0]
+        width = len(get_subjects(node))
+        matrix = convert_pattern_matrix(node)
+        space, useful = build_coverage_space(matrix, width)
+
+        for strategy in COLUMN_STRATEGIES.values():
+            tree = DecisionTree.compile(matrix, strategy, width)
+            analysis = tree.analyze()
+
+            assert analysis.useful == useful, (source, strategy.__name__, analysis.useful, useful)
+            assert analysis.exhaustive == space.is_exhaustive(), (source, strategy.__name__)
+            assert DecisionTree.from_json(tree.to_json()).to_dict() == tree.to_dict()
+
+
+def test_sequence_alternatives_of_a_single_subject_are_useful():
+    node = ast.parse(MATCHES[0]).body[0]
+    analysis = DecisionTree.compile(convert_pattern_matrix(node), width=1).analyze()
+
+    assert analysis.useful == [True]
+    assert not analysis.exhaustive
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from git_diff import parse_unified_diff, read_revisions
+
+
+def test_new_files_are_changed_throughout():
+    diff = ['diff --git a/new.py b/new.py', 'new file mode 100644', '--- /dev/null', '+++ b/new.py',
+            '@@ -0,0 +1,3 @@', '+a = 1', '+b = 2', '+c = 3']
+
+    assert parse_unified_diff(diff) == {'new.py': [(1, 3)]}
+
+
+def test_deleted_files_are_left_out():
+    diff = ['diff --git a/old.py b/old.py', 'deleted file mode 100644', '--- a/old.py', '+++ /dev/null',
+            '@@ -1,2 +0,0 @@', '-a = 1', '-b = 2']
+
+    assert parse_unified_diff(diff) == {}
+
+
+def test_deletions_change_the_lines_around_them():
+    diff = ['--- a/m.py', '+++ b/m.py', '@@ -5,2 +4,0 @@', '-x', '-y', '@@ -1 +0,0 @@', '-z', '@@ -9 +8 @@', '-u', '+v']
+
+    assert parse_unified_diff(diff) == {'m.py': [(4, 5), (1, 1), (8, 8)]}
+
+
+def test_names_end_at_a_tab():
+    # diff -u (and git for names with spaces) appends a tab and a timestamp
+    diff = ['--- a/with space.py\t2024-01-01 00:00:00', '+++ b/with space.py\t2024-01-02 00:00:00',
+            '@@ -1,1 +1,2 @@', ' a', '+b']
+
+    assert parse_unified_diff(diff) == {'with space.py': [(1, 2)]}
+
+
+def test_files_are_read_at_a_revision(tmp_path):
+    def git(*args):
+        subprocess.run(['git', '-c', 'user.name=a', '-c', 'user.email=a@b', *args], cwd=tmp_path, check=True,
+                       capture_output=True)
+
+    git('init', '-q')
+    (tmp_path / 'a.py').write_text('first\n')
+    (tmp_path / 'b c.py').write_text('')
+    git('add', '.')
+    git('commit', '-q', '-m', 'one')
+    (tmp_path / 'a.py').write_text('second\n')
+    (tmp_path / 'new.py').write_text('new\n')
+
+    paths = [str(tmp_path / 'a.py'), str(tmp_path / 'new.py'), str(tmp_path / 'b c.py')]
+    assert read_revisions(paths, 'HEAD', str(tmp_path)) == {str(tmp_path / 'a.py'): 'first\n',
+                                                           str(tmp_path / 'b c.py'): ''}
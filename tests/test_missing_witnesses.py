@@ -0,0 +1,176 @@
+import ast
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pattern_converter import convert_pattern_matrix, get_subjects
+from pattern_matching_checker import (
+    COLUMN_STRATEGIES, missing_results, python_value, set_column_strategy, useless_pattern_results
+)
+
+
+MATCHES = [
+    '''
+match x, y:
+    case 1, 2: pass
+    case 2, 3: pass
+    case (2, _) | (_, 2): pass
+    case 2, 4: pass
+    case _, 3: pass
+    case _, 4: pass
+''',
+    '''
+match x, y:
+    case (2, _) | (_, 2): pass
+    case True, 5: pass
+''',
+    '''
+match x, y:
+    case 1, 2: pass
+    case 3, _: pass
+    case _, 4: pass
+    case "a", True: pass
+''',
+    '''
+match x:
+    case 0 | 1 | 2: pass
+    case 3: pass
+''',
+    '''
+match x:
+    case [1, *_]: pass
+    case []: pass
+''',
+    '''
+match x:
+    case [1, *_, 2]: pass
+    case [_]: pass
+''',
+    '''
+match x, y:
+    case [1, *_], None: pass
+    case [], _: pass
+    case _, True: pass
+''',
+    '''
+match x, y, z:
+    case True, _, 1: pass
+    case _, False, 2: pass
+    case None, _, _: pass
+''',
+    '''
+match x:
+    case int(): pass
+    case str(): pass
+''',
+    '''
+match x:
+    case int(): pass
+    case 5: pass
+    case True: pass
+    case "a": pass
+''',
+    '''
+match x:
+    case bool(): pass
+    case int(3): pass
+    case None: pass
+''',
+    '''
+match x, y:
+    case 0, float(): pass
+    case str(), 1.5: pass
+    case (int() | str()), _: pass
+''',
+    '''
+match x, y:
+    case _, [["b"], *r, 2]: pass
+    case ([4, "b"] | None), "b": pass
+''',
+    '''
+match x, y, z:
+    case _, 1, "a": pass
+    case _, 2, _: pass
+    case 0, _, "b": pass
+    case _, [1, *_], "a": pass
+    case 1, 1, _: pass
+''',
+    '''
+match x:
+    case "1": pass
+    case 1: pass
+    case "None" | None: pass
+''',
+]
+
+
+def case_matched(node: ast.Match, subjects, values):
+    # runs the match statement on the values: the index of the case that matches them, or None
+    node = ast.Match(node.subject, [ast.match_case(case.pattern, case.guard, [ast.Return(ast.Constant(i))])
+                                    for i, case in enumerate(node.cases)])
+    arguments = ast.arguments([], [ast.arg(subject) for subject in subjects], None, [], [], None, [])
+    module = ast.Module([ast.FunctionDef('run', arguments, [node, ast.Return(ast.Constant(None))], [])], [])
+    namespace = dict()
+    exec(compile(ast.fix_missing_locations(module), '<match>', 'exec'), namespace)
+    return namespace['run'](*values)
+
+
+def column_patterns(pattern: ast.pattern, width: int, column: int):
+    # the patterns the subject of a column is tested with, through or-patterns and subject tuples
+    if isinstance(pattern, ast.MatchOr):
+        for alternative in pattern.patterns:
+            yield from column_patterns(alternative, width, column)
+    elif isinstance(pattern, ast.MatchAs) and pattern.pattern is not None:
+        yield from column_patterns(pattern.pattern, width, column)
+    elif width > 1 and isinstance(pattern, ast.MatchSequence):
+        if len(pattern.patterns) == width:
+            yield from column_patterns(pattern.patterns[column], 1, 0)
+    else:
+        yield pattern
+
+
+def test_missing_witnesses_are_not_matched_by_any_row():
+    for source in MATCHES:
+        node = ast.parse(source).body[0]
+        subjects = get_subjects(node)
+        exhaustive, witnesses = missing_results(convert_pattern_matrix(node), width=len(subjects), limit=8)
+
+        assert not exhaustive and witnesses, source
+        assert len({repr(witness) for witness in witnesses}) == len(witnesses), (source, witnesses)
+
+        for witness in witnesses:
+            assert len(witness) == len(subjects), (source, witness)
+            values = [python_value(value) for value in witness]
+
+            # a sequence is only an example for a subject that sequence patterns test
+            for column, value in enumerate(values):
+                if isinstance(value, list):
+                    assert any(isinstance(pattern, ast.MatchSequence) for case in node.cases
+                               for pattern in column_patterns(case.pattern, len(subjects), column)), \
+                        (source, values)
+
+            assert case_matched(node, subjects, values) is None, (source, values)
+
+
+def test_case_witnesses_are_matched_by_their_case_first():
+    for source in MATCHES:
+        node = ast.parse(source).body[0]
+        subjects = get_subjects(node)
+        matrix = convert_pattern_matrix(node)
+
+        for i, (useful, witness) in enumerate(useless_pattern_results(matrix, width=len(subjects))):
+            if useful and witness is not None:
+                values = [python_value(value) for value in witness]
+                assert case_matched(node, subjects, values) == i, (source, i, values)
+
+
+def test_witnesses_hold_in_every_column_order():
+    # the coverage space tests the subjects in the order the column strategy picks
+    for strategy in COLUMN_STRATEGIES:
+        set_column_strategy(strategy)
+        try:
+            test_missing_witnesses_are_not_matched_by_any_row()
+            test_case_witnesses_are_matched_by_their_case_first()
+        finally:
+            set_column_strategy('first')
@@ -0,0 +1,29 @@
+import ast
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pattern_converter import may_contain_match
+
+
+SOURCES = [
+    ('match x:\n    case 1: pass\n', True),
+    ('match ...:\n    case _: pass\n', True),
+    ('match .5:\n    case 0.5: pass\n', True),
+    ('match -x, y:\n    case _: pass\n', True),
+    ('if True:\n    \\\n    match x:\n        case _: pass\n', True),
+    ('match = re.match(p, s)\n', False),
+    ('match.group(1)\n', False),
+    ('match . group(1)\n', False),
+    ('match: int = 1\n', False),
+    ('match, rest = pair\n', False),
+    ('match *= 2\n', False),
+]
+
+
+def test_prefilter_finds_the_match_statements():
+    for source, has_match in SOURCES:
+        parsed = any(isinstance(node, ast.Match) for node in ast.walk(ast.parse(source)))
+        assert parsed == has_match, source
+        assert may_contain_match(source) == has_match, source
@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import report
+from report import CaseResult, analyze_file, analyze_source
+from result_cache import ResultCache
+
+
+def case_witnesses(source: str, cache: ResultCache):
+    return [record.witness for record in analyze_source(source, cache=cache) if isinstance(record, CaseResult)]
+
+
+def test_literals_of_different_types_do_not_share_a_key(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    first = 'match x:\n    case "1": pass\n    case True: pass\n'
+    second = 'match x:\n    case 1: pass\n    case "True": pass\n'
+
+    assert case_witnesses(first, cache) == [['"1"'], ['True']]
+    assert case_witnesses(second, cache) == [['1'], ['"True"']]
+    assert case_witnesses(second, ResultCache(str(tmp_path))) == case_witnesses(second, None)
+
+
+def test_results_without_an_example_are_not_cached(tmp_path, monkeypatch):
+    # as when z3 times out: the case is useful, but has no example
+    def without_examples(matrix, *args, **kwargs):
+        return ((True, None) for _ in matrix)
+
+    path = tmp_path / 'match.py'
+    path.write_text('match x:\n    case 1: pass\n')
+    cache = ResultCache(str(tmp_path / 'cache'))
+
+    monkeypatch.setattr(report, 'useless_pattern_results', without_examples)
+    assert [record.witness for record in analyze_file(str(path), cache) if isinstance(record, CaseResult)] == [None]
+
+    monkeypatch.undo()
+    assert [record.witness for record in analyze_file(str(path), cache) if isinstance(record, CaseResult)] == [['1']]
@@ -1,19 +1,35 @@
-import z3
+import functools
+import importlib
+
+
+@functools.lru_cache(maxsize=None)
+def load_z3():
+    # z3 is loaded on the first witness query rather than on import, so that runs without
+    # witnesses never pay for it
+    return importlib.import_module('z3')
 
 
 TYPE_INT = 0
 TYPE_BOOL = 1
 TYPE_STRING = 2
 
+ALL_TYPES = (TYPE_INT, TYPE_BOOL, TYPE_STRING)
+
 
 class UnionVar:
-    def __init__(self, name: str):
+    # A subject value of one of the given types. With a single type there is no type tag,
+    # and sorts of types that are not needed are never declared (in particular, no string
+    # sort unless strings are needed, which keeps z3's string solver out of the query).
+    def __init__(self, name: str, types=ALL_TYPES):
+        z3 = load_z3()
+
         self.name = name
+        self.types = tuple(sorted(set(types)))
 
-        self.type_var = z3.Int(f'{name}_type')
-        self.int_var = z3.Int(f'{name}_int')
-        self.bool_var = z3.Bool(f'{name}_bool')
-        self.string_var = z3.String(f'{name}_string')
+        self.type_var = z3.Int(f'{name}_type') if len(self.types) > 1 else None
+        self.int_var = z3.Int(f'{name}_int') if TYPE_INT in self.types else None
+        self.bool_var = z3.Bool(f'{name}_bool') if TYPE_BOOL in self.types else None
+        self.string_var = z3.String(f'{name}_string') if TYPE_STRING in self.types else None
 
     def get_int_var(self):
         return self.int_var
@@ -27,31 +43,86 @@ class UnionVar:
     def get_type_var(self):
         return self.type_var
 
+    def has_type(self, type_tag: int):
+        z3 = load_z3()
+
+        if type_tag not in self.types:
+            return z3.BoolVal(False)
+        elif self.type_var is None:
+            return z3.BoolVal(True)
+        return self.type_var == type_tag
+
     def type_validity(self):
-        return z3.Or(self.type_var == TYPE_INT,
-                  self.type_var == TYPE_BOOL,
-                  self.type_var == TYPE_STRING)
+        z3 = load_z3()
+
+        if self.type_var is None:
+            return z3.BoolVal(True)
+
+        return z3.Or(*[self.type_var == type_tag for type_tag in self.types])
 
     def default_constraints(self):
-        constraints = [self.type_validity(),
-                       z3.Implies(self.type_var != TYPE_INT, self.int_var == 0),
-                       z3.Implies(self.type_var != TYPE_BOOL, self.bool_var == False),
-                       z3.Implies(self.type_var != TYPE_STRING, self.string_var == "")]
+        z3 = load_z3()
+
+        constraints = [self.type_validity()]
+
+        if self.type_var is not None:
+            if self.int_var is not None:
+                constraints.append(z3.Implies(self.type_var != TYPE_INT, self.int_var == 0))
+            if self.bool_var is not None:
+                constraints.append(z3.Implies(self.type_var != TYPE_BOOL, self.bool_var == False))
+            if self.string_var is not None:
+                constraints.append(z3.Implies(self.type_var != TYPE_STRING, self.string_var == ""))
 
         return z3.And(*constraints)
 
+    def value_from_model(self, model):
+        if self.type_var is None:
+            type_tag = self.types[0]
+        else:
+            type_tag = model.eval(self.type_var, model_completion=True).as_long()
+
+        if type_tag == TYPE_INT:
+            return model.eval(self.int_var, model_completion=True)
+        elif type_tag == TYPE_BOOL:
+            return model.eval(self.bool_var, model_completion=True)
+        elif type_tag == TYPE_STRING:
+            return model.eval(self.string_var, model_completion=True)
+        else:
+            raise ValueError("Unknown type variable in model")
+
     def __eq__(self, other):
+        z3 = load_z3()
+
+        # bool is checked before int, since bool is a subclass of int
         match other:
-            case int():
-                compare_condition = z3.And(self.type_var == TYPE_INT, self.int_var == other)
             case bool():
-                compare_condition = z3.And(self.type_var == TYPE_BOOL, self.bool_var == other)
+                var, type_tag = self.bool_var, TYPE_BOOL
+            case int():
+                var, type_tag = self.int_var, TYPE_INT
             case str():
-                compare_condition = z3.And(self.type_var == TYPE_STRING, self.string_var == other)
+                var, type_tag = self.string_var, TYPE_STRING
             case _:
                 raise ValueError(f"Unsupported type for comparison: {type(other)}")
 
-        return compare_condition
+        if var is None:  # the value cannot have this type
+            return z3.BoolVal(False)
+
+        return z3.And(self.has_type(type_tag), var == other)
 
     def __ne__(self, other):
+        z3 = load_z3()
+
         return z3.Not(self.__eq__(other))
+
+
+def value_type(value):
+    # the union type a literal value needs, or None if it cannot be encoded
+    match value:
+        case bool():
+            return TYPE_BOOL
+        case int():
+            return TYPE_INT
+        case str():
+            return TYPE_STRING
+        case _:
+            return None